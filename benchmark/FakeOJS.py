@@ -0,0 +1,97 @@
+import random
+import re
+import threading
+import time
+
+# Stand-in for the OJS 3.3 REST API, used by the offline benchmark.
+# Serves a journal with the given number of active submissions, issues and sections: the paginated
+# submission and issue listings, single submissions, publications and issue details (with the sections).
+# The last issue is unpublished, all others are published. The data is generated from a seed, so every
+# benchmark run sees the same journal.
+
+class FakeOJS:
+
+    def __init__(self, submissions=100, issues=5, sections=5, locale='de_DE', seed=1):
+        self.random = random.Random(seed)
+        self.locale = locale
+        stamp = "2025-01-01 00:00:00"
+        self.sections = [{"id": 100 + i, "title": {locale: f"Section {i + 1}"}, "abbrev": {locale: f"S{i + 1}"}} for i in range(sections)]
+        self.issues = []
+        for i in range(issues):
+            self.issues.append({"id": 10 + i, "volume": i + 1, "number": "1", "year": 2020 + i, "locale": locale,
+                                "identification": f"Vol. {i + 1} No. 1 ({2020 + i})", "title": {locale: f"Issue {i + 1}"},
+                                "isPublished": i < issues - 1, "lastModified": stamp, "sections": self.sections})
+        self.submissions = []
+        self.publications = {}
+        for i in range(submissions):
+            submission_id = 1000 + i
+            publication_id = 50000 + i
+            self.publications[publication_id] = {
+                "id": publication_id, "submissionId": submission_id, "fullTitle": {locale: f"Title of submission {submission_id}"},
+                "_href": f"http://ojs.invalid/index.php/journal/api/v1/submissions/{submission_id}/publications/{publication_id}",
+                "authorsStringShort": f"Author {i + 1} et al.",
+                "sectionId": self.random.choice(self.sections)['id'] if self.sections else None,
+                "issueId": self.random.choice(self.issues)['id'] if self.issues else None,
+                "lastModified": stamp,
+                # OJS publications carry many more fields, e.g. the abstract
+                "abstract": {locale: "Lorem ipsum dolor sit amet. " * 40}
+            }
+            self.submissions.append({
+                "id": submission_id, "locale": locale, "stageId": self.random.randint(1, 5), "status": 1,
+                "currentPublicationId": publication_id, "dateLastActivity": stamp, "lastModified": stamp,
+                "_href": f"http://ojs.invalid/index.php/journal/api/v1/submissions/{submission_id}",
+                "publications": [{"id": publication_id, "lastModified": stamp, "fullTitle": {locale: f"Title of submission {submission_id}"}}]
+            })
+        self.lock = threading.Lock()
+
+    def churn(self, fraction):
+        """Change a fraction of the submissions as editors would: move them to the next stage or edit the title"""
+        count = min(len(self.submissions), max(1, round(len(self.submissions) * fraction))) if self.submissions else 0
+        stamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        changed = self.random.sample(self.submissions, count)
+        for i, submission in enumerate(changed):
+            publication = self.publications[submission['currentPublicationId']]
+            if i % 2:
+                publication['fullTitle'][self.locale] += " (revised)"
+                publication['lastModified'] = stamp
+                submission['publications'][0]['lastModified'] = stamp
+            else:
+                submission['stageId'] = submission['stageId'] % 5 + 1
+            submission['dateLastActivity'] = stamp
+            submission['lastModified'] = stamp
+        return [submission['id'] for submission in changed]
+
+    def handle(self, method, path, query, body):
+        """Answer a request, returns (status, JSON payload)"""
+        match = re.match(r".*/api/v1/+(.*)$", path)
+        if not match or method != 'GET':
+            return 404, {"error": "api.404.endpointNotFound"}
+        endpoint = match.group(1)
+        count = int(query.get('count', ['20'])[0])
+        offset = int(query.get('offset', ['0'])[0])
+        if endpoint == 'submissions':
+            statuses = [int(status) for status in query.get('status', ['1'])[0].split(',')]
+            items = [submission for submission in self.submissions if submission['status'] in statuses]
+            return 200, {"itemsMax": len(items), "items": items[offset:offset + count]}
+        match = re.fullmatch(r"submissions/(\d+)", endpoint)
+        if match:
+            submission = next((s for s in self.submissions if s['id'] == int(match.group(1))), None)
+            return (200, submission) if submission else (404, {"error": "api.404.resourceNotFound"})
+        match = re.fullmatch(r"submissions/(\d+)/publications/(\d+)", endpoint)
+        if match:
+            publication = self.publications.get(int(match.group(2)))
+            if not publication or publication['submissionId'] != int(match.group(1)):
+                return 404, {"error": "api.404.resourceNotFound"}
+            return 200, publication
+        if endpoint == 'issues':
+            items = self.issues
+            if 'isPublished' in query:
+                published = query['isPublished'][0] in ('1', 'true')
+                items = [issue for issue in items if issue['isPublished'] == published]
+            summaries = [{key: value for key, value in issue.items() if key != 'sections'} for issue in items]
+            return 200, {"itemsMax": len(summaries), "items": summaries[offset:offset + count]}
+        match = re.fullmatch(r"issues/(\d+)", endpoint)
+        if match:
+            issue = next((issue for issue in self.issues if issue['id'] == int(match.group(1))), None)
+            return (200, issue) if issue else (404, {"error": "api.404.resourceNotFound"})
+        return 404, {"error": "api.404.endpointNotFound"}
@@ -0,0 +1,118 @@
+import gzip
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from benchmark.FakeOJS import FakeOJS
+from benchmark.FakeWekan import FakeWekan
+
+# Local HTTP server for a stand-in API (FakeOJS or FakeWekan), used by the offline benchmark.
+# Every response is delayed by `latency` seconds and compressed if the client accepts gzip. The server counts
+# the requests per endpoint (IDs in the path are replaced by {id}) and the bytes received and sent.
+#
+# serve() runs the stand-in servers for OJS and Wekan in a separate process, so the time and memory measured
+# by the benchmark belong to the middleware only. The process is controlled through a pipe.
+
+class FakeServer:
+
+    def __init__(self, app, latency=0.0, host='127.0.0.1'):
+        self.app = app
+        self.latency = latency
+        self.requests = Counter()
+        self.bytes_received = 0
+        self.bytes_sent = 0
+        self.stats_lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def handle_request(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                try:
+                    body = json.loads(raw) if raw else {}
+                except ValueError:
+                    body = {}
+                if server.latency:
+                    time.sleep(server.latency)
+                parsed = urlparse(self.path)
+                with server.app.lock:
+                    status, payload = server.app.handle(self.command, parsed.path, parse_qs(parsed.query), body)
+                data = json.dumps(payload).encode('utf-8')
+                compressed = 'gzip' in (self.headers.get('Accept-Encoding') or '')
+                if compressed:
+                    data = gzip.compress(data, compresslevel=5)
+                server.count(self.command, parsed.path, len(self.requestline) + len(str(self.headers)) + len(raw), len(data))
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                if compressed:
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+        self.httpd = ThreadingHTTPServer((host, 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self, method, path, received, sent):
+        endpoint = "/".join("{id}" if re.fullmatch(r"\d+|[0-9a-f]{17}", segment) else segment for segment in path.split("/"))
+        with self.stats_lock:
+            self.requests[f"{method} {endpoint}"] += 1
+            self.bytes_received += received
+            self.bytes_sent += sent
+
+    def stats(self, reset=False):
+        """Requests per endpoint and transferred bytes since the last reset"""
+        with self.stats_lock:
+            stats = {"requests": dict(self.requests), "bytesReceived": self.bytes_received, "bytesSent": self.bytes_sent}
+            if reset:
+                self.requests.clear()
+                self.bytes_received = 0
+                self.bytes_sent = 0
+        return stats
+
+
+def serve(options, connection):
+    """Run the OJS and Wekan stand-ins until 'stop' is received, commands and answers are sent through the pipe"""
+    ojs = FakeServer(FakeOJS(submissions=options['submissions'], issues=options['issues'], sections=options['sections'],
+                             seed=options.get('seed', 1)), latency=options['latency']).start()
+    wekan = FakeServer(FakeWekan(options['board_title'], options['swimlanes'], options['lists'],
+                                 existing_cards=options['existing_cards'], seed=options.get('seed', 1)), latency=options['latency']).start()
+    connection.send({"ojs": ojs.url, "wekan": wekan.url})
+    try:
+        while True:
+            command, argument = connection.recv()
+            if command == 'stats':
+                connection.send({"ojs": ojs.stats(reset=argument), "wekan": wekan.stats(reset=argument)})
+            elif command == 'churn':
+                with ojs.app.lock:
+                    connection.send(ojs.app.churn(argument))
+            elif command == 'drift':
+                with wekan.app.lock:
+                    connection.send(wekan.app.drift(argument))
+            elif command == 'stop':
+                break
+    finally:
+        ojs.stop()
+        wekan.stop()
+        connection.close()
@@ -0,0 +1,142 @@
+import random
+import re
+import threading
+import time
+import uuid
+
+# Stand-in for the Wekan REST API, used by the offline benchmark.
+# Implements the endpoints used by the middleware (login, boards, swimlanes, lists, cards, custom fields and
+# checklists) on an in-memory board. As in Wekan, the card listing of a swimlane or list only returns the
+# _id, title, description and listId of the cards, and a single card is only found in its current list.
+# Every card change is recorded as an activity of the user who made it, the board export returns the full
+# cards and the activities.
+
+def new_id():
+    return uuid.uuid4().hex[:17]
+
+
+class FakeWekan:
+
+    def __init__(self, board_title, swimlane_titles, list_titles, existing_cards=0, seed=1):
+        self.user_id = new_id()
+        self.token = new_id()
+        self.board = {"_id": new_id(), "title": board_title}
+        self.swimlanes = [{"_id": new_id(), "title": title} for title in swimlane_titles]
+        self.lists = [{"_id": new_id(), "title": title} for title in list_titles]
+        self.cards = {}
+        self.custom_fields = []
+        self.checklists = []
+        self.activities = []
+        self.last_time = 0
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        # cards that are not managed by the middleware, e.g. created by hand
+        for i in range(existing_cards):
+            self.add_card(f"Existing card {i + 1}", "Created by hand", self.lists[i % len(self.lists)]['_id'],
+                          self.swimlanes[i % len(self.swimlanes)]['_id'])
+
+    def add_card(self, title, description, list_id, swimlane_id):
+        card = {"_id": new_id(), "title": title, "description": description, "listId": list_id, "swimlaneId": swimlane_id,
+                "boardId": self.board['_id'], "archived": False, "parentId": "", "color": "white",
+                "customFields": [{"_id": field['_id'], "value": None} for field in self.custom_fields if field.get('automaticallyOnCard')],
+                "modifiedAt": self.now(), "dateLastActivity": self.now()}
+        self.cards[card['_id']] = card
+        self.add_activity(card, 'createdCard', self.user_id)
+        return card
+
+    def add_activity(self, card, activity_type, user_id):
+        self.activities.append({"_id": new_id(), "activityType": activity_type, "userId": user_id, "boardId": self.board['_id'],
+                                "cardId": card['_id'], "createdAt": self.now()})
+
+    def handle(self, method, path, query, body):
+        """Answer a request, returns (status, JSON payload)"""
+        board_id = self.board['_id']
+        if method == 'POST' and path == '/users/login':
+            return 200, {"id": self.user_id, "token": self.token, "tokenExpires": "2099-01-01T00:00:00.000Z"}
+        if method == 'GET' and re.fullmatch(r"/api/users/[^/]+/boards", path):
+            return 200, [self.board]
+        if method == 'GET' and path == f"/api/boards/{board_id}/export":
+            if query.get('authToken', [None])[0] != self.token:
+                return 401, {"error": "Unauthorized"}
+            return 200, dict(self.board, cards=list(self.cards.values()), activities=self.activities)
+        if path == f"/api/boards/{board_id}/swimlanes":
+            return 200, self.swimlanes
+        if path == f"/api/boards/{board_id}/lists":
+            return 200, self.lists
+        if path == f"/api/boards/{board_id}/custom-fields":
+            if method == 'GET':
+                return 200, [{"_id": field['_id'], "name": field['name'], "type": field['type']} for field in self.custom_fields]
+            field = dict(body, _id=new_id())
+            self.custom_fields.append(field)
+            return 200, {"_id": field['_id']}
+        match = re.fullmatch(rf"/api/boards/{board_id}/custom-fields/([^/]+)", path)
+        if match:
+            field = next((field for field in self.custom_fields if field['_id'] == match.group(1)), None)
+            return (200, field) if field else (404, {"error": "Custom field not found"})
+        match = re.fullmatch(rf"/api/boards/{board_id}/swimlanes/([^/]+)/cards", path)
+        if match:
+            return 200, [self.summary(card) for card in self.cards.values() if card['swimlaneId'] == match.group(1) and not card['archived']]
+        match = re.fullmatch(rf"/api/boards/{board_id}/lists/([^/]+)/cards", path)
+        if match and method == 'GET':
+            return 200, [self.summary(card) for card in self.cards.values() if card['listId'] == match.group(1) and not card['archived']]
+        if match and method == 'POST':
+            card = self.add_card(body.get('title'), body.get('description', ''), match.group(1), body.get('swimlaneId'))
+            return 200, {"_id": card['_id']}
+        match = re.fullmatch(rf"/api/boards/{board_id}/lists/([^/]+)/cards/([^/]+)", path)
+        if match:
+            card = self.cards.get(match.group(2))
+            if not card:
+                return 404, {"error": "Card not found"}
+            if method == 'GET':
+                return 200, card if card['listId'] == match.group(1) else {}
+            if method == 'PUT':
+                self.edit_card(card, body)
+                return 200, {"_id": card['_id']}
+        match = re.fullmatch(rf"/api/boards/{board_id}/cards/([^/]+)/checklists", path)
+        if match and method == 'POST':
+            self.checklists.append(dict(body, cardId=match.group(1)))
+            return 200, {"_id": new_id()}
+        return 404, {"error": f"Unknown endpoint {method} {path}"}
+
+    def drift(self, fraction):
+        """Change a fraction of the synchronized cards by hand: move them to another list or edit their Title field"""
+        synchronized = [card for card in self.cards.values() if not card['archived'] and any(field['value'] for field in card['customFields'])]
+        count = min(len(synchronized), max(1, round(len(synchronized) * fraction))) if synchronized else 0
+        changed = self.random.sample(synchronized, count)
+        editor_id = new_id()
+        for i, card in enumerate(changed):
+            if i % 2:
+                self.edit_card(card, {"customFields": [dict(field, value=f"{field['value']} (edited)") for field in card['customFields'] if field['value']]},
+                               editor_id)
+            else:
+                self.edit_card(card, {"listId": next(lst['_id'] for lst in self.lists if lst['_id'] != card['listId'])}, editor_id)
+        return [card['_id'] for card in changed]
+
+    def edit_card(self, card, changes, user_id=None):
+        for key, value in changes.items():
+            if key == 'newBoardId':
+                continue
+            if key == 'newSwimlaneId':
+                card['swimlaneId'] = value
+            elif key == 'archive':
+                card['archived'] = value in (True, 'true')
+            elif key == 'customFields':
+                for custom_field in value:
+                    known = next((field for field in card['customFields'] if field['_id'] == custom_field['_id']), None)
+                    if known:
+                        known['value'] = custom_field['value']
+                    else:
+                        card['customFields'].append(dict(custom_field))
+            else:
+                card[key] = value
+        card['modifiedAt'] = self.now()
+        self.add_activity(card, 'editedCard', user_id or self.user_id)
+
+    @staticmethod
+    def summary(card):
+        return {key: card[key] for key in ('_id', 'title', 'description', 'listId')}
+
+    def now(self):
+        # strictly increasing milliseconds, so activities are ordered by their creation time as in Wekan
+        self.last_time = max(self.last_time + 1, int(time.time() * 1000))
+        return time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(self.last_time // 1000)) + f".{self.last_time % 1000:03d}Z"
@@ -0,0 +1,236 @@
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from middleware.SyncPlanner import SyncPlanner
+
+# Resumable backfill of submissions with any set of statuses, e.g. to onboard a journal with thousands of
+# published and scheduled submissions. The submissions are streamed from OJS in batches of
+# BACKFILL_BATCH_SIZE, oldest first (see OJSAPI.iterSubmissionPages). Per batch:
+#   - the cards of the issues the submissions belong to are planned and written first, so the submission
+#     cards can be linked to them (a regular sync only writes the cards of future issues)
+#   - the submission cards are planned against the board snapshot and written SYNC_CONCURRENCY at a time
+#   - the sync state of all cards of the batch is committed in one transaction
+#   - the finished submissions of the batch are recorded as "backfilled", the retention pass leaves their cards alone
+# After every complete batch the position is written to the checkpoint file (BACKFILL_CHECKPOINT), a
+# backfill that stopped, e.g. after an HTTP error, resumes from there. A batch with failed cards is not
+# checkpointed, it is planned again when the backfill is resumed (its written cards are then unchanged).
+# A resumed backfill starts one batch before the checkpoint: submissions that left the selected statuses in
+# the meantime shift the later ones to lower offsets.
+
+class BackfillCheckpoint:
+
+    def __init__(self, path, statuses):
+        self.path = path
+        self.statuses = sorted(statuses)
+        self.offset = 0
+        self.total = None
+        self.stats = {"changed": 0, "unchanged": 0, "failed": 0}
+        self.seconds = 0.0
+        self.finished = False
+
+    def load(self):
+        """Continue from the checkpoint file, returns False if there is none"""
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, encoding='utf-8') as f:
+            data = json.load(f)
+        if sorted(data.get('statuses', [])) != self.statuses:
+            raise ValueError(f"Checkpoint {self.path} belongs to a backfill of statuses {data.get('statuses')}, "
+                             f"restart the backfill to start over with statuses {self.statuses}.")
+        self.offset = data.get('offset', 0)
+        self.total = data.get('total')
+        self.stats.update(data.get('stats', {}))
+        self.seconds = data.get('seconds', 0.0)
+        self.finished = data.get('finished', False)
+        return True
+
+    def save(self):
+        data = {"statuses": self.statuses, "offset": self.offset, "total": self.total, "stats": self.stats,
+                "seconds": round(self.seconds, 3), "finished": self.finished, "updatedAt": time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+        tmp_file = f"{self.path}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_file, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Backfill:
+
+    def __init__(self, wekan_api, ojs_api, statuses, batch_size=None, checkpoint_file=None, concurrency=None, checklists=True):
+        self.wekan_api = wekan_api
+        self.ojs_api = ojs_api
+        self.statuses = statuses
+        self.batch_size = max(1, int(batch_size or os.getenv('BACKFILL_BATCH_SIZE', '100')))
+        self.checkpoint = BackfillCheckpoint(checkpoint_file or os.getenv('BACKFILL_CHECKPOINT', '.backfill.checkpoint.json'), statuses)
+        self.concurrency = max(1, int(concurrency or os.getenv('SYNC_CONCURRENCY', '4')))
+        self.planner = SyncPlanner(wekan_api, ojs_api, checklists=checklists)
+        self.issue_operations = {}  # issue ID -> planned operation, the issue cards are written once per backfill
+
+    def run(self, restart=False, dry_run=False):
+        """Run or resume the backfill, returns the number of changed, unchanged and failed cards"""
+        if restart:
+            self.checkpoint.remove()
+        elif self.checkpoint.load():
+            if self.checkpoint.finished:
+                print(f"\033[92mBackfill of {self.checkpoint.total} submissions is already complete, restart it to run it again.\033[0m")
+                return dict(self.checkpoint.stats)
+            print(f"\033[92mResuming backfill at {self.checkpoint.offset} of {self.checkpoint.total} submissions.\033[0m")
+        metrics = self.wekan_api.metrics
+        metrics.begin_run()
+        stats = None
+        try:
+            with self.wekan_api.dry_run_mode(dry_run):
+                stats = self.backfill(dry_run)
+            return stats
+        finally:
+            metrics.end_run(stats)
+
+    def backfill(self, dry_run):
+        metrics = self.wekan_api.metrics
+        checkpoint = self.checkpoint
+        with metrics.span('read_board'):
+            self.planner.read_board()
+        with metrics.span('issues_and_sections'):
+            self.ojs_api.getIssuesAndSections()
+        journal_name = self.wekan_api.get_journal_name()
+        stats = {"changed": 0, "unchanged": 0, "failed": 0}
+        started = time.monotonic()
+        processed = 0
+        checkpointed = 0.0
+        offset = max(0, checkpoint.offset - self.batch_size) if checkpoint.offset else 0
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            # the journal card and the cards of the future issues, as in a regular sync
+            operations = [self.planner.plan_journal(journal_name)]
+            operations.extend(self.plan_issue(journal_name, issue) for issue in self.ojs_api.future_issues)
+            self.apply_levels(executor, operations, stats, dry_run)
+            if stats['failed']:
+                print(f"\033[91mBackfill stopped: the journal or issue cards could not be written.\033[0m")
+                return stats
+
+            try:
+                for offset, total, submissions in self.ojs_api.iterSubmissionPages(self.statuses, offset, self.batch_size):
+                    batch_stats = self.run_batch(executor, journal_name, submissions, dry_run)
+                    for key, value in batch_stats.items():
+                        stats[key] += value
+                    if batch_stats['failed']:
+                        print(f"\033[91mBackfill stopped at {offset} of {total} submissions: {batch_stats['failed']} cards of the batch failed, "
+                              f"run the backfill again to resume.\033[0m")
+                        break
+                    processed += len(submissions)
+                    elapsed = time.monotonic() - started
+                    if not dry_run:
+                        checkpoint.offset = max(checkpoint.offset, offset + len(submissions))
+                        checkpoint.total = total
+                        for key, value in batch_stats.items():
+                            checkpoint.stats[key] += value
+                        checkpoint.seconds += elapsed - checkpointed
+                        checkpointed = elapsed
+                        checkpoint.save()
+                    self.report_progress(offset + len(submissions), total, processed, elapsed, stats)
+                else:
+                    if not dry_run:
+                        checkpoint.finished = True
+                        checkpoint.save()
+            except Exception:
+                if not dry_run:
+                    print(f"\033[91mBackfill interrupted, {checkpoint.offset} of {checkpoint.total} submissions are checkpointed in "
+                          f"{checkpoint.path}, run the backfill again to resume.\033[0m")
+                raise
+
+        if not dry_run:
+            self.wekan_api.report_write_stats()
+        if checkpoint.finished:
+            print(f"\033[92mBackfill complete: {checkpoint.stats['changed']} cards written, {checkpoint.stats['unchanged']} unchanged "
+                  f"in {format_duration(checkpoint.seconds)}.\033[0m")
+        return stats
+
+    def run_batch(self, executor, journal_name, submissions, dry_run):
+        """Plan and write the cards of one batch of submissions, parents first"""
+        ojs_api = self.ojs_api
+        with self.wekan_api.metrics.span('plan'):
+            # issue cards that are not on the board yet are created before the submissions linked to them
+            operations = []
+            for submission in submissions:
+                issue = ojs_api.getIssueSummary(ojs_api.getCurrentPublication(submission).issue_id)
+                if issue and issue.id not in self.issue_operations:
+                    operations.append(self.plan_issue(journal_name, issue))
+            new_cards = {(operation.kind, str(operation.source_id)) for operation in self.issue_operations.values() if operation.action == 'create'}
+            operations.extend(self.planner.plan_submission(journal_name, submission, new_cards) for submission in submissions)
+        stats = self.apply_levels(executor, operations, {"changed": 0, "unchanged": 0, "failed": 0}, dry_run)
+        if not dry_run:
+            self.exempt_from_retention(submissions)
+        # the publications of a batch are not needed again, the backfill keeps only the batch in flight in memory
+        for submission in submissions:
+            ojs_api.publications.pop(ojs_api.publication_key(submission), None)
+        return stats
+
+    def exempt_from_retention(self, submissions):
+        """Keep the backfilled cards of finished submissions on the board, the retention pass skips them"""
+        sync_state = self.wekan_api.get_sync_state()
+        if not sync_state:
+            return
+        entries = sync_state.get_retention('submission')
+        now = time.time()
+        with sync_state.batch():
+            for submission in submissions:
+                if submission.status != self.ojs_api.STATUS_QUEUED and str(submission.id) not in entries:
+                    sync_state.set_retention({"kind": "submission", "source_id": submission.id, "status": "backfilled", "inactive_since": now,
+                                              "checked_at": now, "list_title": None, "archived_at": None})
+
+    def plan_issue(self, journal_name, issue):
+        operation = self.planner.plan_issue(journal_name, issue, set())
+        self.issue_operations[issue.id] = operation
+        return operation
+
+    def apply_levels(self, executor, operations, stats, dry_run):
+        """Apply the operations level by level, the cards of a level concurrently, with one state transaction"""
+        stats["unchanged"] += sum(1 for operation in operations if operation.action == 'unchanged')
+        changed = [operation for operation in operations if operation.action != 'unchanged']
+        if dry_run:
+            for operation in changed:
+                print(operation.describe())
+            stats["changed"] += len(changed)
+            return stats
+        sync_state = self.wekan_api.get_sync_state()
+        levels = {}
+        for operation in changed:
+            levels.setdefault(operation.level, []).append(operation)
+        with sync_state.batch() if sync_state else nullcontext():
+            for level in sorted(levels):
+                with self.wekan_api.metrics.span(f"apply_{levels[level][0].kind}"):
+                    for result in executor.map(self.apply, levels[level]):
+                        stats[result] += 1
+        return stats
+
+    def apply(self, operation):
+        try:
+            self.planner.apply(operation)
+        except Exception as e:
+            traceback.print_exc()
+            print(f"\033[91mSynchronization of {operation.kind} ID {operation.source_id} failed ({e}).\033[0m")
+            return "failed"
+        return "changed"
+
+    def report_progress(self, position, total, processed, elapsed, stats):
+        rate = processed / elapsed if elapsed > 0 else 0.0
+        total = total if isinstance(total, int) else position
+        eta = format_duration((total - position) / rate) if rate > 0 else 'unknown'
+        share = f" ({position / total:.1%})" if total else ''
+        print(f"\033[92mBackfill: {position} of {total} submissions{share}, {rate:.1f} submissions/s, ETA {eta} "
+              f"({stats['changed']} cards written, {stats['unchanged']} unchanged).\033[0m")
+
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
@@ -0,0 +1,181 @@
+import json
+import os
+import time
+import traceback
+from middleware.SyncPlanner import SyncPlanner
+
+# Wekan side change detection (board drift).
+# Cards moved or edited by hand on the board are otherwise only noticed by the next full synchronization, and the
+# custom field Title not even then: the card listing doesn't return custom fields, so their last written value
+# is assumed (see WekanAPI.apply_written_fields). The delta reader polls the activities of the board from a
+# high-water mark kept in the sync state. Wekan's REST API has no activity listing, the board export
+# (api/boards/<id>/export) is the only read that returns the activities, so it is fetched once per check.
+#   - activities after the mark that were made by other users than the middleware name the changed cards,
+#     activities of the middleware's own user are echoes of its writes and are ignored
+#   - the full cards of the changed and mapped cards are taken from the export into the board snapshot, so
+#     their list, title, description, Title field and parent are compared instead of assumed
+#   - the synchronization re-checks these cards even if their OJS source is unchanged and repairs them
+# Cost: the export holds all cards and activities of the board, so a check is a single request whose size grows
+# with the board. The board is therefore checked at most every DRIFT_INTERVAL seconds: by the first
+# synchronization after the interval, and in the sync daemon by the first refresh cycle after it, paid from the
+# request budget of the cycle. A change made by hand is repaired at the latest DRIFT_INTERVAL seconds (plus one
+# cycle) after it was made, or by the next full synchronization if it is visible in the card listing.
+# The mark is only advanced when the checked cards were written without failures. The first check only sets
+# the mark. repair() re-checks and repairs only the changed cards, without planning the other cards.
+# DRIFT_POLICY decides per field who wins for a card changed on the board:
+#   list    the list the card is in
+#   title   the custom field Title
+# "ojs" (default) writes the OJS value back, "board" keeps the board value until OJS changes the field itself,
+# e.g. DRIFT_POLICY='{"list": "board", "title": "ojs"}'
+
+POLICY_FIELDS = ('list', 'title')
+POLICY_WINNERS = ('ojs', 'board')
+
+
+def load_drift_policy(value=None):
+    """Winner per card field from DRIFT_POLICY, OJS wins for fields that are not set"""
+    policy = json.loads(value if value is not None else os.getenv('DRIFT_POLICY', '{}') or '{}')
+    for field, winner in policy.items():
+        if field not in POLICY_FIELDS:
+            raise ValueError(f"Unknown field '{field}' in DRIFT_POLICY, use {' or '.join(POLICY_FIELDS)}")
+        if winner not in POLICY_WINNERS:
+            raise ValueError(f"Unknown winner '{winner}' for field '{field}' in DRIFT_POLICY, use {' or '.join(POLICY_WINNERS)}")
+    return dict({field: 'ojs' for field in POLICY_FIELDS}, **policy)
+
+
+class BoardDelta:
+
+    def __init__(self, wekan_api, interval=None):
+        self.wekan_api = wekan_api
+        self.interval = float(interval if interval is not None else os.getenv('DRIFT_INTERVAL', '900'))
+        self.pending_mark = None
+
+    def due(self):
+        """The board is checked at most every DRIFT_INTERVAL seconds, the time of the last check is kept in the sync state"""
+        wekan_api = self.wekan_api
+        sync_state = wekan_api.get_sync_state()
+        board = wekan_api.get_snapshot(wekan_api.board_name).board
+        if not sync_state or not board:
+            return True
+        checked_at = sync_state.get_delta_checked_at(board['_id'])
+        return checked_at is None or time.time() - checked_at >= self.interval
+
+    def read(self):
+        """Mapped cards changed on the board by other users since the high-water mark, card ID -> (mapping, card)"""
+        wekan_api = self.wekan_api
+        sync_state = wekan_api.get_sync_state()
+        snapshot = wekan_api.get_snapshot(wekan_api.board_name)
+        if not sync_state or not snapshot.board:
+            return {}
+        board_id = snapshot.board['_id']
+        mark = sync_state.get_high_water_mark(board_id)
+        export = wekan_api.call_api('get', f"{wekan_api.base_url}/api/boards/{board_id}/export", params={"authToken": wekan_api.token})
+        activities = export.get('activities') or []
+        # an empty mark still records the time of the check on a board without activities
+        self.pending_mark = max([mark or ''] + [activity.get('createdAt') or '' for activity in activities])
+        if mark is None:
+            # the first check only sets the mark, the full synchronization compares the cards anyway
+            return {}
+        card_ids = {activity['cardId'] for activity in activities
+                    if activity.get('cardId') and (activity.get('createdAt') or '') > mark and activity.get('userId') != wekan_api.user_id}
+        drifted = {}
+        for card in export.get('cards') or []:
+            if card.get('_id') not in card_ids or card.get('archived'):
+                continue
+            # cards of other swimlanes or created by hand are not synchronized
+            mapping = sync_state.find_mapping_by_card(card['_id'])
+            if mapping and mapping['board_id'] == board_id:
+                drifted[card['_id']] = (mapping, card)
+        return drifted
+
+    def poll(self):
+        """Read the changed cards into the board snapshot and mark them for the next plan"""
+        wekan_api = self.wekan_api
+        drifted = self.read()
+        snapshot = wekan_api.get_snapshot(wekan_api.board_name)
+        for card_id, (mapping, card) in drifted.items():
+            # Wekan stores a missing parent as an empty string
+            snapshot.apply_card(card_id, dict(card, parentId=card.get('parentId') or None))
+        with wekan_api.lock:
+            wekan_api.drifted_cards = set(drifted)
+            wekan_api.pending_overrides = {}
+        print(f"\033[92mBoard delta: {len(drifted)} cards changed on the board since the last check.\033[0m")
+        return drifted
+
+    def commit(self):
+        """Advance the high-water mark and keep the board values decided by the drift policy"""
+        wekan_api = self.wekan_api
+        sync_state = wekan_api.get_sync_state()
+        with wekan_api.lock:
+            overrides, wekan_api.pending_overrides = wekan_api.pending_overrides, {}
+            wekan_api.drifted_cards = set()
+        if not sync_state:
+            return
+        with sync_state.batch():
+            for (card_id, field), ojs_value in overrides.items():
+                if ojs_value is None:
+                    sync_state.remove_override(card_id, field)
+                else:
+                    sync_state.set_override(card_id, field, ojs_value)
+            if self.pending_mark is not None:
+                sync_state.set_high_water_mark(wekan_api.get_snapshot(wekan_api.board_name).board['_id'], self.pending_mark)
+        self.pending_mark = None
+
+    def run(self, ojs_api, dry_run=False, coordinator=None):
+        """Re-check and repair the cards changed on the board as a single run, returns the counters of the run"""
+        metrics = self.wekan_api.metrics
+        metrics.begin_run()
+        stats = None
+        try:
+            planner = SyncPlanner(self.wekan_api, ojs_api, coordinator=coordinator)
+            with metrics.span('read_board'):
+                planner.read_board()
+            with self.wekan_api.dry_run_mode(dry_run):
+                stats = self.repair(ojs_api, planner, dry_run)
+            return stats
+        finally:
+            metrics.end_run(stats)
+
+    def repair(self, ojs_api, planner, dry_run=False):
+        """Re-check and repair only the cards changed on the board, the board snapshot must be loaded"""
+        wekan_api = self.wekan_api
+        stats = {"changed": 0, "unchanged": 0, "failed": 0}
+        with wekan_api.metrics.span('board_delta'):
+            drifted = self.poll()
+        if drifted and not ojs_api.sections:
+            ojs_api.getIssuesAndSections()
+        journal_name = wekan_api.get_journal_name()
+        for card_id, (mapping, card) in sorted(drifted.items(), key=lambda item: ('journal', 'issue', 'submission').index(item[1][0]['kind'])):
+            kind, source_id = mapping['kind'], mapping['source_id']
+            if not planner.owns(kind, source_id):
+                continue
+            try:
+                operation = self.plan(planner, ojs_api, journal_name, kind, source_id)
+                if operation is None or operation.action == 'unchanged':
+                    stats["unchanged"] += 1
+                    continue
+                if dry_run:
+                    print(operation.describe())
+                else:
+                    planner.apply(operation)
+                stats["changed"] += 1
+            except Exception as e:
+                traceback.print_exc()
+                print(f"\033[91mRepair of the card of {kind} ID {source_id} failed ({e}), checking it again with the next check.\033[0m")
+                stats["failed"] += 1
+        if not dry_run and not stats["failed"]:
+            self.commit()
+        print(f"\033[92mBoard delta: {stats['changed']} cards repaired, {stats['unchanged']} unchanged, {stats['failed']} failed.\033[0m")
+        return stats
+
+    @staticmethod
+    def plan(planner, ojs_api, journal_name, kind, source_id):
+        """Operation reconciling the card of an OJS object, None if the object is not synchronized any more"""
+        if kind == 'journal':
+            return planner.plan_journal(journal_name) if source_id == journal_name else None
+        if kind == 'issue':
+            issue = ojs_api.getIssue(int(source_id))
+            return None if issue.is_published else planner.plan_issue(journal_name, issue, set())
+        submission = ojs_api.getSubmission(int(source_id))
+        # the cards of submissions that left the queue are left to the retention pass
+        return planner.plan_submission(journal_name, submission, set()) if submission.status == ojs_api.STATUS_QUEUED else None
@@ -0,0 +1,101 @@
+import json
+import threading
+
+# In-memory copy of a Wekan board (board, swimlanes, lists and cards).
+# The board structure is listed once per synchronization run, the cards of a swimlane are listed on first access.
+# All card writes done by the middleware are applied to the snapshot, so no further listing requests are needed.
+
+class BoardSnapshot:
+
+    # card fields used by the synchronization, the rest of a listed or fetched card is dropped
+    CARD_FIELDS = ('_id', 'title', 'description', 'listId', 'swimlaneId', 'parentId', 'archived', 'customFields', 'color')
+
+    def __init__(self, wekan_api, board_title):
+        self.wekan_api = wekan_api
+        self.board_title = board_title
+        self.board = None
+        self.swimlanes_by_id = {}
+        self.swimlanes_by_title = {}
+        self.lists_by_id = {}
+        self.lists_by_title = {}
+        self.cards_by_id = {}
+        self.cards_by_title = {}  # (swimlaneId, title) -> card
+        self.loaded_swimlanes = set()
+        # workers of the sync engine share the snapshot, a swimlane is still listed only once
+        self.lock = threading.RLock()
+
+    def load(self):
+        """Load board, swimlanes and lists of the board"""
+        base_url = self.wekan_api.base_url
+        boards = self.wekan_api.call_api('get', f"{base_url}/api/users/{self.wekan_api.user_id}/boards")
+        self.board = next((b for b in boards if b['title'] == self.board_title), None)
+        if not self.board:
+            return self
+
+        swimlanes = self.wekan_api.call_api('get', f"{base_url}/api/boards/{self.board['_id']}/swimlanes")
+        for swimlane in swimlanes:
+            self.swimlanes_by_id[swimlane['_id']] = swimlane
+            self.swimlanes_by_title.setdefault(swimlane['title'], swimlane)
+
+        lists = self.wekan_api.call_api('get', f"{base_url}/api/boards/{self.board['_id']}/lists")
+        for lst in lists:
+            self.lists_by_id[lst['_id']] = lst
+            self.lists_by_title.setdefault(lst['title'], lst)
+        return self
+
+    def find_swimlane(self, swimlane_title):
+        return self.swimlanes_by_title.get(swimlane_title)
+
+    def find_list(self, list_title):
+        return self.lists_by_title.get(list_title)
+
+    def cards(self, swimlane_id):
+        """Return all cards of a swimlane, the swimlane is listed only once"""
+        with self.lock:
+            if swimlane_id not in self.loaded_swimlanes:
+                cards = self.wekan_api.call_api('get', f"{self.wekan_api.base_url}/api/boards/{self.board['_id']}/swimlanes/{swimlane_id}/cards")
+                self.loaded_swimlanes.add(swimlane_id)
+                for card in cards:
+                    # cards listed per swimlane don't carry their swimlaneId
+                    self.apply_card(card['_id'], dict(card, swimlaneId=swimlane_id))
+            return [card for card in self.cards_by_id.values() if card.get('swimlaneId') == swimlane_id]
+
+    def find_card(self, swimlane_id, card_title):
+        if swimlane_id not in self.loaded_swimlanes:
+            self.cards(swimlane_id)
+        return self.cards_by_title.get((swimlane_id, card_title))
+
+    def get_card(self, card_id, swimlane_id=None):
+        """Find a card by ID, the cards of the given swimlane are listed first if necessary"""
+        if swimlane_id and swimlane_id not in self.loaded_swimlanes and swimlane_id in self.swimlanes_by_id:
+            self.cards(swimlane_id)
+        return self.cards_by_id.get(card_id)
+
+    def apply_card(self, card_id, fields):
+        """Insert a card or merge changed fields into a known card and keep the title index up to date"""
+        fields = {key: value for key, value in fields.items() if key in self.CARD_FIELDS}
+        with self.lock:
+            card = self.cards_by_id.get(card_id)
+            if card:
+                old_key = (card.get('swimlaneId'), card.get('title'))
+                if self.cards_by_title.get(old_key) is card:
+                    del self.cards_by_title[old_key]
+                card.update(fields)
+            else:
+                card = dict(fields, _id=card_id)
+                self.cards_by_id[card_id] = card
+            # the first card with a given title wins, as in the title lookup of the Wekan listing
+            self.cards_by_title.setdefault((card.get('swimlaneId'), card.get('title')), card)
+        if self.wekan_api.DEBUG:
+            print("Snapshot card:", json.dumps(card, indent=2))
+        return card
+
+    def remove_card(self, card_id):
+        """Drop an archived card, the card listing of Wekan doesn't return archived cards either"""
+        with self.lock:
+            card = self.cards_by_id.pop(card_id, None)
+            if card:
+                key = (card.get('swimlaneId'), card.get('title'))
+                if self.cards_by_title.get(key) is card:
+                    del self.cards_by_title[key]
+        return card
@@ -0,0 +1,250 @@
+import math
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+
+# Coordination of several sync workers on the same swimlane, e.g. daemons on several nodes (COORDINATION_ENABLED).
+# The journal, issues and submissions are split into COORDINATION_SHARDS shards by their ID. A worker only
+# plans and writes the cards of the shards it holds a lease on, so every card is written by exactly one
+# worker and no two workers create the same card or link it twice.
+#   leases          a lease is held for COORDINATION_LEASE_TTL seconds and renewed by a heartbeat thread;
+#                   if a worker dies its leases expire and the remaining workers take its shards over
+#                   before their next run
+#   fencing tokens  every acquisition of a shard increases its token. Wekan can't check tokens itself, so
+#                   the worker checks its token against the lease store before every card write: a worker
+#                   that was paused past its lease and lost the shard stops before writing again
+#   balancing       workers announce themselves with the heartbeat; before every run a worker holds at most
+#                   ceil(shards / live workers) shards, releases the rest and takes over free shards. Shards
+#                   only change hands between runs, never while a worker writes their cards
+# The lease store is pluggable (LeaseStore). COORDINATION_STORE names a SQLite file ("sqlite:///path" or a
+# plain path) that all workers can reach, e.g. on the same host or a shared volume.
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class LeaseStore:
+    """Interface of a lease store, a lease is (name, owner, fencing token, expiry)"""
+
+    def acquire(self, name, owner, ttl):
+        """Take the lease if it is free, expired or already held by owner, returns its fencing token or None"""
+        raise NotImplementedError
+
+    def renew(self, name, owner, token, ttl):
+        """Extend a held lease, returns False if it was lost"""
+        raise NotImplementedError
+
+    def release(self, name, owner, token):
+        raise NotImplementedError
+
+    def validate(self, name, owner, token):
+        """True if owner still holds the lease with this fencing token"""
+        raise NotImplementedError
+
+    def heartbeat(self, group, owner, ttl):
+        """Announce a live worker of a group, returns the number of live workers of the group"""
+        raise NotImplementedError
+
+    def leave(self, group, owner):
+        raise NotImplementedError
+
+
+class SQLiteLeaseStore(LeaseStore):
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        # autocommit mode, the acquisitions use explicit write transactions
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        with self.lock:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT,
+                    token INTEGER NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS workers (
+                    grp TEXT NOT NULL,
+                    owner TEXT NOT NULL,
+                    seen_at REAL NOT NULL,
+                    PRIMARY KEY (grp, owner)
+                )
+            """)
+
+    def acquire(self, name, owner, ttl):
+        now = time.time()
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.connection.execute("SELECT owner, token, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+                if row and row[0] == owner and row[2] > now:
+                    token = row[1]
+                elif row and row[0] and row[2] > now:
+                    self.connection.execute("ROLLBACK")
+                    return None
+                else:
+                    # a new holder gets a new fencing token
+                    token = (row[1] if row else 0) + 1
+                self.connection.execute("INSERT OR REPLACE INTO leases (name, owner, token, expires_at) VALUES (?, ?, ?, ?)",
+                                        (name, owner, token, now + ttl))
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+        return token
+
+    def renew(self, name, owner, token, ttl):
+        now = time.time()
+        with self.lock:
+            cursor = self.connection.execute("UPDATE leases SET expires_at = ? WHERE name = ? AND owner = ? AND token = ? AND expires_at > ?",
+                                             (now + ttl, name, owner, token, now))
+        return cursor.rowcount == 1
+
+    def release(self, name, owner, token):
+        with self.lock:
+            self.connection.execute("UPDATE leases SET owner = NULL, expires_at = 0 WHERE name = ? AND owner = ? AND token = ?", (name, owner, token))
+
+    def validate(self, name, owner, token):
+        with self.lock:
+            row = self.connection.execute("SELECT owner, token, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+        return bool(row) and row[0] == owner and row[1] == token and row[2] > time.time()
+
+    def heartbeat(self, group, owner, ttl):
+        now = time.time()
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO workers (grp, owner, seen_at) VALUES (?, ?, ?)", (group, owner, now))
+            self.connection.execute("DELETE FROM workers WHERE grp = ? AND seen_at < ?", (group, now - ttl))
+            return self.connection.execute("SELECT COUNT(*) FROM workers WHERE grp = ?", (group,)).fetchone()[0]
+
+    def leave(self, group, owner):
+        with self.lock:
+            self.connection.execute("DELETE FROM workers WHERE grp = ? AND owner = ?", (group, owner))
+
+
+def open_lease_store(location=None):
+    location = location or os.getenv('COORDINATION_STORE', '.coordination.sqlite')
+    if location.startswith('sqlite:///'):
+        return SQLiteLeaseStore(location[len('sqlite:///'):])
+    if '://' in location:
+        raise ValueError(f"Unknown lease store '{location}', use a SQLite file (sqlite:///path)")
+    return SQLiteLeaseStore(location)
+
+
+class Coordinator:
+
+    def __init__(self, group, store=None, shards=None, ttl=None, owner=None):
+        # the group names the board the workers share, its shards are leased as "<group>/shard-<n>"
+        self.group = group
+        self.store = store or open_lease_store()
+        self.shards = max(1, int(shards or os.getenv('COORDINATION_SHARDS', '8')))
+        self.ttl = float(ttl or os.getenv('COORDINATION_LEASE_TTL', '60'))
+        self.owner = owner or os.getenv('COORDINATION_WORKER_ID') or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.held = {}  # shard -> fencing token
+        self.lock = threading.Lock()
+        # the heartbeat thread and the worker loop don't renew or rebalance at the same time
+        self.lease_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def lease_name(self, shard):
+        return f"{self.group}/shard-{shard}"
+
+    def shard_of(self, kind, source_id):
+        """Shard of an OJS object, numeric IDs are distributed round robin"""
+        source_id = str(source_id)
+        if source_id.isdigit():
+            return int(source_id) % self.shards
+        return zlib.crc32(f"{kind}:{source_id}".encode('utf-8')) % self.shards
+
+    def owns(self, kind, source_id):
+        with self.lock:
+            return self.shard_of(kind, source_id) in self.held
+
+    def check(self, kind, source_id):
+        """Fencing check before a card write, raises LeaseLost if the shard was lost or taken over"""
+        shard = self.shard_of(kind, source_id)
+        with self.lock:
+            token = self.held.get(shard)
+        if token is None or not self.store.validate(self.lease_name(shard), self.owner, token):
+            with self.lock:
+                if self.held.get(shard) == token:
+                    self.held.pop(shard, None)
+            raise LeaseLost(f"Lease of shard {shard} lost, the {kind} {source_id} is left to its new holder.")
+
+    def renew(self):
+        """Announce the worker and renew the held leases, returns the number of live workers"""
+        workers = max(1, self.store.heartbeat(self.group, self.owner, self.ttl))
+        with self.lock:
+            held = dict(self.held)
+        for shard, token in held.items():
+            if not self.store.renew(self.lease_name(shard), self.owner, token, self.ttl):
+                print(f"\033[91mLease of shard {shard} lost.\033[0m")
+                with self.lock:
+                    if self.held.get(shard) == token:
+                        del self.held[shard]
+        return workers
+
+    def rebalance(self):
+        """Renew the held leases, release the shards above the fair share and take over free shards"""
+        with self.lease_lock:
+            workers = self.renew()
+            fair_share = math.ceil(self.shards / workers)
+            with self.lock:
+                held = dict(self.held)
+            for shard in sorted(held, reverse=True)[:max(0, len(held) - fair_share)]:
+                self.store.release(self.lease_name(shard), self.owner, held.pop(shard))
+                print(f"Released shard {shard} to balance {self.shards} shards over {workers} workers.")
+            # start at a different shard per worker, so joining workers don't compete for the same shards
+            start = zlib.crc32(self.owner.encode('utf-8')) % self.shards
+            for offset in range(self.shards):
+                if len(held) >= fair_share:
+                    break
+                shard = (start + offset) % self.shards
+                if shard in held:
+                    continue
+                token = self.store.acquire(self.lease_name(shard), self.owner, self.ttl)
+                if token is not None:
+                    held[shard] = token
+                    print(f"\033[92mAcquired shard {shard} with fencing token {token}.\033[0m")
+            with self.lock:
+                self.held = held
+            return sorted(held)
+
+    def start(self):
+        """Take the first shards and keep the leases alive from a heartbeat thread"""
+        self.rebalance()
+        self.thread = threading.Thread(target=self.keep_alive, daemon=True)
+        self.thread.start()
+        return self
+
+    def keep_alive(self):
+        while not self.stop_event.wait(self.ttl / 3):
+            try:
+                with self.lease_lock:
+                    self.renew()
+            except Exception as e:
+                # the leases run out if the store can't be reached, the fencing checks then stop the writes
+                print(f"\033[91mLease renewal failed ({e}).\033[0m")
+
+    def stop(self):
+        """Release all leases, so the other workers take the shards over right away"""
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        with self.lock:
+            held, self.held = self.held, {}
+        for shard, token in held.items():
+            self.store.release(self.lease_name(shard), self.owner, token)
+        self.store.leave(self.group, self.owner)
+
+    def describe(self):
+        with self.lock:
+            return f"shards {', '.join(str(shard) for shard in sorted(self.held)) or 'none'} of {self.shards}"
@@ -0,0 +1,55 @@
+import json
+import threading
+
+# Registry of the custom field definitions of a Wekan board.
+# Field names are resolved to field IDs with a single listing request, missing fields can be created on demand.
+
+class CustomFieldRegistry:
+
+    def __init__(self, wekan_api, board_id):
+        self.wekan_api = wekan_api
+        self.board_id = board_id
+        self.fields_by_name = None
+        # concurrent workers must not create the same field twice
+        self.lock = threading.RLock()
+
+    def load(self):
+        """List all custom fields of the board and index them by name"""
+        fields = self.wekan_api.call_api('get', f"{self.wekan_api.base_url}/api/boards/{self.board_id}/custom-fields")
+        self.fields_by_name = {}
+        for field in fields:
+            self.fields_by_name.setdefault(field.get('name'), field)
+        return self
+
+    def invalidate(self):
+        """Drop the cached definitions, they are listed again on the next lookup"""
+        self.fields_by_name = None
+
+    def find(self, name):
+        with self.lock:
+            if self.fields_by_name is None:
+                self.load()
+            return self.fields_by_name.get(name)
+
+    def resolve(self, name, definition=None):
+        """Return the ID of the custom field with the given name, create the field from definition if it doesn't exist"""
+        with self.lock:
+            field = self.find(name)
+            if not field and definition is not None:
+                print(f"\033[91mCustom field '{name}' not found. Creating it...\033[0m")
+                created = self.wekan_api.call_api(
+                    'post',
+                    f"{self.wekan_api.base_url}/api/boards/{self.board_id}/custom-fields",
+                    json_data=dict(definition, name=name)
+                )
+                if self.wekan_api.DEBUG:
+                    print(f"Created custom field '{name}':", json.dumps(created, indent=2))
+                # the board definitions changed, list them again to pick up the new field
+                self.invalidate()
+                field = self.find(name)
+                if not field:
+                    # Handle both dict and string responses from API
+                    field_id = created.get('_id') if isinstance(created, dict) else created
+                    field = dict(definition, name=name, _id=field_id)
+                    self.fields_by_name[name] = field
+            return field.get('_id') if field else None
@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse, parse_qsl, urlencode
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# Record/replay of the HTTP traffic of the transport, used to profile runs on exact production traffic.
+#   record   every request and its final response is appended to a JSONL cassette
+#   replay   requests are answered from the cassette, nothing is sent over the network
+# Requests are matched by method, URL (with sorted query parameters) and body. Identical requests are
+# answered in the order they were recorded, so the concurrent sync engine can be replayed as well.
+# Credentials are not written: the OJS apiToken, the Wekan password and login tokens are masked, request
+# headers (Authorization) are not recorded at all. A request that is not on the cassette fails with
+# CassetteMiss, a ConnectionError, and is handled like a network error by the middleware.
+
+SECRET_PARAMETERS = ('apiToken', 'authToken')
+SECRET_FIELDS = ('password', 'token')
+MASK = '***'
+
+
+class CassetteMiss(requests.ConnectionError):
+    pass
+
+
+class HttpCassette:
+
+    def __init__(self, path, mode, replay_delay=0.0):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Unknown cassette mode '{mode}', use 'record' or 'replay'")
+        self.path = path
+        self.mode = mode
+        # 0 answers immediately, 1 waits as long as the recorded request took
+        self.replay_delay = float(replay_delay)
+        self.lock = threading.Lock()
+        self.entries = {}  # (method, url, body) -> deque of recorded responses
+        self.recorded = 0
+        self.replayed = 0
+        self.misses = 0
+        if mode == 'replay':
+            self.load()
+        else:
+            # a new recording replaces an older cassette
+            open(self.path, 'w', encoding='utf-8').close()
+
+    @property
+    def replaying(self):
+        return self.mode == 'replay'
+
+    def load(self):
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.entries.setdefault((entry['method'], entry['url'], entry['body']), deque()).append(entry)
+        print(f"\033[92mReplaying {sum(len(entries) for entries in self.entries.values())} requests from {self.path}.\033[0m")
+
+    def record(self, method, url, kwargs, response, elapsed):
+        method, url, body = self.request_key(method, url, kwargs)
+        entry = {
+            "method": method, "url": url, "body": body,
+            "status": response.status_code,
+            "headers": {key: response.headers[key] for key in ('Content-Type', 'Retry-After') if key in response.headers},
+            "response": self.mask_response(url, response.text),
+            "elapsed": round(elapsed, 4)
+        }
+        line = json.dumps(entry, ensure_ascii=False)
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + "\n")
+            self.recorded += 1
+
+    def replay(self, method, url, kwargs):
+        key = self.request_key(method, url, kwargs)
+        with self.lock:
+            entries = self.entries.get(key)
+            if not entries:
+                self.misses += 1
+                raise CassetteMiss(f"Request not on cassette {self.path}: {key[0]} {key[1]}")
+            # the last response of a request is kept, e.g. for a listing repeated more often than recorded
+            entry = entries.popleft() if len(entries) > 1 else entries[0]
+            self.replayed += 1
+        if self.replay_delay:
+            time.sleep(entry['elapsed'] * self.replay_delay)
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response._content = entry['response'].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = url
+        response.request = requests.Request(method.upper(), url).prepare()
+        return response
+
+    def request_key(self, method, url, kwargs):
+        """(method, URL with sorted and masked query parameters, canonical masked body)"""
+        prepared = requests.Request(method.upper(), url, params=kwargs.get('params')).prepare()
+        parsed = urlparse(prepared.url)
+        query = sorted((key, MASK if key in SECRET_PARAMETERS else value) for key, value in parse_qsl(parsed.query, keep_blank_values=True))
+        body = kwargs.get('json') or kwargs.get('data') or None
+        if isinstance(body, dict):
+            body = json.dumps({key: MASK if key in SECRET_FIELDS else value for key, value in body.items()}, sort_keys=True, ensure_ascii=False)
+        elif isinstance(body, bytes):
+            body = body.decode('utf-8', errors='replace')
+        return prepared.method, parsed._replace(query=urlencode(query), fragment='').geturl(), body
+
+    @staticmethod
+    def mask_response(url, text):
+        # the login response carries the Wekan token, it is not needed for the replay
+        if not urlparse(url).path.endswith('/users/login'):
+            return text
+        try:
+            data = json.loads(text)
+        except ValueError:
+            return text
+        if isinstance(data, dict):
+            data = {key: MASK if key in SECRET_FIELDS else value for key, value in data.items()}
+        return json.dumps(data)
+
+    def report(self):
+        if self.replaying:
+            print(f"\033[92mReplayed {self.replayed} requests from {self.path}, {self.misses} requests not on the cassette.\033[0m")
+        else:
+            print(f"\033[92mRecorded {self.recorded} requests to {self.path}.\033[0m")
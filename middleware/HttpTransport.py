@@ -0,0 +1,146 @@
+import json
+import os
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from middleware.HttpCassette import HttpCassette
+from middleware.RateLimiter import RateLimiter, parse_retry_after
+
+# Shared HTTP transport for OJSAPI and WekanAPI.
+# Keeps one persistent session (keep-alive connection pool) per host, negotiates gzip, applies timeouts
+# and retries idempotent requests with exponential backoff.
+# Every host gets its own rate limiter (see RateLimiter): requests wait for a free slot of the adaptive
+# concurrency limit, 429 responses are retried after the time given by Retry-After.
+# With HTTP_CASSETTE set, all requests are recorded to or replayed from a cassette (see HttpCassette).
+
+class HttpTransport:
+
+    # only these methods are retried automatically, a repeated POST could create duplicate cards
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+    RETRY_STATUS_CODES = (502, 503, 504)
+
+    def __init__(self):
+        self.timeout = (float(os.getenv('HTTP_CONNECT_TIMEOUT', '10')), float(os.getenv('HTTP_READ_TIMEOUT', '60')))
+        self.pool_size = int(os.getenv('HTTP_POOL_SIZE', '10'))
+        # per host pool sizes as json object, e.g. '{"wekan.example.org": 20}'
+        self.pool_sizes = json.loads(os.getenv('HTTP_POOL_SIZES', '{}') or '{}')
+        self.retries = int(os.getenv('HTTP_RETRIES', '3'))
+        self.backoff_factor = float(os.getenv('HTTP_BACKOFF_FACTOR', '0.5'))
+        # requests per second per host (0 = no limit), per host values as json object like the pool sizes
+        self.rate_limit = float(os.getenv('HTTP_RATE_LIMIT', '0'))
+        self.rate_limits = json.loads(os.getenv('HTTP_RATE_LIMITS', '{}') or '{}')
+        self.max_retry_after = float(os.getenv('HTTP_MAX_RETRY_AFTER', '120'))
+        cassette_file = os.getenv('HTTP_CASSETTE', '')
+        self.cassette = HttpCassette(cassette_file, os.getenv('HTTP_CASSETTE_MODE', 'record'),
+                                     replay_delay=os.getenv('HTTP_REPLAY_DELAY', '0')) if cassette_file else None
+        self.sessions = {}
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+    def session(self, url):
+        """Return the persistent session for the host of the given URL"""
+        parsed = urlparse(url)
+        host_key = f"{parsed.scheme}://{parsed.netloc}"
+        with self.lock:
+            session = self.sessions.get(host_key)
+            if session is None:
+                session = self.create_session(parsed.hostname)
+                self.sessions[host_key] = session
+        return session
+
+    def limiter(self, url):
+        """Return the rate limiter for the host of the given URL"""
+        parsed = urlparse(url)
+        host_key = f"{parsed.scheme}://{parsed.netloc}"
+        with self.lock:
+            limiter = self.limiters.get(host_key)
+            if limiter is None:
+                # the concurrency limit never exceeds the connection pool of the host
+                limiter = RateLimiter(
+                    parsed.netloc,
+                    max_concurrency=int(self.pool_sizes.get(parsed.hostname, self.pool_size)),
+                    rate=float(self.rate_limits.get(parsed.hostname, self.rate_limit))
+                )
+                self.limiters[host_key] = limiter
+        return limiter
+
+    def create_session(self, hostname):
+        pool_size = int(self.pool_sizes.get(hostname, self.pool_size))
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=self.RETRY_STATUS_CODES,
+            allowed_methods=self.IDEMPOTENT_METHODS,
+            respect_retry_after_header=False,  # 429 and Retry-After are handled by the rate limiter in request()
+            raise_on_status=False  # the final response is handed to the caller which checks the status itself
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers['Accept-Encoding'] = 'gzip, deflate'
+        return session
+
+    def request(self, method, url, **kwargs):
+        if self.cassette and self.cassette.replaying:
+            return self.cassette.replay(method, url, kwargs)
+        kwargs.setdefault('timeout', self.timeout)
+        session = self.session(url)
+        limiter = self.limiter(url)
+        attempt = 0
+        while True:
+            limiter.acquire()
+            started = time.monotonic()
+            try:
+                response = session.request(method.upper(), url, **kwargs)
+            except requests.RequestException:
+                limiter.release(error=True)
+                raise
+            limiter.release(latency=time.monotonic() - started, status=response.status_code)
+            retry_after = response.headers.get('Retry-After')
+            if response.status_code in (429, 503) and retry_after:
+                limiter.pause(min(self.max_retry_after, parse_retry_after(retry_after, self.backoff_factor)))
+            # a 429 response was not processed by the server, so even a POST can safely be sent again
+            if response.status_code != 429 or attempt >= self.retries:
+                if self.cassette:
+                    self.cassette.record(method, url, kwargs, response, time.monotonic() - started)
+                return response
+            if not retry_after:
+                limiter.pause(self.backoff_factor * (2 ** attempt))
+            attempt += 1
+            print(f"\033[91mRate limited by {limiter.host}, retry {attempt} of {self.retries}.\033[0m")
+
+    def limits(self):
+        """Current limits of all hosts"""
+        with self.lock:
+            limiters = list(self.limiters.values())
+        return [limiter.limits() for limiter in limiters]
+
+    def close(self):
+        with self.lock:
+            for session in self.sessions.values():
+                session.close()
+            self.sessions = {}
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+def get_transport():
+    """Return the process wide transport, it is created on first use after the .env settings are loaded"""
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = HttpTransport()
+        return _transport
+
+def reset_transport():
+    """Close the process wide transport, the next get_transport() builds a new one from the current environment"""
+    global _transport
+    with _transport_lock:
+        if _transport is not None:
+            _transport.close()
+        _transport = None
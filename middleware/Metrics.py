@@ -0,0 +1,256 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Instrumentation of the synchronization.
+#   - requests: latency histogram and count per service (ojs, wekan), method, endpoint template and status,
+#     recorded by WekanAPI.send_request and OJSAPI.fetch_page; IDs in the path are replaced by {id}
+#   - spans: duration of the sync phases (reading the board, issues and sections, planning, applying a level,
+#     custom field lookups) and of every card written in a run
+# The metrics of all runs are exposed in the Prometheus text format by MetricsExporter (daemon mode),
+# the metrics of a single run are returned by run_summary() and written as JSON by one-shot runs.
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# numeric OJS IDs and 17 character Wekan (Meteor) IDs
+ID_SEGMENT = re.compile(r"^(\d+|[A-Za-z0-9]{17})$")
+
+
+def endpoint_template(path):
+    """Endpoint of a request path with the object IDs replaced by {id}"""
+    return "/".join("{id}" if ID_SEGMENT.match(segment) else segment for segment in path.strip('/').split('/'))
+
+
+class Histogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+    def summary(self):
+        return {"count": self.count, "seconds": round(self.sum, 4), "max": round(self.max, 4),
+                "mean": round(self.sum / self.count, 4) if self.count else 0.0}
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.requests = {}  # (service, method, endpoint) -> Histogram
+        self.statuses = {}  # (service, method, endpoint, status) -> count
+        self.phases = {}  # phase -> Histogram
+        self.cards = {}  # card kind -> Histogram
+        self.runs = {}  # result -> count
+        self.last_run = None
+        self.run_started = None
+        self.run_requests = {}
+        self.run_phases = {}  # phase -> (Histogram, start of the first span)
+        self.run_cards = []
+
+    def observe_request(self, service, method, endpoint, status, duration):
+        key = (service, method.upper(), endpoint)
+        with self.lock:
+            self.requests.setdefault(key, Histogram()).observe(duration)
+            status_key = key + (str(status),)
+            self.statuses[status_key] = self.statuses.get(status_key, 0) + 1
+            if self.run_started is not None:
+                self.run_requests.setdefault(key, Histogram()).observe(duration)
+
+    def request_count(self):
+        """Number of requests recorded since the start of the process"""
+        with self.lock:
+            return sum(histogram.count for histogram in self.requests.values())
+
+    @contextmanager
+    def span(self, phase):
+        """Measure the duration of a sync phase, phases entered several times per run are added up"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - started
+            with self.lock:
+                self.phases.setdefault(phase, Histogram()).observe(duration)
+                if self.run_started is not None:
+                    histogram, _ = self.run_phases.setdefault(phase, (Histogram(), started - self.run_started))
+                    histogram.observe(duration)
+
+    @contextmanager
+    def card_span(self, kind, source_id, action):
+        """Measure the time needed to write the card of a journal, issue or submission"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            duration = time.monotonic() - started
+            with self.lock:
+                self.cards.setdefault(kind, Histogram()).observe(duration)
+                if self.run_started is not None:
+                    self.run_cards.append({"kind": kind, "id": source_id, "action": action, "seconds": round(duration, 4)})
+
+    def begin_run(self):
+        with self.lock:
+            self.run_started = time.monotonic()
+            self.run_requests = {}
+            self.run_phases = {}
+            self.run_cards = []
+
+    def end_run(self, stats=None):
+        """Finish the current run and return its summary, a run without stats counts as failed"""
+        with self.lock:
+            result = 'failed' if stats is None else 'ok'
+            self.runs[result] = self.runs.get(result, 0) + 1
+            requests = {}
+            for (service, method, endpoint), histogram in sorted(self.run_requests.items()):
+                requests[f"{service} {method} {endpoint}"] = histogram.summary()
+            self.last_run = {
+                "result": result,
+                "finishedAt": time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                "seconds": round(time.monotonic() - self.run_started, 4) if self.run_started is not None else 0.0,
+                "stats": dict(stats or {}),
+                "requests": requests,
+                "requestCount": sum(histogram.count for histogram in self.run_requests.values()),
+                "phases": {phase: dict(histogram.summary(), start=round(start, 4))
+                           for phase, (histogram, start) in sorted(self.run_phases.items(), key=lambda item: item[1][1])},
+                "cards": {"count": len(self.run_cards), "seconds": round(sum(card['seconds'] for card in self.run_cards), 4),
+                          "slowest": sorted(self.run_cards, key=lambda card: card['seconds'], reverse=True)[:10]}
+            }
+            self.run_started = None
+            return self.last_run
+
+    def run_summary(self):
+        with self.lock:
+            return self.last_run
+
+    def write_summary(self, path):
+        """Write the summary of the last run as JSON"""
+        tmp_file = f"{path}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(self.run_summary(), f, indent=2)
+        os.replace(tmp_file, path)
+
+    def render_prometheus(self):
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        with self.lock:
+            self.render_histograms(lines, 'oawfms_http_request_duration_seconds', 'Duration of HTTP requests to OJS and Wekan.',
+                                   {key: histogram for key, histogram in self.requests.items()}, ('service', 'method', 'endpoint'))
+            lines.append('# HELP oawfms_http_requests_total HTTP requests to OJS and Wekan by response status.')
+            lines.append('# TYPE oawfms_http_requests_total counter')
+            for key, count in sorted(self.statuses.items()):
+                lines.append(f"oawfms_http_requests_total{self.labels(('service', 'method', 'endpoint', 'status'), key)} {count}")
+            self.render_histograms(lines, 'oawfms_sync_phase_duration_seconds', 'Duration of the synchronization phases.',
+                                   {(phase,): histogram for phase, histogram in self.phases.items()}, ('phase',))
+            self.render_histograms(lines, 'oawfms_card_sync_duration_seconds', 'Time needed to write a card.',
+                                   {(kind,): histogram for kind, histogram in self.cards.items()}, ('kind',))
+            lines.append('# HELP oawfms_sync_runs_total Synchronization runs by result.')
+            lines.append('# TYPE oawfms_sync_runs_total counter')
+            for result, count in sorted(self.runs.items()):
+                lines.append(f"oawfms_sync_runs_total{self.labels(('result',), (result,))} {count}")
+            if self.last_run:
+                lines.append('# HELP oawfms_last_run_duration_seconds Duration of the last synchronization run.')
+                lines.append('# TYPE oawfms_last_run_duration_seconds gauge')
+                lines.append(f"oawfms_last_run_duration_seconds {self.last_run['seconds']}")
+                lines.append('# HELP oawfms_last_run_cards Cards of the last synchronization run by action.')
+                lines.append('# TYPE oawfms_last_run_cards gauge')
+                for action in ('changed', 'unchanged', 'failed'):
+                    lines.append(f"oawfms_last_run_cards{self.labels(('action',), (action,))} {self.last_run['stats'].get(action, 0)}")
+            lines.append('# HELP oawfms_process_start_time_seconds Start time of the middleware process.')
+            lines.append('# TYPE oawfms_process_start_time_seconds gauge')
+            lines.append(f"oawfms_process_start_time_seconds {self.started_at:.3f}")
+        return "\n".join(lines) + "\n"
+
+    def render_histograms(self, lines, name, description, histograms, label_names):
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} histogram")
+        for key, histogram in sorted(histograms.items()):
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                lines.append(f"{name}_bucket{self.labels(label_names + ('le',), key + (repr(bound),))} {count}")
+            lines.append(f"{name}_bucket{self.labels(label_names + ('le',), key + ('+Inf',))} {histogram.count}")
+            lines.append(f"{name}_sum{self.labels(label_names, key)} {histogram.sum:.6f}")
+            lines.append(f"{name}_count{self.labels(label_names, key)} {histogram.count}")
+
+    @staticmethod
+    def labels(names, values):
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+        return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+
+class MetricsExporter:
+    """HTTP endpoint serving GET /metrics in the Prometheus text format and GET /metrics/last-run as JSON"""
+
+    def __init__(self, metrics, host=None, port=None):
+        self.metrics = metrics
+        self.host = host or os.getenv('METRICS_HOST', '127.0.0.1')
+        self.port = int(port if port is not None else os.getenv('METRICS_PORT', '9108'))
+        self.server = None
+
+    def start(self):
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] == '/metrics':
+                    self.respond(metrics.render_prometheus(), 'text/plain; version=0.0.4; charset=utf-8')
+                elif self.path.split('?')[0] == '/metrics/last-run':
+                    self.respond(json.dumps(metrics.run_summary(), indent=2), 'application/json')
+                else:
+                    self.send_error(404)
+
+            def respond(self, text, content_type):
+                data = text.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f"\033[92mServing metrics on http://{self.host}:{self.server.server_address[1]}/metrics\033[0m")
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+def get_metrics():
+    """Return the process wide metrics registry"""
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics()
+        return _metrics
+
+def reset_metrics():
+    """Drop the process wide metrics registry, the next get_metrics() starts an empty one"""
+    global _metrics
+    with _metrics_lock:
+        _metrics = None
@@ -1,7 +1,13 @@
 import json
 import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-import requests
+from middleware.HttpTransport import get_transport
+from middleware.Metrics import endpoint_template, get_metrics
+from middleware.Records import Issue, Publication, Submission
+from middleware.SectionCatalogue import SectionCatalogue
 
 # OJS API reference: https://docs.pkp.sfu.ca/dev/api/ojs/3.3
 
@@ -24,71 +30,228 @@ class OJSAPI:
         self.base_url = os.getenv('OJS_URL')
         self.username = os.getenv('OJS_USERNAME')
         self.password = os.getenv('OJS_PASSWORD')
+        self.http = get_transport()
+        self.metrics = get_metrics()
+        # page size and number of pages fetched in parallel for paginated endpoints
+        self.page_size = int(os.getenv('OJS_PAGE_SIZE', '50'))
+        self.fetch_concurrency = int(os.getenv('OJS_FETCH_CONCURRENCY', '4'))
 
-        self.submissions = []
         self.issues = []
+        self.issues_by_id = {}
         self.future_issues = []
         self.sections = []
+        # sections keyed by sectionId, harvested from the issue details
+        self.section_catalogue = SectionCatalogue(self)
+
+        # current publications keyed by (submission id, publication id, last modification, locale), optionally kept on disk
+        self.publications = {}
+        self.publication_cache_file = os.getenv('OJS_PUBLICATION_CACHE', '')
+        self.publication_cache_loaded = False
 
     # Generic function to fetch paginated OJS endpoints
-    def fetch_endpoint(self, endpoint, params=''):
-        offset = 0
-        count = 50
-        itemsMax = None
+    # Once the first page reports itemsMax all remaining offsets are known and can be fetched in parallel.
+    def fetch_endpoint(self, endpoint, params='', parallel=None):
+        page_data = self.fetch_page(endpoint, params, self.page_size, 0)
+
+        # if there is no itemsMax field we don't have a paginated response and can return immediately
+        if 'itemsMax' not in page_data:
+            return page_data
         result = {'items': []}
+        for page in self.iter_pages(endpoint, params, page_data, parallel):
+            result['items'].extend(page.get('items', []))
+        itemsMax = page_data.get('itemsMax')
+        result['itemsMax'] = itemsMax if isinstance(itemsMax, int) else len(result['items'])
+        return result
+
+    def iter_pages(self, endpoint, params, first_page, parallel=None, count=None, offset=0):
+        """Yield the pages of a paginated endpoint in order, starting with the already fetched first page at offset"""
+        count = count or self.page_size
+        yield first_page
+        itemsMax = first_page.get('itemsMax')
+
+        if not isinstance(itemsMax, int):
+            # without a usable total walk the pages one after another until an empty page is returned
+            offset += count
+            page = first_page
+            while page.get('items'):
+                page = self.fetch_page(endpoint, params, count, offset)
+                yield page
+                offset += count
+            return
+
+        offsets = list(range(offset + count, itemsMax, count))
+        if parallel is None:
+            parallel = self.fetch_concurrency > 1
+        if parallel and len(offsets) > 1:
+            # at most fetch_concurrency pages are requested ahead of the page that is currently consumed
+            workers = min(self.fetch_concurrency, len(offsets))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = deque(executor.submit(self.fetch_page, endpoint, params, count, offset) for offset in offsets[:workers])
+                remaining = iter(offsets[workers:])
+                while pending:
+                    page = pending.popleft().result()
+                    offset = next(remaining, None)
+                    if offset is not None:
+                        pending.append(executor.submit(self.fetch_page, endpoint, params, count, offset))
+                    yield page
+        else:
+            for offset in offsets:
+                page = self.fetch_page(endpoint, params, count, offset)
+                if not page.get('items'):
+                    break
+                yield page
+
+    def fetch_page(self, endpoint, params, count, offset):
         headers = {
             'Content-Type': 'application/json',
             'Accept': '*/*'
         }
-        while True:
-            journals_url = f"{self.base_url}/api/v1/{endpoint}?apiToken={self.password}&{params}&count={count}&offset={offset}"
-            response = requests.get(journals_url, headers=headers)
-            response.raise_for_status()
-            page_data = response.json()
+        journals_url = f"{self.base_url}/api/v1/{endpoint}?apiToken={self.password}&{params}&count={count}&offset={offset}"
+        started = time.monotonic()
+        status = 'error'
+        try:
+            response = self.http.request('get', journals_url, headers=headers)
+            status = response.status_code
+        finally:
+            self.metrics.observe_request('ojs', 'get', endpoint_template(endpoint), status, time.monotonic() - started)
+        response.raise_for_status()
+        return response.json()
 
-            if itemsMax is None:
-                # if there is no itemsMax field we don't have a paginated response and can return immediately
-                if 'itemsMax' not in page_data:
-                    return page_data 
-                itemsMax = page_data.get('itemsMax', 0)
+    # Get a single submission or issue, e.g. after a webhook notification
+    def getSubmission(self, submission_id):
+        return Submission.from_json(self.fetch_endpoint(f'submissions/{submission_id}'))
 
-            result['items'].extend(page_data.get('items', []))
+    def getIssue(self, issue_id):
+        return Issue.from_json(self.fetch_endpoint(f'issues/{issue_id}'))
 
-            if len(result['items']) >= itemsMax or not page_data.get('items'):
+    # iterator over all active submissions
+    # The submissions are streamed page by page and parsed into Submission records.
+    # The current publications of each page are prefetched concurrently before its submissions are yielded.
+    # Once all active submissions are read, publications of earlier modifications and of submissions that left
+    # the queue are dropped from memory, so a long-lived process doesn't keep every version it has seen.
+    def iterSubmissions(self):
+        self.load_publication_cache()
+        params = self.submission_params([self.STATUS_QUEUED])
+        pages = self.iter_pages('submissions', params, self.fetch_page('submissions', params, self.page_size, 0))
+        keys = []
+        fetched = 0
+        for page in pages:
+            submissions = [Submission.from_json(submission) for submission in page.get('items', [])]
+            fetched += self.fetch_missing_publications(submissions)
+            keys.extend(self.publication_key(submission) for submission in submissions)
+            yield from submissions
+        print(f"\033[92mPrefetched {fetched} publications, {len(keys) - fetched} served from cache.\033[0m")
+        self.prune_publications(keys)
+        self.save_publication_cache(keys)
+
+    # Pages of submissions with any set of statuses, e.g. for the backfill of published and scheduled submissions
+    # The submissions are ordered by submission date, oldest first, so an offset stays valid between runs
+    # while new submissions are added at the end. Yields (offset of the page, total, submissions) with the
+    # current publications of the page prefetched.
+    def iterSubmissionPages(self, statuses, offset=0, count=None):
+        count = count or self.page_size
+        params = f"{self.submission_params(statuses)}&orderBy=dateSubmitted&orderDirection=ASC"
+        first_page = self.fetch_page('submissions', params, count, offset)
+        total = first_page.get('itemsMax')
+        for page in self.iter_pages('submissions', params, first_page, count=count, offset=offset):
+            submissions = [Submission.from_json(submission) for submission in page.get('items', [])]
+            if not submissions:
                 break
+            self.fetch_missing_publications(submissions)
+            yield offset, total, submissions
             offset += count
-        result['itemsMax'] = itemsMax
-        return result
 
-    # Get all active submissions
-    def getActiveSubmissions(self):
-        self.submissions = self.fetch_endpoint('submissions', params=f'status={self.STATUS_QUEUED}')
-        return self.submissions
-    
-    # itarator over all submissions
-    def iterSubmissions(self):
-        for submission in self.submissions.get('items', []):
-            yield submission
+    @staticmethod
+    def submission_params(statuses):
+        return f"status={','.join(str(status) for status in statuses)}"
 
     def getCurrentPublication(self, submission):
-        currentPublicationId = submission.get('currentPublicationId', {})
+        key = self.publication_key(submission)
+        publication = self.publications.get(key)
+        if publication is None:
+            publication = self.fetch_publication(submission)
+            self.publications[key] = publication
+        return publication
+
+    def getCachedSubmissionIds(self, issue_id):
+        """IDs of the submissions whose cached current publication is assigned to the issue, None if nothing is cached"""
+        self.load_publication_cache()
+        if not self.publications:
+            return None
+        return {key[0] for key, publication in self.publications.items() if publication.issue_id == issue_id}
+
+    def fetch_publication(self, submission):
         # fetch publication details via API, the publication object that comes with the submission is incomplete
-        return self.fetch_endpoint(f'/submissions/{submission["id"]}/publications/{currentPublicationId}')
+        publication = self.fetch_endpoint(f'/submissions/{submission.id}/publications/{submission.current_publication_id}')
+        return Publication.from_json(publication, submission.locale)
+
+    def publication_key(self, submission):
+        """Cache key of the current publication: (submission id, publication id, last modification, locale)"""
+        last_modified = submission.publication_modified or submission.last_modified or submission.date_last_activity
+        return (submission.id, submission.current_publication_id, last_modified, submission.locale)
+
+    def fetch_missing_publications(self, submissions):
+        """Fetch the current publications of the given submissions that are not cached yet, concurrently"""
+        missing = [s for s in submissions if self.publication_key(s) not in self.publications]
+        if missing:
+            with ThreadPoolExecutor(max_workers=max(1, min(self.fetch_concurrency, len(missing)))) as executor:
+                for submission, publication in zip(missing, executor.map(self.fetch_publication, missing)):
+                    self.publications[self.publication_key(submission)] = publication
+        return len(missing)
+
+    def load_publication_cache(self):
+        """Load the on-disk publication cache once, if a cache file is configured"""
+        if not self.publication_cache_file or self.publication_cache_loaded:
+            return
+        self.publication_cache_loaded = True
+        if not os.path.exists(self.publication_cache_file):
+            return
+        try:
+            with open(self.publication_cache_file, encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"\033[91mIgnoring unreadable publication cache {self.publication_cache_file}: {e}\033[0m")
+            return
+        for entry in entries:
+            # entries written before the publication records were introduced are fetched again
+            if 'record' in entry:
+                self.publications.setdefault(tuple(entry['key']), Publication.from_dict(entry['record']))
+
+    def prune_publications(self, keys):
+        """Keep only the publications with the given keys in memory"""
+        keys = set(keys)
+        for key in [key for key in self.publications if key not in keys]:
+            self.publications.pop(key, None)
+
+    def save_publication_cache(self, keys):
+        """Write the publications with the given keys to the on-disk cache, older entries are dropped"""
+        if not self.publication_cache_file:
+            return
+        entries = [{'key': list(key), 'record': self.publications[key].to_dict()} for key in keys if key in self.publications]
+        tmp_file = f"{self.publication_cache_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(entries, f)
+        os.replace(tmp_file, self.publication_cache_file)
 
     def getIssuesAndSections(self):
-        # get ojs issues, loop over all issues to extract and merge section arrays
-        self.issues = self.fetch_endpoint('issues')
-        section_map = {}
-        for issue in self.issues.get('items', []):
-            issue_details = self.fetch_endpoint(f'issues/{issue["id"]}')
-            for section in issue_details.get('sections', []):
-                section_id = section.get('id')
-                if section_id and section_id not in section_map:
-                    section_map[section_id] = section
-        self.sections = list(section_map.values())
-        self.future_issues = self.fetch_endpoint('issues', params=f'isPublished=0')
+        # get ojs issues, the section catalogue harvests the sections of new or modified issues
+        self.issues = [Issue.from_json(issue) for issue in self.fetch_endpoint('issues').get('items', [])]
+        self.issues_by_id = {issue.id: issue for issue in self.issues}
+        self.section_catalogue.refresh(self.issues)
+        self.sections = self.section_catalogue.sections()
+        # future issues are taken from the issue list if it reports isPublished, otherwise they are fetched
+        if all(issue.is_published is not None for issue in self.issues):
+            self.future_issues = [issue for issue in self.issues if not issue.is_published]
+        else:
+            self.future_issues = [Issue.from_json(issue) for issue in self.fetch_endpoint('issues', params=f'isPublished=0').get('items', [])]
         return
 
+    def getIssueSummary(self, issue_id):
+        return self.issues_by_id.get(issue_id)
+
+    def getSection(self, section_id):
+        return self.section_catalogue.get(section_id)
+
     # simple test function to demonstrate usage
     def test_api(self):
         print("Running as:", self.username)
@@ -0,0 +1,108 @@
+import cProfile
+import io
+import pstats
+import sys
+import threading
+from collections import Counter
+
+# Profilers for a synchronization run. Most of the work of a run is done on the worker threads of the sync
+# engine and the OJS page fetcher, so both profilers cover all threads:
+#   cprofile   deterministic profile; every thread started during the run gets its own cProfile.Profile,
+#              the profiles are merged and written as pstats file (e.g. for snakeviz)
+#   sample     sampling profiler; the stacks of all threads are sampled every `interval` seconds and written
+#              as folded stacks (e.g. for flamegraph.pl or speedscope), with little overhead
+
+
+class ThreadedProfiler:
+
+    def __init__(self, output):
+        self.output = output
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        profiler = self
+
+        def start_thread_profile(*args):
+            # called on the first profiling event of a new thread, hands the thread over to its own profile
+            profile = cProfile.Profile()
+            with profiler.lock:
+                profiler.profiles.append(profile)
+            sys.setprofile(None)
+            profile.enable()
+
+        threading.setprofile(start_thread_profile)
+        self.main_profile = cProfile.Profile()
+        self.main_profile.enable()
+        return self
+
+    def stop(self, top=30):
+        self.main_profile.disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(self.main_profile)
+        with self.lock:
+            for profile in self.profiles:
+                profile.disable()
+                stats.add(profile)
+        stats.dump_stats(self.output)
+        report = io.StringIO()
+        stats.stream = report
+        stats.sort_stats('cumulative').print_stats(top)
+        print(report.getvalue())
+        print(f"\033[92mProfile of {len(self.profiles) + 1} threads written to {self.output}.\033[0m")
+
+
+class SamplingProfiler:
+
+    def __init__(self, output, interval=0.005):
+        self.output = output
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def sample(self):
+        own_id = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self, top=30):
+        self.stop_event.set()
+        self.thread.join()
+        with open(self.output, 'w', encoding='utf-8') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        # inclusive samples per function, counted once per stack
+        functions = Counter()
+        for stack, count in self.stacks.items():
+            for function in set(stack.split(";")):
+                functions[function] += count
+        total = sum(self.stacks.values()) or 1
+        print(f"{'samples':>8} {'share':>6}  function")
+        for function, count in functions.most_common(top):
+            print(f"{count:>8} {count / total:>6.1%}  {function}")
+        print(f"\033[92m{self.samples} samples taken every {self.interval * 1000:.0f} ms, folded stacks written to {self.output}.\033[0m")
+
+
+def start_profiler(mode, output=None):
+    """Start a profiler ('cprofile' or 'sample'), returns an object with a stop() method"""
+    if mode == 'cprofile':
+        return ThreadedProfiler(output or 'oa-wfms.pstats').start()
+    if mode == 'sample':
+        return SamplingProfiler(output or 'oa-wfms.folded').start()
+    raise ValueError(f"Unknown profiler '{mode}', use 'cprofile' or 'sample'")
@@ -0,0 +1,115 @@
+import os
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+# Client side limiter for the requests sent to one host, used by the HTTP transport.
+#   - token bucket: at most `rate` requests per second with bursts of up to `burst` requests (rate 0 = no limit)
+#   - AIMD concurrency: the number of requests in flight grows by `increase` per window of successful requests
+#     while the limit is used up (additive increase) and is cut by `decrease` on 429/5xx responses, connection
+#     errors and responses slower than `latency_target` (multiplicative decrease)
+#   - Retry-After: a 429 or 503 response pauses all requests to the host for the requested time
+
+class RateLimiter:
+
+    def __init__(self, host, max_concurrency, rate=0.0, burst=None, latency_target=None, decrease=None):
+        self.host = host
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.min_concurrency = 1
+        # start low and let the limit grow, a cold start at full concurrency would trip a busy backend
+        self.limit = float(min(self.max_concurrency, int(os.getenv('HTTP_INITIAL_CONCURRENCY', '2'))))
+        self.rate = float(rate)
+        self.burst = float(burst if burst else max(1.0, self.rate))
+        self.tokens = self.burst
+        self.latency_target = float(latency_target if latency_target is not None else os.getenv('HTTP_LATENCY_TARGET', '5'))
+        self.increase = float(os.getenv('HTTP_AIMD_INCREASE', '0.25'))
+        self.decrease = float(decrease if decrease is not None else os.getenv('HTTP_AIMD_DECREASE', '0.5'))
+        self.in_flight = 0
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+        self.last_decrease = 0.0
+        self.latency = None  # moving average of the response times
+        self.throttled = 0
+        self.errors = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """Wait until the host is not paused, a token is available and the concurrency limit allows another request"""
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                self.refill(now)
+                wait = self.blocked_until - now
+                if wait <= 0 and self.in_flight < int(self.limit):
+                    if not self.rate:
+                        break
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        break
+                    wait = (1 - self.tokens) / self.rate
+                self.condition.wait(wait if wait > 0 else None)
+            self.in_flight += 1
+
+    def release(self, latency=None, status=None, error=False):
+        """Finish a request and adapt the concurrency limit to its outcome"""
+        with self.condition:
+            self.in_flight -= 1
+            if latency is not None:
+                self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            if error or (status is not None and (status == 429 or status >= 500)):
+                self.errors += 1
+                self.back_off()
+            elif latency is not None and latency > self.latency_target:
+                self.back_off()
+            elif self.in_flight + 1 >= int(self.limit):
+                # the limit is only raised while it is actually used up
+                self.limit = min(float(self.max_concurrency), self.limit + self.increase / self.limit)
+            self.condition.notify_all()
+
+    def pause(self, delay):
+        """Pause all requests to the host, e.g. as requested by a Retry-After header"""
+        with self.condition:
+            self.throttled += 1
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+            self.condition.notify_all()
+
+    def back_off(self):
+        # errors of requests that were already in flight belong to the same congestion event,
+        # so the limit is cut at most once per average response time
+        now = time.monotonic()
+        if now - self.last_decrease >= (self.latency or 0.0):
+            self.limit = max(float(self.min_concurrency), self.limit * self.decrease)
+            self.last_decrease = now
+
+    def refill(self, now):
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def limits(self):
+        """Current limits of the host"""
+        with self.condition:
+            return {
+                "host": self.host,
+                "concurrency": int(self.limit),
+                "maxConcurrency": self.max_concurrency,
+                "inFlight": self.in_flight,
+                "rate": self.rate,
+                "pausedFor": round(max(0.0, self.blocked_until - time.monotonic()), 2),
+                "throttled": self.throttled,
+                "errors": self.errors
+            }
+
+
+def parse_retry_after(value, default):
+    """Seconds to wait according to a Retry-After header (delay in seconds or HTTP date)"""
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,95 @@
+from dataclasses import asdict, dataclass
+
+# Compact records of the OJS objects used by the synchronization.
+# OJS returns large nested objects with localized maps. The records are created when a response is parsed,
+# keep only the fields the synchronization uses and resolve localized values once, for the locale of the object.
+
+@dataclass(slots=True)
+class Submission:
+    id: int
+    locale: str
+    stage_id: int
+    status: int
+    current_publication_id: int
+    date_last_activity: str
+    last_modified: str
+    publication_modified: str  # lastModified of the current publication as listed with the submission
+
+    @classmethod
+    def from_json(cls, data):
+        publication_id = data.get('currentPublicationId')
+        summary = next((p for p in data.get('publications', []) if p.get('id') == publication_id), {})
+        return cls(
+            id=data.get('id'),
+            locale=data.get('locale'),
+            stage_id=data.get('stageId'),
+            status=data.get('status'),
+            current_publication_id=publication_id,
+            date_last_activity=data.get('dateLastActivity'),
+            last_modified=data.get('lastModified'),
+            publication_modified=summary.get('lastModified')
+        )
+
+    def to_dict(self):
+        return asdict(self)
+
+
+@dataclass(slots=True)
+class Publication:
+    id: int
+    submission_id: int
+    locale: str
+    title: str
+    url: str
+    authors: str
+    section_id: int
+    issue_id: int
+    last_modified: str
+
+    @classmethod
+    def from_json(cls, data, locale):
+        return cls(
+            id=data.get('id'),
+            submission_id=data.get('submissionId'),
+            locale=locale,
+            title=(data.get('fullTitle') or {}).get(locale, 'No Title'),
+            url=data.get('_href', 'No URL'),
+            authors=data.get('authorsStringShort', 'No Authors'),
+            section_id=data.get('sectionId'),
+            issue_id=data.get('issueId'),
+            last_modified=data.get('lastModified')
+        )
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+    def to_dict(self):
+        return asdict(self)
+
+
+@dataclass(slots=True)
+class Issue:
+    id: int
+    volume: str
+    year: str
+    identification: str
+    title: str
+    is_published: bool
+    last_modified: str
+
+    @classmethod
+    def from_json(cls, data):
+        locale = data.get('locale', 'de_DE')
+        return cls(
+            id=data.get('id'),
+            volume=data.get('volume', 'No volume number'),
+            year=data.get('year', 'No Year'),
+            identification=data.get('identification'),
+            title=(data.get('title') or {}).get(locale, 'No Title'),
+            is_published=data.get('isPublished'),
+            last_modified=data.get('lastModified')
+        )
+
+    def to_dict(self):
+        return asdict(self)
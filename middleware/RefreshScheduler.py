@@ -0,0 +1,231 @@
+import heapq
+import json
+import os
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from middleware.Coordination import LeaseLost
+from middleware.Records import Submission
+from middleware.SyncPlanner import SyncPlanner
+
+# Tiered refresh of the active submissions for the sync daemon.
+# Instead of synchronizing every submission in every cycle, each submission gets a refresh tier and is
+# refreshed individually when it is due:
+#   hot    copyediting and production, or activity within REFRESH_HOT_ACTIVITY_HOURS
+#   warm   internal and external review
+#   cold   submission stage, or no activity for REFRESH_DORMANT_DAYS
+# The refresh intervals of the tiers are set with REFRESH_INTERVALS. Every tier is a priority queue of the
+# next due times, the due submissions are refreshed hot tier first. A refresh cycle spends at most
+# REFRESH_BUDGET requests (estimated from the average cost of the previous refreshes), submissions that
+# don't fit into the budget stay due for the next cycle, so the cost of a cycle stays flat while the backlog
+# grows. Every cycle also lists the newest REFRESH_DISCOVERY_COUNT submissions to pick up new ones.
+# The schedule is filled by the full synchronizations, which still run every REFRESH_FULL_INTERVAL seconds:
+# they see every active submission, repair changes made on the board and drop the submissions that left
+# the queue. Refresh cycles reuse the board snapshot of the last full run or drift check. With a coordinator the schedule only
+# holds the submissions of the shards leased by this worker.
+
+TIERS = ('hot', 'warm', 'cold')
+DEFAULT_INTERVALS = {"hot": 30, "warm": 600, "cold": 21600}
+
+
+class RefreshScheduler:
+
+    def __init__(self, wekan_api, ojs_api, intervals=None, budget=None):
+        self.wekan_api = wekan_api
+        self.ojs_api = ojs_api
+        self.intervals = dict(DEFAULT_INTERVALS, **(intervals or json.loads(os.getenv('REFRESH_INTERVALS', '{}') or '{}')))
+        unknown = set(self.intervals) - set(TIERS)
+        if unknown:
+            raise ValueError(f"Unknown refresh tiers {', '.join(sorted(unknown))} in REFRESH_INTERVALS, use {', '.join(TIERS)}")
+        self.budget = max(2, int(budget or os.getenv('REFRESH_BUDGET', '60')))
+        self.cycle_interval = float(os.getenv('REFRESH_CYCLE', '10'))
+        self.full_interval = float(os.getenv('REFRESH_FULL_INTERVAL', '3600'))
+        self.discovery_count = int(os.getenv('REFRESH_DISCOVERY_COUNT', '20'))
+        self.hot_activity = float(os.getenv('REFRESH_HOT_ACTIVITY_HOURS', '24')) * 3600
+        self.dormant = float(os.getenv('REFRESH_DORMANT_DAYS', '180')) * 86400
+        self.concurrency = max(1, int(os.getenv('SYNC_CONCURRENCY', '4')))
+        self.lock = threading.Lock()
+        self.queues = {tier: [] for tier in TIERS}  # tier -> heap of (due, submission ID)
+        self.entries = {}  # submission ID -> (due, tier), heap items that don't match are stale
+        self.seen = None  # submission IDs observed by the running full synchronization
+        self.last_full_sync = None
+        # average number of requests needed to refresh one submission, used to fill the budget
+        self.average_cost = 2.0
+        self.backlog = False
+        self.coordinator = None  # set by the daemon when several workers share the board
+        self.coordinator_shards = None
+
+    def tier(self, submission, now=None):
+        """Refresh tier of a submission from its workflow stage and last activity"""
+        ojs_api = self.ojs_api
+        now = now or time.time()
+        stage = submission.stage_id
+        if stage in (ojs_api.WORKFLOW_STAGE_EDITING, ojs_api.WORKFLOW_STAGE_PRODUCTION):
+            tier = 'hot'
+        elif stage in (ojs_api.WORKFLOW_STAGE_INTERNAL_REVIEW, ojs_api.WORKFLOW_STAGE_EXTERNAL_REVIEW):
+            tier = 'warm'
+        else:
+            tier = 'cold'
+        activity = parse_date(submission.date_last_activity)
+        if activity is not None and now - activity < self.hot_activity:
+            tier = 'hot'
+        elif activity is not None and now - activity > self.dormant:
+            tier = 'cold'
+        return tier
+
+    def schedule(self, submission_id, tier, due):
+        with self.lock:
+            self.entries[submission_id] = (due, tier)
+            heapq.heappush(self.queues[tier], (due, submission_id))
+
+    def forget(self, submission_id):
+        with self.lock:
+            self.entries.pop(submission_id, None)
+
+    # full synchronizations
+
+    def full_sync_due(self):
+        return self.last_full_sync is None or time.monotonic() - self.last_full_sync >= self.full_interval
+
+    def begin_full_sync(self):
+        with self.lock:
+            self.seen = set()
+
+    def observe(self, submission):
+        """Called for every active submission of a full synchronization, which has just refreshed it"""
+        now = time.time()
+        tier = self.tier(submission, now)
+        with self.lock:
+            if self.seen is not None:
+                self.seen.add(submission.id)
+        self.schedule(submission.id, tier, now + self.intervals[tier])
+
+    def end_full_sync(self, completed):
+        """Submissions a completed full synchronization didn't see have left the queue"""
+        with self.lock:
+            if completed and self.seen is not None:
+                for submission_id in set(self.entries) - self.seen:
+                    del self.entries[submission_id]
+                self.last_full_sync = time.monotonic()
+            self.seen = None
+
+    # refresh cycles
+
+    def take_due(self, now, budget):
+        """Pop the due submissions that fit into the budget, hot tier first"""
+        due = []
+        with self.lock:
+            for tier in TIERS:
+                queue = self.queues[tier]
+                # at least one submission per cycle, even if a single refresh exceeds the budget
+                while queue and queue[0][0] <= now and (not due or (len(due) + 1) * self.average_cost <= budget):
+                    item_due, submission_id = heapq.heappop(queue)
+                    if self.entries.get(submission_id) == (item_due, tier):
+                        due.append(submission_id)
+            self.backlog = any(self.is_due(tier, now) for tier in TIERS)
+        return due
+
+    def is_due(self, tier, now):
+        queue = self.queues[tier]
+        while queue and self.entries.get(queue[0][1]) != (queue[0][0], tier):
+            # drop stale heap items left by rescheduled or forgotten submissions
+            heapq.heappop(queue)
+        return bool(queue) and queue[0][0] <= now
+
+    def next_delay(self):
+        """Seconds until the next refresh cycle or full synchronization"""
+        if self.full_sync_due():
+            return 0.0
+        until_full = self.full_interval - (time.monotonic() - self.last_full_sync)
+        if self.backlog:
+            return min(self.cycle_interval, until_full)
+        now = time.time()
+        with self.lock:
+            for tier in TIERS:
+                self.is_due(tier, now)
+            next_due = min((queue[0][0] for queue in self.queues.values() if queue), default=now + until_full)
+        return max(1.0, min(until_full, max(self.cycle_interval, next_due - now)))
+
+    def discover(self, now):
+        """Schedule new submissions from the newest page of the active submissions"""
+        ojs_api = self.ojs_api
+        params = f"{ojs_api.submission_params([ojs_api.STATUS_QUEUED])}&orderBy=dateSubmitted&orderDirection=DESC"
+        page = ojs_api.fetch_page('submissions', params, self.discovery_count, 0)
+        discovered = 0
+        for item in page.get('items', []):
+            submission = Submission.from_json(item)
+            if self.coordinator and not self.coordinator.owns('submission', submission.id):
+                continue
+            if submission.id not in self.entries:
+                self.schedule(submission.id, 'hot', now)
+                discovered += 1
+        return discovered
+
+    def refresh(self, spent=0):
+        """Refresh the due submissions within the request budget, less the requests already spent in the cycle, returns the counters of the cycle"""
+        wekan_api = self.wekan_api
+        metrics = wekan_api.metrics
+        stats = {"changed": 0, "unchanged": 0, "failed": 0, "left": 0, "skipped": 0, "discovered": 0}
+        requests_before = metrics.request_count()
+        now = time.time()
+        with metrics.span('refresh'):
+            stats["discovered"] = self.discover(now) if self.discovery_count else 0
+            requests_after_discovery = metrics.request_count()
+            due = self.take_due(now, self.budget - spent - (requests_after_discovery - requests_before))
+            if due:
+                planner = SyncPlanner(wekan_api, self.ojs_api, coordinator=self.coordinator)
+                journal_name = wekan_api.get_journal_name()
+                with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                    for result in executor.map(lambda submission_id: self.refresh_submission(planner, journal_name, submission_id, now), due):
+                        stats[result] += 1
+        spent = metrics.request_count() - requests_before
+        if due:
+            cost = (metrics.request_count() - requests_after_discovery) / len(due)
+            self.average_cost = 0.8 * self.average_cost + 0.2 * max(1.0, cost)
+        print(f"\033[92mRefreshed {len(due)} submissions with {spent} requests: {stats['changed']} changed, {stats['unchanged']} unchanged, "
+              f"{stats['left']} left the queue, {stats['failed']} failed, {stats['discovered']} new"
+              f"{', more submissions are due' if self.backlog else ''}.\033[0m")
+        return stats
+
+    def refresh_submission(self, planner, journal_name, submission_id, now):
+        ojs_api = self.ojs_api
+        tier = self.entries.get(submission_id, (None, 'hot'))[1]
+        try:
+            submission = ojs_api.getSubmission(submission_id)
+            if submission.status != ojs_api.STATUS_QUEUED:
+                # the card is left to the retention pass of the next full synchronization
+                self.forget(submission_id)
+                return "left"
+            tier = self.tier(submission, now)
+            operation = planner.plan_submission(journal_name, submission, set())
+            planner.apply(operation)
+        except LeaseLost as e:
+            # the shard was taken over, the submission is scheduled by its new holder
+            print(f"\033[91m{e}\033[0m")
+            self.forget(submission_id)
+            return "skipped"
+        except Exception as e:
+            traceback.print_exc()
+            print(f"\033[91mRefresh of submission ID {submission_id} failed ({e}), retrying in {self.intervals[tier]:.0f} seconds.\033[0m")
+            self.schedule(submission_id, tier, now + self.intervals[tier])
+            return "failed"
+        self.schedule(submission_id, tier, now + self.intervals[tier])
+        return "unchanged" if operation.action == 'unchanged' else "changed"
+
+    def report(self):
+        with self.lock:
+            counts = {tier: 0 for tier in TIERS}
+            for _, tier in self.entries.values():
+                counts[tier] += 1
+        print(f"\033[92mRefresh schedule: {counts['hot']} hot, {counts['warm']} warm, {counts['cold']} cold submissions.\033[0m")
+
+
+def parse_date(value):
+    """Timestamp of an OJS date ('2025-01-31 12:00:00'), None if it can't be parsed"""
+    if not value:
+        return None
+    try:
+        return time.mktime(time.strptime(value[:19], '%Y-%m-%d %H:%M:%S'))
+    except ValueError:
+        return None
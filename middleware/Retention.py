@@ -0,0 +1,178 @@
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+# Retention of the cards of finished submissions.
+# Cards of submissions that left the OJS queue (published, scheduled, declined or removed) are not touched by
+# the synchronization any more, so the swimlane and its card listing would keep growing with the history of
+# the journal. After a synchronization the retention pass compares the mapped submission cards with the
+# active submissions of the plan. The status of a submission that left the queue is fetched once (and again
+# after RETENTION_RECHECK_HOURS while its card is on the board), then the policy of the status is applied.
+# A submission OJS answers with 404 is only "missing" at first, e.g. after a wrong OJS_URL or a
+# misconfigured proxy: it is fetched again with the next run and only counts as "removed" if it is still not
+# found. The cards written by a backfill (see Backfill) are recorded as "backfilled" and left alone until
+# their submission becomes active again. The policy per status:
+#   list                 the card is moved to this list, e.g. Post-Produktion for published submissions
+#   archive_after_days   the card is archived this many days after the submission left the queue
+# e.g. RETENTION_POLICY='{"published": {"list": "Post-Produktion", "archive_after_days": 90}, "declined": {"archive_after_days": 7}}'
+# Archived cards are dropped from the board snapshot and their sync state is forgotten. Wekan doesn't list
+# archived cards, so the listings of the swimlane only carry the active work. The card mapping is kept: if the
+# submission becomes active again, the synchronization restores its card if Wekan still returns it, otherwise
+# it creates a new one.
+
+POLICY_STATUSES = ('published', 'scheduled', 'declined', 'removed')
+POLICY_RULES = ('list', 'archive_after_days')
+
+
+def load_policy(value=None):
+    """Retention policy per submission status from RETENTION_POLICY"""
+    policy = json.loads(value if value is not None else os.getenv('RETENTION_POLICY', '{}') or '{}')
+    for status, rule in policy.items():
+        if status not in POLICY_STATUSES:
+            raise ValueError(f"Unknown status '{status}' in RETENTION_POLICY, use one of {', '.join(POLICY_STATUSES)}")
+        unknown = set(rule) - set(POLICY_RULES)
+        if unknown:
+            raise ValueError(f"Unknown rule {', '.join(sorted(unknown))} for status '{status}' in RETENTION_POLICY, use {' or '.join(POLICY_RULES)}")
+    return policy
+
+
+class RetentionPass:
+
+    def __init__(self, wekan_api, ojs_api, policy=None, recheck_hours=None):
+        self.wekan_api = wekan_api
+        self.ojs_api = ojs_api
+        self.policy = policy if policy is not None else load_policy()
+        self.recheck = float(recheck_hours if recheck_hours is not None else os.getenv('RETENTION_RECHECK_HOURS', '24')) * 3600
+        self.coordinator = None
+        self.status_names = {ojs_api.STATUS_QUEUED: 'queued', ojs_api.STATUS_PUBLISHED: 'published',
+                             ojs_api.STATUS_DECLINED: 'declined', ojs_api.STATUS_SCHEDULED: 'scheduled'}
+
+    def run(self, active_ids, dry_run=False, coordinator=None):
+        """Apply the policy to the cards of the submissions that are not in active_ids, returns the number of moved and archived cards"""
+        self.coordinator = coordinator
+        stats = {"moved": 0, "archived": 0, "retention_failed": 0}
+        sync_state = self.wekan_api.get_sync_state()
+        snapshot = self.wekan_api.get_snapshot(self.wekan_api.board_name)
+        if not sync_state or not snapshot.board:
+            return stats
+        active_ids = {str(source_id) for source_id in active_ids}
+        entries = sync_state.get_retention('submission')
+        # submissions that are active again are synchronized as usual, which restores their cards
+        for source_id in entries.keys() & active_ids:
+            if not dry_run:
+                sync_state.remove_retention('submission', source_id)
+            del entries[source_id]
+
+        inactive = sorted(mapping['source_id'] for mapping in sync_state.get_mappings('submission')
+                          if mapping['board_id'] == snapshot.board['_id'] and mapping['source_id'] not in active_ids
+                          and (coordinator is None or coordinator.owns('submission', mapping['source_id'])))
+        now = time.time()
+        to_check = [source_id for source_id in inactive if source_id not in entries
+                    or (entries[source_id]['archived_at'] is None and entries[source_id]['status'] != 'backfilled'
+                        and (entries[source_id]['status'] == 'missing' or now - entries[source_id]['checked_at'] >= self.recheck))]
+        with ThreadPoolExecutor(max_workers=max(1, min(self.ojs_api.fetch_concurrency, len(to_check) or 1))) as executor:
+            for source_id, status in zip(to_check, executor.map(self.fetch_status, to_check)):
+                if status in (None, 'queued'):
+                    # not checked or active again since the plan was made
+                    continue
+                entry = entries.get(source_id)
+                if status == 'missing' and entry and entry['status'] in ('missing', 'removed'):
+                    # not found twice in a row, it left the queue when it was first missed
+                    status = 'removed'
+                    entry['status'] = status
+                if entry is None or entry['status'] != status:
+                    entry = {"kind": "submission", "source_id": source_id, "status": status, "inactive_since": now,
+                             "list_title": entry['list_title'] if entry else None, "archived_at": None}
+                entry['checked_at'] = now
+                entries[source_id] = entry
+                if not dry_run:
+                    sync_state.set_retention(entry)
+
+        due = []
+        for source_id in inactive:
+            entry = entries.get(source_id)
+            if not entry or entry['archived_at'] is not None:
+                continue
+            changes = self.get_changes(entry, now)
+            if changes:
+                due.append((entry, changes))
+        if not due:
+            return stats
+        print(f"\033[92mRetention: {sum(1 for _, changes in due if 'listId' in changes)} cards to move, "
+              f"{sum(1 for _, changes in due if 'archive' in changes)} to archive.\033[0m")
+        if dry_run:
+            for entry, changes in due:
+                print(f"{'archive' if 'archive' in changes else 'move':9} submission {entry['source_id']} ({entry['status']})"
+                      + (f" to '{entry['list_target']}'" if 'listId' in changes else ''))
+            stats["moved"] = sum(1 for _, changes in due if 'listId' in changes)
+            stats["archived"] = sum(1 for _, changes in due if 'archive' in changes)
+            return stats
+
+        concurrency = max(1, int(os.getenv('SYNC_CONCURRENCY', '4')))
+        with sync_state.batch(), ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for result in executor.map(lambda item: self.apply(*item), due):
+                for key in result:
+                    stats[key] += 1
+        print(f"\033[92mRetention: {stats['moved']} cards moved, {stats['archived']} archived, {stats['retention_failed']} failed.\033[0m")
+        return stats
+
+    def fetch_status(self, source_id):
+        try:
+            submission = self.ojs_api.getSubmission(source_id)
+        except requests.RequestException as e:
+            if isinstance(e, requests.HTTPError) and e.response is not None and e.response.status_code == 404:
+                # confirmed as removed by the next run
+                return 'missing'
+            print(f"\033[91mStatus of submission ID {source_id} could not be fetched ({e}), checking again in the next run.\033[0m")
+            return None
+        return self.status_names.get(submission.status, str(submission.status))
+
+    def get_changes(self, entry, now):
+        """Card fields to write according to the policy of the status of a retention entry"""
+        rule = self.policy.get(entry['status'], {})
+        changes = {}
+        if rule.get('list') and entry['list_title'] != rule['list']:
+            target_list = self.wekan_api.get_snapshot(self.wekan_api.board_name).find_list(rule['list'])
+            if not target_list:
+                raise ValueError(f"List '{rule['list']}' of the retention policy not found in board '{self.wekan_api.board_name}'.")
+            changes["listId"] = target_list['_id']
+            entry['list_target'] = rule['list']
+        if rule.get('archive_after_days') is not None and now - entry['inactive_since'] >= float(rule['archive_after_days']) * 86400:
+            changes["archive"] = "true"
+        return changes
+
+    def apply(self, entry, changes):
+        """Move or archive the card of an inactive submission, returns the counters to increase"""
+        wekan_api = self.wekan_api
+        snapshot = wekan_api.get_snapshot(wekan_api.board_name)
+        source_id = entry['source_id']
+        try:
+            if self.coordinator:
+                self.coordinator.check('submission', source_id)
+            card = wekan_api.find_mapped_card('submission', source_id, None)
+            if card:
+                wekan_api.call_api('put', f"{wekan_api.base_url}/api/boards/{snapshot.board['_id']}/lists/{card['listId']}/cards/{card['_id']}",
+                                   json_data=changes)
+                wekan_api.count_writes("requests")
+        except Exception as e:
+            traceback.print_exc()
+            print(f"\033[91mRetention of the card of submission ID {source_id} failed ({e}), retrying in the next run.\033[0m")
+            return ["retention_failed"]
+        # a card that was deleted on the board counts as archived
+        result = []
+        if 'listId' in changes:
+            entry['list_title'] = entry.pop('list_target')
+            if card:
+                wekan_api.record_mapping('submission', source_id, snapshot.apply_card(card['_id'], {"listId": changes['listId']}))
+            result.append("moved")
+        if 'archive' in changes or not card:
+            entry['archived_at'] = time.time()
+            if card:
+                snapshot.remove_card(card['_id'])
+            wekan_api.get_sync_state().forget('submission', source_id)
+            result.append("archived")
+        wekan_api.get_sync_state().set_retention(entry)
+        return result
@@ -0,0 +1,104 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Catalogue of the OJS sections, keyed by sectionId.
+# OJS only returns the sections of a journal as part of the issue details, so the details of every issue
+# have to be harvested. The catalogue remembers the last modification of every harvested issue and only
+# fetches the details of new or modified issues, concurrently. If a cache file is configured the catalogue
+# is kept on disk; after OJS_SECTION_CACHE_TTL seconds it is discarded and all issues are harvested again.
+# Issues that are no longer listed are dropped with every refresh, together with the sections that only they
+# listed, so neither the catalogue nor its cache file grows with deleted issues.
+
+class SectionCatalogue:
+
+    def __init__(self, ojs_api, cache_file=None, ttl=None):
+        self.ojs_api = ojs_api
+        self.cache_file = cache_file if cache_file is not None else os.getenv('OJS_SECTION_CACHE', '')
+        self.ttl = float(ttl if ttl is not None else os.getenv('OJS_SECTION_CACHE_TTL', '86400'))
+        self.sections_by_id = {}
+        self.issue_stamps = {}  # issue id -> lastModified of the harvested issue details
+        self.issue_sections = {}  # issue id -> IDs of the sections listed by the harvested issue details
+        self.harvested_at = None
+        self.loaded = False
+
+    def get(self, section_id):
+        return self.sections_by_id.get(section_id)
+
+    def sections(self):
+        return list(self.sections_by_id.values())
+
+    def refresh(self, issues):
+        """Harvest the sections of all new or modified issues of the given Issue records"""
+        self.load()
+        if self.harvested_at is not None and time.time() - self.harvested_at > self.ttl:
+            print("\033[92mSection catalogue expired, harvesting all issues again.\033[0m")
+            self.sections_by_id = {}
+            self.issue_stamps = {}
+            self.issue_sections = {}
+            self.harvested_at = None
+
+        stale = [issue for issue in issues if self.issue_key(issue) not in self.issue_stamps
+                 or self.issue_stamps[self.issue_key(issue)] != issue.last_modified]
+        if stale:
+            with ThreadPoolExecutor(max_workers=max(1, min(self.ojs_api.fetch_concurrency, len(stale)))) as executor:
+                details = executor.map(lambda issue: self.ojs_api.fetch_endpoint(f'issues/{issue.id}'), stale)
+                for issue, issue_details in zip(stale, details):
+                    sections = [section for section in issue_details.get('sections', []) if section.get('id')]
+                    for section in sections:
+                        # sections of a refetched issue replace older copies, e.g. after a section was renamed
+                        self.sections_by_id[section['id']] = section
+                    self.issue_stamps[self.issue_key(issue)] = issue.last_modified
+                    self.issue_sections[self.issue_key(issue)] = [section['id'] for section in sections]
+            if self.harvested_at is None:
+                self.harvested_at = time.time()
+        removed = self.prune({self.issue_key(issue) for issue in issues})
+        print(f"\033[92mHarvested sections of {len(stale)} issues, {len(issues) - len(stale)} issues unchanged, {removed} issues removed.\033[0m")
+        self.save()
+        return self
+
+    def prune(self, issue_keys):
+        """Drop the issues that are not listed any more and the sections no remaining issue lists, returns the number of dropped issues"""
+        removed = [key for key in self.issue_stamps if key not in issue_keys]
+        for key in removed:
+            self.issue_stamps.pop(key, None)
+            self.issue_sections.pop(key, None)
+        listed = {section_id for section_ids in self.issue_sections.values() for section_id in section_ids}
+        self.sections_by_id = {section_id: section for section_id, section in self.sections_by_id.items() if section_id in listed}
+        return len(removed)
+
+    @staticmethod
+    def issue_key(issue):
+        return str(issue.id)
+
+    def load(self):
+        """Load the on-disk catalogue once, if a cache file is configured"""
+        if not self.cache_file or self.loaded:
+            return
+        self.loaded = True
+        if not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"\033[91mIgnoring unreadable section catalogue {self.cache_file}: {e}\033[0m")
+            return
+        if 'issueSections' not in data:
+            # catalogues written before the sections were tracked per issue can't be pruned and are harvested again
+            return
+        self.harvested_at = data.get('harvestedAt')
+        self.issue_stamps = data.get('issues', {})
+        self.issue_sections = data.get('issueSections', {})
+        self.sections_by_id = {section['id']: section for section in data.get('sections', [])}
+
+    def save(self):
+        if not self.cache_file:
+            return
+        data = {'harvestedAt': self.harvested_at, 'issues': self.issue_stamps, 'issueSections': self.issue_sections,
+                'sections': self.sections()}
+        tmp_file = f"{self.cache_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp_file, self.cache_file)
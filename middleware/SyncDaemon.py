@@ -0,0 +1,198 @@
+import os
+import random
+import signal
+import threading
+import time
+import traceback
+from middleware.SyncPlanner import SyncPlanner
+
+# Long-lived synchronization process replacing the one-process-per-iteration loop of run_loop.sh.
+# The API objects (HTTP sessions, Wekan token, publication cache, sync state) stay alive between cycles.
+# Cycles are scheduled in-process: the interval is jittered, shrinks while OJS reports changes and grows
+# while nothing changes. Failed cycles are retried with exponential backoff instead of stopping the loop.
+# With a work queue (see WebhookReceiver) a worker thread additionally synchronizes single submissions and
+# issues as soon as notifications arrive, the periodic full run then only serves as a safety net.
+# With a refresh scheduler (see RefreshScheduler) the cycles between the full runs only refresh the submissions
+# that are due according to their refresh tier, within a request budget per cycle.
+# With a coordinator (see Coordinator) several daemons share the board: before every cycle the daemon rebalances
+# its shard leases and then only synchronizes, refreshes and processes notifications of its own shards.
+# With a delta reader (see BoardDelta) a refresh cycle reads the cards changed by hand on the board every
+# DRIFT_INTERVAL seconds and repairs them, the requests are paid from the budget of the cycle.
+
+class SyncDaemon:
+
+    def __init__(self, wekan_api, ojs_api, interval=None, queue=None, scheduler=None, coordinator=None, delta=None):
+        self.wekan_api = wekan_api
+        self.ojs_api = ojs_api
+        self.queue = queue
+        self.scheduler = scheduler
+        self.coordinator = coordinator
+        self.delta = delta
+        if scheduler and coordinator:
+            scheduler.coordinator = coordinator
+        # full runs and targeted work items share the API objects and must not overlap
+        self.sync_lock = threading.Lock()
+        self.base_interval = float(interval or os.getenv('DAEMON_INTERVAL', '60'))
+        self.min_interval = float(os.getenv('DAEMON_MIN_INTERVAL', '15'))
+        self.max_interval = float(os.getenv('DAEMON_MAX_INTERVAL', '600'))
+        self.jitter = float(os.getenv('DAEMON_JITTER', '0.1'))
+        self.max_backoff = float(os.getenv('DAEMON_MAX_BACKOFF', '900'))
+        self.interval = self.base_interval
+        self.failures = 0
+        self.cycle = 0
+        self.stop_event = threading.Event()
+        self.wake_event = threading.Event()
+
+    def run_forever(self):
+        self.install_signal_handlers()
+        print(f"\033[92mStarting sync daemon with an interval of {self.base_interval:.0f} seconds.\033[0m")
+        if self.coordinator:
+            self.coordinator.start()
+        if self.queue is not None:
+            threading.Thread(target=self.process_queue, daemon=True).start()
+        try:
+            while not self.stop_event.is_set():
+                if self.coordinator and not self.rebalance():
+                    delay = self.jittered(self.coordinator.ttl / 2)
+                elif self.scheduler and not self.scheduler.full_sync_due():
+                    delay = self.run_refresh_cycle()
+                else:
+                    delay = self.run_cycle()
+                print(f"Next synchronization in {delay:.1f} seconds.")
+                self.sleep(delay)
+        finally:
+            if self.coordinator:
+                # the other daemons take the shards over with their next cycle
+                self.coordinator.stop()
+        print("\033[92mSync daemon stopped.\033[0m")
+
+    def rebalance(self):
+        """Renew and rebalance the shard leases before a cycle, returns False if this daemon holds no shard"""
+        try:
+            with self.sync_lock:
+                shards = self.coordinator.rebalance()
+        except Exception as e:
+            traceback.print_exc()
+            print(f"\033[91mLeases could not be renewed ({e}), retrying.\033[0m")
+            return False
+        if not shards:
+            print(f"All {self.coordinator.shards} shards are leased by other workers, waiting for a free shard.")
+            return False
+        if self.scheduler and self.scheduler.coordinator_shards != shards:
+            # shards taken over from a dead worker are not scheduled yet, the next full run fills the schedule
+            self.scheduler.coordinator_shards = shards
+            self.scheduler.last_full_sync = None
+        print(f"\033[92mHolding {self.coordinator.describe()}.\033[0m")
+        return True
+
+    def run_cycle(self):
+        """Run one synchronization and return the delay until the next one"""
+        self.cycle += 1
+        started = time.monotonic()
+        print(f"\033[92m=== Synchronization cycle {self.cycle} - {time.strftime('%Y-%m-%d %H:%M:%S')} ===\033[0m")
+        scheduler = self.scheduler
+        try:
+            with self.sync_lock:
+                if scheduler:
+                    scheduler.begin_full_sync()
+                stats = None
+                try:
+                    stats = self.wekan_api.synchronize(self.ojs_api, observer=scheduler.observe if scheduler else None,
+                                                       coordinator=self.coordinator) or {}
+                finally:
+                    if scheduler:
+                        scheduler.end_full_sync(stats is not None)
+        except Exception as e:
+            self.failures += 1
+            traceback.print_exc()
+            delay = self.backoff_delay()
+            print(f"\033[91mCycle {self.cycle} failed ({e}), retrying in {delay:.1f} seconds.\033[0m")
+            return delay
+
+        self.failures = 0
+        self.adapt_interval(stats.get('changed', 0))
+        print(f"\033[92mCycle {self.cycle} finished in {time.monotonic() - started:.1f} seconds, {stats.get('changed', 0)} objects changed.\033[0m")
+        if scheduler:
+            scheduler.report()
+            return scheduler.next_delay()
+        return self.jittered(self.interval)
+
+    def run_refresh_cycle(self):
+        """Refresh the due submissions of the scheduler and return the delay until the next cycle"""
+        self.cycle += 1
+        print(f"\033[92m=== Refresh cycle {self.cycle} - {time.strftime('%Y-%m-%d %H:%M:%S')} ===\033[0m")
+        try:
+            with self.sync_lock:
+                spent = self.check_drift() if self.delta and self.delta.due() else 0
+                self.scheduler.refresh(spent)
+        except Exception as e:
+            self.failures += 1
+            traceback.print_exc()
+            delay = self.backoff_delay()
+            print(f"\033[91mRefresh cycle {self.cycle} failed ({e}), retrying in {delay:.1f} seconds.\033[0m")
+            return delay
+        self.failures = 0
+        return self.scheduler.next_delay()
+
+    def check_drift(self):
+        """Repair the cards changed on the board within the refresh budget, returns the number of requests spent"""
+        metrics = self.wekan_api.metrics
+        requests_before = metrics.request_count()
+        # the board is read again, the changed cards are compared with the current board
+        planner = SyncPlanner(self.wekan_api, self.ojs_api, coordinator=self.coordinator)
+        with metrics.span('read_board'):
+            planner.read_board()
+        self.delta.repair(self.ojs_api, planner)
+        return metrics.request_count() - requests_before
+
+    def process_queue(self):
+        """Worker loop synchronizing the objects named by queued notifications"""
+        while not self.stop_event.is_set():
+            for kind, source_id in self.queue.get_batch(timeout=1):
+                if self.coordinator and kind in ('submission', 'issue') and not self.coordinator.owns(kind, source_id):
+                    # the daemon holding the shard receives the notification too or repairs the card in its next run
+                    continue
+                print(f"\033[92mProcessing notification: resync {kind} {source_id}\033[0m")
+                try:
+                    with self.sync_lock:
+                        if kind == 'submission':
+                            self.wekan_api.synchronizeSubmission(self.ojs_api, int(source_id))
+                        elif kind == 'issue':
+                            self.wekan_api.synchronizeIssue(self.ojs_api, int(source_id))
+                        else:
+                            # the journal card or unknown objects are repaired by the next full run
+                            self.wake()
+                except Exception as e:
+                    traceback.print_exc()
+                    print(f"\033[91mNotification for {kind} {source_id} failed ({e}), left to the next full run.\033[0m")
+
+    def adapt_interval(self, changed):
+        """Poll more often while OJS reports changes, back off slowly while everything is unchanged"""
+        if changed:
+            self.interval = max(self.min_interval, self.interval / 2)
+        else:
+            self.interval = min(self.max_interval, self.interval * 1.5)
+
+    def backoff_delay(self):
+        return self.jittered(min(self.max_backoff, self.min_interval * (2 ** (self.failures - 1))))
+
+    def jittered(self, delay):
+        # spread the cycles so several daemons don't hit OJS and Wekan at the same moment
+        return max(0.0, delay * (1 + random.uniform(-self.jitter, self.jitter)))
+
+    def sleep(self, delay):
+        """Wait for the next cycle, wake() or stop() end the wait early"""
+        self.wake_event.wait(delay)
+        self.wake_event.clear()
+
+    def wake(self):
+        self.wake_event.set()
+
+    def stop(self, *args):
+        self.stop_event.set()
+        self.wake_event.set()
+
+    def install_signal_handlers(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, self.stop)
+            signal.signal(signal.SIGINT, self.stop)
@@ -0,0 +1,154 @@
+import asyncio
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from middleware.BoardDelta import BoardDelta
+from middleware.Coordination import LeaseLost
+from middleware.Retention import RetentionPass
+from middleware.SyncPlanner import SyncPlanner
+
+# Asynchronous synchronization engine.
+# A run reads the board and OJS at the same time, plans all card operations (see SyncPlanner) and applies them.
+# Most of the time is spent waiting for Wekan, so the operations are applied concurrently, at most
+# SYNC_CONCURRENCY at a time. OJSAPI and WekanAPI are blocking clients, their calls are handed to a thread pool of
+# the same size (see ThreadPoolCalls), the engine itself only schedules and awaits them.
+# Ordering guarantees:
+#   - the levels of the plan are applied one after another: the journal card, then the issue cards, then the
+#     submission cards, so every card can be linked to its parent card right away
+#   - every card is written by exactly one operation, which writes and links it with one edit
+# A failing operation is reported and counted, the other operations are still applied. Its state is not
+# recorded, so it is synchronized again in the next run.
+# The phases of a run (read_board, issues_and_sections, plan, apply_journal, apply_issue, apply_submission) are recorded as spans in the
+# metrics registry (see Metrics), the run summary is available from Metrics.run_summary() afterwards.
+# With RETENTION_ENABLED the cards of submissions that left the queue are moved or archived after the
+# levels are applied (see RetentionPass), the active submissions are taken from the plan.
+# With DRIFT_ENABLED the cards changed by hand on the board since the last check are read after the board, at most
+# every DRIFT_INTERVAL seconds (see BoardDelta), they are re-checked and repaired even if their OJS source is unchanged.
+# With a coordinator only the objects of the shards leased by this worker are planned and written, a card whose
+# lease was lost in the meantime is skipped and left to the new holder of its shard (see Coordinator).
+
+class ThreadPoolCalls:
+    """Awaitable calls of the blocking API methods, run on the thread pool of the engine"""
+
+    def __init__(self, executor):
+        self.executor = executor
+
+    async def call(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+
+class SyncEngine:
+
+    def __init__(self, wekan_api, ojs_api, concurrency=None, observer=None, coordinator=None):
+        self.wekan_api = wekan_api
+        self.ojs_api = ojs_api
+        self.observer = observer
+        self.coordinator = coordinator
+        self.concurrency = max(1, int(concurrency or os.getenv('SYNC_CONCURRENCY', '4')))
+        retention = os.getenv('RETENTION_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+        self.retention = RetentionPass(wekan_api, ojs_api) if retention else None
+        drift = os.getenv('DRIFT_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+        self.delta = BoardDelta(wekan_api) if drift and wekan_api.get_sync_state() else None
+
+    def run(self, dry_run=False):
+        """Run one synchronization, returns the number of changed and unchanged objects"""
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.synchronize(dry_run))
+        # asyncio.run can't be nested in a running event loop (e.g. a notebook or an async caller), the run gets a
+        # loop of its own in a separate thread; the calling loop is blocked until it finishes, async callers
+        # should await synchronize() instead
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(asyncio.run, self.synchronize(dry_run)).result()
+
+    async def synchronize(self, dry_run=False):
+        metrics = self.wekan_api.metrics
+        metrics.begin_run()
+        stats = None
+        try:
+            stats = await self.synchronize_plan(dry_run)
+            return stats
+        finally:
+            metrics.end_run(stats)
+
+    async def timed(self, phase, awaitable):
+        with self.wekan_api.metrics.span(phase):
+            return await awaitable
+
+    async def synchronize_plan(self, dry_run):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            calls = ThreadPoolCalls(executor)
+            planner = SyncPlanner(self.wekan_api, self.ojs_api, observer=self.observer, coordinator=self.coordinator)
+            semaphore = asyncio.Semaphore(self.concurrency)
+
+            # read the board and the OJS issues at the same time, then plan the card operations
+            # while the submissions are streamed from OJS
+            await asyncio.gather(
+                self.timed('read_board', calls.call(planner.read_board)),
+                self.timed('issues_and_sections', calls.call(self.ojs_api.getIssuesAndSections))
+            )
+            if self.delta and self.delta.due():
+                await self.poll_delta(calls)
+            plan = await self.timed('plan', calls.call(planner.build))
+            plan.print(verbose=self.wekan_api.DEBUG)
+            # number of objects written in this run, reported to the caller (e.g. the sync daemon)
+            stats = {"changed": 0, "unchanged": plan.count('unchanged'), "planned_requests": plan.requests()}
+            active_ids = [operation.source_id for operation in plan.operations if operation.kind == 'submission']
+            if dry_run:
+                stats["changed"] = len(plan.operations) - stats["unchanged"]
+                stats.update(await self.retain(calls, active_ids, dry_run))
+                return stats
+
+            async def apply(operation):
+                async with semaphore:
+                    try:
+                        await calls.call(planner.apply, operation)
+                    except LeaseLost as e:
+                        print(f"\033[91m{e}\033[0m")
+                        return "skipped"
+                    except Exception as e:
+                        traceback.print_exc()
+                        print(f"\033[91mSynchronization of {operation.kind} ID {operation.source_id} failed ({e}), retrying in the next run.\033[0m")
+                        return "failed"
+                    return "changed"
+
+            # the levels are applied one after another, the cards of a level concurrently
+            for operations in plan.levels():
+                changed = [operation for operation in operations if operation.action != 'unchanged']
+                results = await self.timed(f"apply_{operations[0].kind}", asyncio.gather(*(apply(operation) for operation in changed)))
+                for result in results:
+                    stats[result] = stats.get(result, 0) + 1
+            stats.update(await self.retain(calls, active_ids, dry_run))
+            if self.delta and not stats.get('failed') and not stats.get('skipped'):
+                # failed cards are checked again with the next run
+                await calls.call(self.delta.commit)
+
+        self.wekan_api.report_write_stats()
+        self.report_limits()
+        stats.update(self.wekan_api.write_stats)
+        return stats
+
+    async def poll_delta(self, calls):
+        try:
+            await self.timed('board_delta', calls.call(self.delta.poll))
+        except Exception as e:
+            # the run still compares all cards with the board listing, the changes are read again with the next run
+            traceback.print_exc()
+            print(f"\033[91mBoard cards could not be checked ({e}), checking them again in the next run.\033[0m")
+            self.delta.pending_mark = None
+
+    async def retain(self, calls, active_ids, dry_run):
+        if not self.retention:
+            return {}
+        try:
+            return await self.timed('retention', calls.call(self.retention.run, active_ids, dry_run, self.coordinator))
+        except Exception as e:
+            traceback.print_exc()
+            print(f"\033[91mRetention pass failed ({e}), retrying in the next run.\033[0m")
+            return {"retention_failed": 1}
+
+    def report_limits(self):
+        for limits in self.wekan_api.http.limits():
+            print(f"\033[92mHTTP limits of {limits['host']}: concurrency {limits['concurrency']}/{limits['maxConcurrency']}, "
+                  f"{limits['throttled']} times throttled, {limits['errors']} errors.\033[0m")
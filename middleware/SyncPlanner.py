@@ -0,0 +1,208 @@
+import json
+import os
+
+# Reconciliation planner.
+# The desired board state (cards, lists, parent cards and the custom field Title) is rendered from OJS and
+# compared with one snapshot of the board. The result is a plan of card operations in dependency order:
+# the journal card first, then the issue cards, then the submission cards, so every parent card exists
+# before the cards linked to it are written. Each operation knows how many write requests it needs, so a
+# dry run can print the plan and its cost without changing the board.
+
+# placeholder for the ID of a parent card that is created by an earlier operation of the same plan
+NEW_PARENT_CARD = '(new card)'
+
+
+class CardOperation:
+
+    def __init__(self, kind, source_id, source_stamp, rendered_card, level, color=None, checklist=None):
+        self.kind = kind
+        self.source_id = source_id
+        self.source_stamp = source_stamp
+        self.rendered_card = rendered_card
+        self.level = level
+        self.color = color
+        self.checklist = checklist
+        self.action = 'unchanged'  # create, update or unchanged
+        self.card = None
+        self.changes = {}
+
+    def requests(self):
+        """Number of write requests needed to apply the operation"""
+        if self.action == 'create':
+            # create the card, set color, custom field and parent with one edit, add the checklist
+            return 1 + (1 if self.changes else 0) + (1 if self.checklist else 0)
+        if self.action == 'update':
+            return 1
+        return 0
+
+    def describe(self):
+        description = f"{self.action:9} {self.kind} {self.source_id}: '{self.rendered_card['card_title']}'"
+        if self.action != 'unchanged' and self.changes:
+            description += f" ({', '.join(sorted(self.changes))})"
+        return description
+
+
+class SyncPlan:
+
+    def __init__(self, operations, custom_field_missing=False):
+        self.operations = operations
+        # creating the custom field Title costs one request and one listing of the field definitions
+        self.custom_field_missing = custom_field_missing
+
+    def levels(self):
+        """Operations grouped by dependency level, parents first"""
+        levels = {}
+        for operation in self.operations:
+            levels.setdefault(operation.level, []).append(operation)
+        return [levels[level] for level in sorted(levels)]
+
+    def count(self, action):
+        return sum(1 for operation in self.operations if operation.action == action)
+
+    def requests(self):
+        """Expected number of HTTP requests to apply the plan"""
+        return sum(operation.requests() for operation in self.operations) + (2 if self.custom_field_missing else 0)
+
+    def print(self, verbose=False):
+        for operation in self.operations:
+            if verbose or operation.action != 'unchanged':
+                print(operation.describe())
+        if self.custom_field_missing:
+            print("create    custom field 'Title'")
+        print(f"\033[92mPlan: {self.count('create')} cards to create, {self.count('update')} to update, {self.count('unchanged')} unchanged, "
+              f"{self.requests()} HTTP requests expected.\033[0m")
+
+
+class SyncPlanner:
+
+    def __init__(self, wekan_api, ojs_api, checklists=True, observer=None, coordinator=None):
+        self.wekan_api = wekan_api
+        self.ojs_api = ojs_api
+        # new cards get the checklist templates, bulk runs can leave them out to save a request per card
+        self.checklists = checklists
+        # called with every streamed active submission, e.g. by the refresh scheduler of the daemon
+        self.observer = observer
+        # with several workers only the objects of the shards leased by this worker are planned (see Coordinator)
+        self.coordinator = coordinator
+
+    def read_board(self):
+        """Load the board snapshot, the cards of the journal swimlane and the custom field definitions"""
+        wekan_api = self.wekan_api
+        wekan_api.begin_run()
+        snapshot = wekan_api.get_snapshot(wekan_api.board_name)
+        if not snapshot.board:
+            raise ValueError(f"Board '{wekan_api.board_name}' not found.")
+        swimlane = snapshot.find_swimlane(wekan_api.swimlane_name)
+        if swimlane:
+            snapshot.cards(swimlane['_id'])
+
+    def build(self):
+        """Render the desired state from the fetched OJS data and compare it with the board snapshot"""
+        wekan_api = self.wekan_api
+        print(f"\033[92mCollected {len(self.ojs_api.sections)} unique sections from issues.\033[0m")
+        journal_name = wekan_api.get_journal_name()
+        operations = [self.plan_journal(journal_name)] if self.owns('journal', journal_name) else []
+        for issue in self.ojs_api.future_issues:
+            if self.owns('issue', issue.id):
+                operations.append(self.plan_issue(journal_name, issue, set()))
+        # parent cards that don't exist yet are created by the operations of the previous levels
+        # the submissions are streamed from OJS, only the rendered cards are kept in the plan
+        new_cards = {(operation.kind, str(operation.source_id)) for operation in operations if operation.action == 'create'}
+        for submission in self.ojs_api.iterSubmissions():
+            if not self.owns('submission', submission.id):
+                continue
+            operations.append(self.plan_submission(journal_name, submission, new_cards))
+            if self.observer:
+                self.observer(submission)
+        title_field_missing = any(operation.action != 'unchanged' for operation in operations) and not self.find_title_field()
+        return SyncPlan(operations, custom_field_missing=title_field_missing)
+
+    def owns(self, kind, source_id):
+        return self.coordinator is None or self.coordinator.owns(kind, source_id)
+
+    def plan_journal(self, journal_name):
+        return self.plan_card('journal', journal_name, None, self.wekan_api.render_journal(journal_name), 0, set(),
+                              color="blue", checklist=self.checklist('CHECKLIST_TEMPLATE_JOURNAL'))
+
+    def plan_issue(self, journal_name, issue, new_cards):
+        return self.plan_card('issue', issue.id, issue.last_modified, self.wekan_api.render_issue(journal_name, issue), 1, new_cards,
+                              color="green", checklist=self.checklist('CHECKLIST_TEMPLATE_ISSUE'))
+
+    def plan_submission(self, journal_name, submission, new_cards):
+        wekan_api = self.wekan_api
+        return self.plan_card('submission', submission.id, wekan_api.get_submission_stamp(submission),
+                              wekan_api.render_submission(self.ojs_api, journal_name, submission), 2, new_cards,
+                              checklist=self.checklist('CHECKLIST_TEMPLATE_SUBMISSION'))
+
+    def checklist(self, template):
+        return json.loads(os.getenv(template, {})) if self.checklists else None
+
+    def find_title_field(self):
+        # the field definitions are only listed if a card has to be compared or written
+        snapshot = self.wekan_api.get_snapshot(self.wekan_api.board_name)
+        return self.wekan_api.get_custom_fields(snapshot.board['_id']).find('Title')
+
+    def plan_card(self, kind, source_id, source_stamp, rendered_card, level, new_cards, color=None, checklist=None):
+        wekan_api = self.wekan_api
+        operation = CardOperation(kind, source_id, source_stamp, rendered_card, level, color=color, checklist=checklist)
+        if wekan_api.is_unchanged(kind, source_id, source_stamp, rendered_card):
+            return operation
+
+        snapshot = wekan_api.get_snapshot(wekan_api.board_name)
+        swimlane = snapshot.find_swimlane(wekan_api.swimlane_name)
+        target_list = snapshot.find_list(rendered_card['list_title'])
+        if not swimlane or not target_list:
+            raise ValueError(f"Swimlane '{wekan_api.swimlane_name}' or list '{rendered_card['list_title']}' not found in board '{wekan_api.board_name}'.")
+
+        parent_id = None
+        if rendered_card.get('parent'):
+            parent_kind, parent_source_id = rendered_card['parent']
+            parent_card = wekan_api.find_parent_card(rendered_card)
+            if parent_card:
+                parent_id = parent_card['_id']
+            elif (parent_kind, str(parent_source_id)) in new_cards:
+                parent_id = NEW_PARENT_CARD
+        title_field = self.find_title_field()
+        custom_fields = [{"_id": title_field['_id'] if title_field else None, "value": rendered_card['title']}]
+
+        card = wekan_api.find_mapped_card(kind, source_id, rendered_card['card_title'])
+        operation.card = card
+        if card:
+            if 'customFields' not in card:
+                card = wekan_api.apply_written_fields(snapshot, card, {"customFields": custom_fields, "parentId": parent_id})
+            operation.changes = wekan_api.get_card_changes(
+                card, snapshot.board, swimlane, target_list, rendered_card['card_title'], rendered_card['card_description'], custom_fields, parent_id
+            )
+            operation.action = 'update' if operation.changes else 'unchanged'
+        else:
+            operation.action = 'create'
+            operation.changes = {key: value for key, value in (("color", color), ("customFields", custom_fields), ("parentId", parent_id)) if value}
+        return operation
+
+    def apply(self, operation):
+        """Write the card of a planned operation, parent cards are resolved now that earlier levels are applied"""
+        if operation.action == 'unchanged':
+            return operation.card
+        wekan_api = self.wekan_api
+        rendered_card = operation.rendered_card
+        if self.coordinator:
+            # fencing: the card is only written while this worker still holds the lease of its shard
+            self.coordinator.check(operation.kind, operation.source_id)
+        print(f"\033[92mSynchronizing {operation.kind} ID {operation.source_id} with title '{rendered_card['title']}'\033[0m")
+        with wekan_api.metrics.card_span(operation.kind, operation.source_id, operation.action):
+            parent_card = wekan_api.find_parent_card(rendered_card)
+            card = wekan_api.synchronizeCard(
+                card_id=operation.card['_id'] if operation.card else None,
+                parent_id=parent_card['_id'] if parent_card else None,
+                board_title=wekan_api.board_name,
+                swimlane_title=wekan_api.swimlane_name,
+                list_title=rendered_card['list_title'],
+                card_title=rendered_card['card_title'],
+                card_description=rendered_card['card_description'],
+                title=rendered_card['title'],
+                color=operation.color,
+                checklist=operation.checklist
+            )
+            wekan_api.record_mapping(operation.kind, operation.source_id, card)
+            wekan_api.record_sync_state(operation.kind, operation.source_id, operation.source_stamp, rendered_card, card)
+        return card
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# Local SQLite store of the last synchronized state of every OJS object.
+# Per journal, issue and submission it keeps the last seen OJS modification stamp, a hash of the rendered
+# card payload and the ID of the Wekan card, so unchanged objects can be skipped in incremental runs.
+# The card mapping table relates OJS objects to their Wekan card, list and swimlane IDs and is used
+# to find cards independently of their (changeable) titles.
+# The card fields table keeps a hash of the last written card fields that the Wekan card listing doesn't return
+# (custom fields, parent), so unchanged values don't have to be written again.
+# The card retention table keeps the submissions whose cards are mapped but that left the OJS queue: their
+# status, since when they are inactive, the list their card was moved to and when it was archived.
+# The board delta table keeps the high-water mark of the board changes read by the delta reader, the card
+# overrides table the fields of cards changed on the board that the board wins for (see BoardDelta).
+# Every write is committed on its own, unless it is made inside batch(): bulk runs like the backfill commit
+# the state of all cards of a batch in one transaction.
+
+class SyncState:
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self.batch_depth = 0
+        with self.lock, self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    kind TEXT NOT NULL,
+                    source_id TEXT NOT NULL,
+                    source_stamp TEXT,
+                    payload_hash TEXT NOT NULL,
+                    card_id TEXT,
+                    synchronized_at REAL NOT NULL,
+                    PRIMARY KEY (kind, source_id)
+                )
+            """)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS card_mapping (
+                    kind TEXT NOT NULL,
+                    source_id TEXT NOT NULL,
+                    board_id TEXT NOT NULL,
+                    swimlane_id TEXT,
+                    list_id TEXT,
+                    card_id TEXT NOT NULL,
+                    PRIMARY KEY (kind, source_id)
+                )
+            """)
+            self.connection.execute("CREATE INDEX IF NOT EXISTS card_mapping_card_id ON card_mapping (card_id)")
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS card_fields (
+                    card_id TEXT PRIMARY KEY,
+                    fields_hash TEXT NOT NULL
+                )
+            """)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS card_retention (
+                    kind TEXT NOT NULL,
+                    source_id TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    inactive_since REAL NOT NULL,
+                    checked_at REAL NOT NULL,
+                    list_title TEXT,
+                    archived_at REAL,
+                    PRIMARY KEY (kind, source_id)
+                )
+            """)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS board_delta (
+                    board_id TEXT PRIMARY KEY,
+                    high_water_mark TEXT NOT NULL,
+                    checked_at REAL NOT NULL
+                )
+            """)
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS card_overrides (
+                    card_id TEXT NOT NULL,
+                    field TEXT NOT NULL,
+                    ojs_value TEXT,
+                    PRIMARY KEY (card_id, field)
+                )
+            """)
+
+    @contextmanager
+    def batch(self):
+        """Commit the writes made inside the block in one transaction"""
+        with self.lock:
+            self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            # also committed if a card of the batch failed, the state of the written cards is kept
+            with self.lock:
+                self.batch_depth -= 1
+                if not self.batch_depth:
+                    self.connection.commit()
+
+    def write(self, statement, parameters):
+        with self.lock:
+            self.connection.execute(statement, parameters)
+            if not self.batch_depth:
+                self.connection.commit()
+
+    @staticmethod
+    def hash_payload(payload):
+        """Stable hash of a rendered card payload"""
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, kind, source_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM sync_state WHERE kind = ? AND source_id = ?", (kind, str(source_id))
+            ).fetchone()
+        return dict(row) if row else None
+
+    def record(self, kind, source_id, source_stamp, payload, card_id):
+        self.write(
+            "INSERT OR REPLACE INTO sync_state (kind, source_id, source_stamp, payload_hash, card_id, synchronized_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, str(source_id), source_stamp, self.hash_payload(payload), card_id, time.time())
+        )
+
+    def get_mapping(self, kind, source_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT * FROM card_mapping WHERE kind = ? AND source_id = ?", (kind, str(source_id))
+            ).fetchone()
+        return dict(row) if row else None
+
+    def find_mapping_by_card(self, card_id):
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM card_mapping WHERE card_id = ?", (card_id,)).fetchone()
+        return dict(row) if row else None
+
+    def set_mapping(self, kind, source_id, board_id, swimlane_id, list_id, card_id):
+        self.write(
+            "INSERT OR REPLACE INTO card_mapping (kind, source_id, board_id, swimlane_id, list_id, card_id) VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, str(source_id), board_id, swimlane_id, list_id, card_id)
+        )
+
+    def get_mappings(self, kind):
+        with self.lock:
+            rows = self.connection.execute("SELECT * FROM card_mapping WHERE kind = ?", (kind,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_card_fields_hash(self, card_id):
+        with self.lock:
+            row = self.connection.execute("SELECT fields_hash FROM card_fields WHERE card_id = ?", (card_id,)).fetchone()
+        return row['fields_hash'] if row else None
+
+    def set_card_fields(self, card_id, fields):
+        self.write(
+            "INSERT OR REPLACE INTO card_fields (card_id, fields_hash) VALUES (?, ?)", (card_id, self.hash_payload(fields))
+        )
+
+    def get_retention(self, kind):
+        """Retention entries of the inactive objects of a kind, keyed by source ID"""
+        with self.lock:
+            rows = self.connection.execute("SELECT * FROM card_retention WHERE kind = ?", (kind,)).fetchall()
+        return {row['source_id']: dict(row) for row in rows}
+
+    def set_retention(self, entry):
+        self.write(
+            "INSERT OR REPLACE INTO card_retention (kind, source_id, status, inactive_since, checked_at, list_title, archived_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (entry['kind'], str(entry['source_id']), entry['status'], entry['inactive_since'], entry['checked_at'], entry['list_title'], entry['archived_at'])
+        )
+
+    def remove_retention(self, kind, source_id):
+        self.write("DELETE FROM card_retention WHERE kind = ? AND source_id = ?", (kind, str(source_id)))
+
+    def get_high_water_mark(self, board_id):
+        with self.lock:
+            row = self.connection.execute("SELECT high_water_mark FROM board_delta WHERE board_id = ?", (board_id,)).fetchone()
+        return row['high_water_mark'] if row else None
+
+    def get_delta_checked_at(self, board_id):
+        """Time the high-water mark of a board was last advanced, None before the first check"""
+        with self.lock:
+            row = self.connection.execute("SELECT checked_at FROM board_delta WHERE board_id = ?", (board_id,)).fetchone()
+        return row['checked_at'] if row else None
+
+    def set_high_water_mark(self, board_id, high_water_mark):
+        self.write(
+            "INSERT OR REPLACE INTO board_delta (board_id, high_water_mark, checked_at) VALUES (?, ?, ?)", (board_id, high_water_mark, time.time())
+        )
+
+    def get_override(self, card_id, field):
+        """OJS value of a card field at the time the board change of the field was kept, None if there is no override"""
+        with self.lock:
+            row = self.connection.execute("SELECT ojs_value FROM card_overrides WHERE card_id = ? AND field = ?", (card_id, field)).fetchone()
+        return row['ojs_value'] if row else None
+
+    def set_override(self, card_id, field, ojs_value):
+        self.write("INSERT OR REPLACE INTO card_overrides (card_id, field, ojs_value) VALUES (?, ?, ?)", (card_id, field, ojs_value))
+
+    def remove_override(self, card_id, field):
+        self.write("DELETE FROM card_overrides WHERE card_id = ? AND field = ?", (card_id, field))
+
+    def forget(self, kind, source_id):
+        """Drop the synchronized state of an archived card, its mapping is kept in case the object becomes active again"""
+        self.write("DELETE FROM sync_state WHERE kind = ? AND source_id = ?", (kind, str(source_id)))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,188 @@
+import json
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+
+# Multi-tenant synchronization: many OJS journals (contexts) synchronized to their boards and swimlanes.
+# The tenants are read from a JSON file (TENANTS_FILE). Every tenant is a name plus settings that override
+# the .env file while the tenant is synchronized, e.g.
+#   {"defaults": {"DEMO_BOARD_NAME": "Zeitschriften"},
+#    "tenants": [{"name": "mrm", "OJS_URL": "https://ojs.example.org/index.php/mrm", "SYNC_SWIMLANE": "Zeitschriften"},
+#                {"name": "reihe", "OJS_URL": "https://ojs.example.org/index.php/reihe", "SYNC_SWIMLANE": "Schriftenreihen",
+#                 "JOURNAL_NAME": "REIHE"}]}
+# Isolation and sharing:
+#   - caches: the sync state, publication cache and section catalogue get a file per tenant (the tenant name
+#     is added to the configured file name), unless the tenant sets its own files
+#   - logins: tenants with the same Wekan URL and user share one login, the runner logs in once and hands the
+#     token to the workers (TENANT_SHARED_LOGIN="false" lets every tenant log in by itself)
+#   - metrics and HTTP transport: the process wide registry and transport are built again for every tenant, so
+#     the HTTP_* settings (pool sizes, rate limits, cassette) of a tenant apply to its own requests and every
+#     tenant gets its own run summary, the runner combines them in one summary
+#   - list and swimlane names: PROCESS_GROUP_* and SYNC_SWIMLANE / PRODUCT_GROUP_JOURNALS are read by every
+#     WekanAPI instance, so they can be set per tenant
+# The tenants are sharded by board: tenants writing to the same board run one after another in the same
+# worker process, different boards are synchronized in parallel by up to TENANT_WORKERS processes.
+
+ISOLATED_FILES = ('SYNC_STATE_FILE', 'OJS_PUBLICATION_CACHE', 'OJS_SECTION_CACHE')
+
+
+@dataclass
+class Tenant:
+    name: str
+    settings: dict = field(default_factory=dict)
+
+    def setting(self, key, default=''):
+        return self.settings.get(key, os.getenv(key, default))
+
+    def shard_key(self):
+        """Tenants on the same board must not be synchronized at the same time"""
+        return (self.setting('WEKAN_URL'), self.setting('DEMO_BOARD_NAME', 'Testboard'))
+
+    def login_key(self):
+        return (self.setting('WEKAN_URL'), self.setting('WEKAN_USERNAME'))
+
+    def environment(self):
+        """Settings of the tenant including the per tenant cache files"""
+        settings = dict(self.settings)
+        for key in ISOLATED_FILES:
+            if key not in settings and os.getenv(key):
+                root, extension = os.path.splitext(os.getenv(key))
+                settings[key] = f"{root}.{self.name}{extension}"
+        return {key: str(value) for key, value in settings.items()}
+
+
+def load_tenants(path=None):
+    """Read the tenants from the tenants file, the defaults apply to every tenant"""
+    path = path or os.getenv('TENANTS_FILE', 'tenants.json')
+    with open(path, encoding='utf-8') as f:
+        data = json.load(f)
+    defaults = data.get('defaults', {})
+    tenants = []
+    for entry in data.get('tenants', []):
+        entry = dict(entry)
+        name = entry.pop('name', None)
+        if not name:
+            raise ValueError(f"Tenant without name in {path}: {entry}")
+        if any(tenant.name == name for tenant in tenants):
+            raise ValueError(f"Tenant '{name}' is defined twice in {path}")
+        tenants.append(Tenant(name, {**defaults, **entry}))
+    return tenants
+
+
+@contextmanager
+def tenant_environment(settings):
+    """Apply the settings of a tenant to the environment and restore the previous values afterwards"""
+    previous = {key: os.environ.get(key) for key in settings}
+    os.environ.update(settings)
+    try:
+        yield
+    finally:
+        for key, value in previous.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+
+
+def run_shard(shard, dry_run=False):
+    """Synchronize the tenants of one shard one after another, runs in a worker process"""
+    results = []
+    for name, settings in shard:
+        print(f"\033[92m=== Tenant {name} (process {os.getpid()}) ===\033[0m")
+        started = time.monotonic()
+        with tenant_environment(settings):
+            from middleware.HttpTransport import reset_transport
+            from middleware.Metrics import get_metrics, reset_metrics
+            from middleware.OJSAPI import OJSAPI
+            from middleware.WekanAPI import WekanAPI
+            # the singletons of the previous tenant of this worker were built from its settings
+            reset_transport()
+            reset_metrics()
+            try:
+                stats = WekanAPI().synchronize(OJSAPI(), dry_run=dry_run)
+                results.append({"tenant": name, "result": "ok", "seconds": round(time.monotonic() - started, 3),
+                                "stats": stats, "summary": get_metrics().run_summary()})
+            except Exception as e:
+                traceback.print_exc()
+                print(f"\033[91mSynchronization of tenant {name} failed: {e}\033[0m")
+                results.append({"tenant": name, "result": "failed", "seconds": round(time.monotonic() - started, 3), "error": str(e)})
+    return results
+
+
+class ShardedRunner:
+
+    def __init__(self, tenants, workers=None, shared_login=None):
+        self.tenants = tenants
+        self.workers = max(1, int(workers or os.getenv('TENANT_WORKERS', '4')))
+        self.shared_login = (shared_login if shared_login is not None
+                             else os.getenv('TENANT_SHARED_LOGIN', 'true').lower() in ('1', 'true', 'yes'))
+
+    def shards(self):
+        """Tenants grouped by board, as (name, settings) pairs that can be sent to a worker process"""
+        logins = self.login() if self.shared_login else {}
+        shards = {}
+        for tenant in self.tenants:
+            settings = tenant.environment()
+            settings.update(logins.get(tenant.login_key(), {}))
+            shards.setdefault(tenant.shard_key(), []).append((tenant.name, settings))
+        return list(shards.values())
+
+    def login(self):
+        """Log in once per Wekan URL and user, returns the token settings per login"""
+        from middleware.WekanAPI import WekanAPI
+        logins = {}
+        for tenant in self.tenants:
+            key = tenant.login_key()
+            if key in logins or 'WEKAN_TOKEN' in tenant.settings:
+                continue
+            with tenant_environment(tenant.environment()):
+                wekan_api = WekanAPI()
+                wekan_api.ensure_login()
+                logins[key] = {"WEKAN_TOKEN": wekan_api.token, "WEKAN_USER_ID": wekan_api.user_id}
+        return logins
+
+    def run(self, dry_run=False):
+        """Synchronize all tenants, returns the results per tenant"""
+        shards = self.shards()
+        workers = min(self.workers, len(shards)) or 1
+        print(f"\033[92mSynchronizing {len(self.tenants)} tenants on {len(shards)} boards with {workers} worker processes.\033[0m")
+        results = []
+        # every shard gets a fresh process, nothing of the tenants of an earlier shard is left in it
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, max_tasks_per_child=1) as executor:
+            futures = {executor.submit(run_shard, shard, dry_run): shard for shard in shards}
+            for future in as_completed(futures):
+                try:
+                    results.extend(future.result())
+                except Exception as e:
+                    # the worker process died, e.g. killed by the OS
+                    results.extend({"tenant": name, "result": "failed", "error": str(e)} for name, _ in futures[future])
+        return sorted(results, key=lambda result: result['tenant'])
+
+    @staticmethod
+    def report(results):
+        for result in results:
+            stats = result.get('stats') or {}
+            if result['result'] == 'ok':
+                print(f"\033[92mTenant {result['tenant']}: {stats.get('changed', 0)} changed, {stats.get('unchanged', 0)} unchanged, "
+                      f"{stats.get('failed', 0)} failed in {result['seconds']:.1f} seconds.\033[0m")
+            else:
+                print(f"\033[91mTenant {result['tenant']} failed: {result.get('error')}\033[0m")
+
+    @staticmethod
+    def write_summary(results, path):
+        """Combined run summary of all tenants"""
+        totals = {}
+        for result in results:
+            for key, value in (result.get('stats') or {}).items():
+                totals[key] = totals.get(key, 0) + value
+        summary = {"tenants": {result['tenant']: result for result in results}, "totals": totals,
+                   "failedTenants": [result['tenant'] for result in results if result['result'] != 'ok']}
+        tmp_file = f"{path}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+        os.replace(tmp_file, path)
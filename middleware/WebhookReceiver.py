@@ -0,0 +1,181 @@
+import heapq
+import hmac
+import json
+import os
+import threading
+import time
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# Local HTTP receiver for push notifications.
+#
+#   POST /webhooks/wekan   Wekan outgoing webhook (board integration), identifies the changed card by cardId
+#   POST /webhooks/ojs     OJS notification / plugin callback: {"type": "submission" | "issue", "id": 123}
+#
+# Every notification is turned into a targeted work item ("resync submission 123", "relink issue 7") on a
+# coalescing queue. Repeated notifications for the same object within WEBHOOK_COALESCE_DELAY seconds are
+# merged into one work item.
+# The token is checked before the body is read, and bodies larger than WEBHOOK_MAX_BODY bytes are refused
+# without reading them, so unauthenticated or oversized requests cost the receiver nothing.
+
+class WorkQueue:
+
+    def __init__(self, delay=None):
+        self.delay = float(delay if delay is not None else os.getenv('WEBHOOK_COALESCE_DELAY', '2'))
+        self.pending = {}  # (kind, source_id) -> due time
+        self.due = []  # heap of (due time, kind, source_id)
+        self.condition = threading.Condition()
+
+    def put(self, kind, source_id):
+        """Queue a work item, returns False if it was merged into a pending one"""
+        key = (kind, str(source_id))
+        with self.condition:
+            if key in self.pending:
+                return False
+            due = time.monotonic() + self.delay
+            self.pending[key] = due
+            heapq.heappush(self.due, (due, kind, str(source_id)))
+            self.condition.notify()
+            return True
+
+    def get_batch(self, timeout=None):
+        """Wait for work items that are due and return all of them"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.due and self.due[0][0] <= now:
+                    batch = []
+                    while self.due and self.due[0][0] <= now:
+                        _, kind, source_id = heapq.heappop(self.due)
+                        del self.pending[(kind, source_id)]
+                        batch.append((kind, source_id))
+                    return batch
+                wait = self.due[0][0] - now if self.due else None
+                if deadline is not None:
+                    if now >= deadline:
+                        return []
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                self.condition.wait(wait)
+
+    def __len__(self):
+        with self.condition:
+            return len(self.pending)
+
+
+class WebhookReceiver:
+
+    def __init__(self, queue, sync_state=None, host=None, port=None, secret=None, ignore_user=None, max_body=None):
+        self.queue = queue
+        self.sync_state = sync_state
+        # card activities of the middleware's own Wekan user are echoes of our writes and are ignored
+        self.ignore_user = ignore_user
+        self.host = host or os.getenv('WEBHOOK_HOST', '127.0.0.1')
+        self.port = int(port if port is not None else os.getenv('WEBHOOK_PORT', '8085'))
+        self.secret = secret if secret is not None else os.getenv('WEBHOOK_SECRET', '')
+        self.max_body = int(max_body if max_body is not None else os.getenv('WEBHOOK_MAX_BODY', '65536'))
+        self.server = None
+
+    def start(self):
+        """Start serving in a background thread"""
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_POST(self):
+                parsed = urlparse(self.path)
+                token = self.headers.get('X-Webhook-Token') or parse_qs(parsed.query).get('token', [''])[0]
+                if receiver.secret and not hmac.compare_digest(token, receiver.secret):
+                    self.refuse(403, {"error": "invalid token"})
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    self.refuse(400, {"error": "invalid Content-Length"})
+                    return
+                if length > receiver.max_body:
+                    self.refuse(413, {"error": f"body larger than {receiver.max_body} bytes"})
+                    return
+                body = self.rfile.read(length) if length else b''
+                try:
+                    payload = json.loads(body or b'{}')
+                except ValueError:
+                    self.reply(400, {"error": "invalid json"})
+                    return
+                if not isinstance(payload, dict):
+                    self.reply(400, {"error": "payload must be a JSON object"})
+                    return
+                try:
+                    if parsed.path == '/webhooks/wekan':
+                        items = receiver.handle_wekan(payload)
+                    elif parsed.path == '/webhooks/ojs':
+                        items = receiver.handle_ojs(payload)
+                    else:
+                        self.reply(404, {"error": "unknown endpoint"})
+                        return
+                except ValueError as e:
+                    self.reply(400, {"error": str(e)})
+                    return
+                self.reply(202, {"queued": [list(item) for item in items]})
+
+            def refuse(self, status, payload):
+                # the body is left unread, so the connection can't be reused for another request
+                self.close_connection = True
+                self.reply(status, payload)
+
+            def reply(self, status, payload):
+                data = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f"\033[92mWebhook receiver listening on http://{self.host}:{self.port}/webhooks/(wekan|ojs)\033[0m")
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def handle_wekan(self, payload):
+        """A card was changed on the board: resync the OJS object the card belongs to"""
+        card_id = payload.get('cardId')
+        if self.ignore_user and payload.get('user') == self.ignore_user:
+            return []
+        mapping = self.sync_state.find_mapping_by_card(card_id) if card_id and self.sync_state else None
+        if not mapping:
+            return []
+        self.queue.put(mapping['kind'], mapping['source_id'])
+        return [(mapping['kind'], mapping['source_id'])]
+
+    def handle_ojs(self, payload):
+        kind = payload.get('type')
+        source_id = payload.get('id')
+        if kind not in ('submission', 'issue') or source_id is None:
+            return []
+        # the worker looks the object up by its numeric OJS ID
+        if isinstance(source_id, bool) or not (isinstance(source_id, int) or (isinstance(source_id, str) and source_id.isdigit())):
+            raise ValueError(f"invalid {kind} id {source_id!r}, expected an integer")
+        source_id = int(source_id)
+        self.queue.put(kind, source_id)
+        return [(kind, str(source_id))]
+
+
+def send_notification(url, payload, secret=''):
+    """Stand-in sender to post a notification to a running receiver, e.g. for local tests"""
+    headers = {'X-Webhook-Token': secret} if secret else {}
+    response = requests.post(url, json=payload, headers=headers, timeout=10)
+    response.raise_for_status()
+    return response.json()
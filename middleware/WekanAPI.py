@@ -4,6 +4,16 @@ import os
 from dotenv import load_dotenv
 import requests
 import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from middleware.BoardDelta import load_drift_policy
+from middleware.BoardSnapshot import BoardSnapshot
+from middleware.CustomFieldRegistry import CustomFieldRegistry
+from middleware.HttpTransport import get_transport
+from middleware.Metrics import endpoint_template, get_metrics
+from middleware.SyncState import SyncState
 
 # Wekan API reference: https://wekan.fi/api/v7.93/#wekan-rest-api
 
@@ -19,6 +29,17 @@ PRODUCT_GROUP_BOOKSERIES = os.getenv('PRODUCT_GROUP_BOOKSERIES', 'Schriftenreihe
 PRODUCT_GROUP_ANTHOLOGY = os.getenv('PRODUCT_GROUP_ANTHOLOGY', 'Sammelbände')
 PRODUCT_GROUP_MONOGRAPH = os.getenv('PRODUCT_GROUP_MONOGRAPH', 'Monographien')
 
+# definition used to create the custom field Title if it doesn't exist on the board
+TITLE_FIELD_DEFINITION = {
+    "type": "text",
+    "settings": {},
+    "showOnCard": False,
+    "automaticallyOnCard": True,
+    "alwaysOnCard": True,
+    "showLabelOnMiniCard": True,
+    "showSumAtTopOfList": False
+}
+
 class WekanAPI:
 
     DEBUG = False
@@ -30,8 +51,38 @@ class WekanAPI:
         self.username = os.getenv('WEKAN_USERNAME')
         self.password = os.getenv('WEKAN_PASSWORD')
         self.board_name = os.getenv('DEMO_BOARD_NAME', 'Testboard')
-        self.token = None
-        self.user_id = None
+        # swimlane and name of the synchronized journal, set per tenant by the sharded runner (see Tenants)
+        self.swimlane_name = os.getenv('SYNC_SWIMLANE') or os.getenv('PRODUCT_GROUP_JOURNALS', PRODUCT_GROUP_JOURNALS)
+        self.journal_name = os.getenv('JOURNAL_NAME', '')
+        # lists of the workflow stages, read per instance as well so every tenant can name the lists of its board
+        self.stage_lists = {
+            "inbox": os.getenv('PROCESS_GROUP_INBOX', PROCESS_GROUP_INBOX),
+            "proof": os.getenv('PROCESS_GROUP_PROOF', PROCESS_GROUP_PROOF),
+            "copyediting": os.getenv('PROCESS_GROUP_COPYEDITING', PROCESS_GROUP_COPYEDITING),
+            "production": os.getenv('PROCESS_GROUP_PRODUCTION', PROCESS_GROUP_PRODUCTION)
+        }
+        self.http = get_transport()
+        self.metrics = get_metrics()
+        # a token handed over by the sharded runner is reused, it is replaced by a new login when it expires
+        self.token = os.getenv('WEKAN_TOKEN') or None
+        self.user_id = os.getenv('WEKAN_USER_ID') or None
+        self.snapshots = {}
+        self.custom_fields = {}
+        # incremental mode only writes cards whose OJS source or board state changed since the last run
+        self.sync_state_file = os.getenv('SYNC_STATE_FILE', '')
+        self.incremental = os.getenv('SYNC_INCREMENTAL', 'false').lower() in ('1', 'true', 'yes')
+        self.sync_state = None
+        # a dry run reads the board and the sync state but writes neither, not even backfilled mappings
+        self.dry_run = False
+        # several workers on the same swimlane split its cards into leased shards (see Coordinator)
+        self.coordinated = os.getenv('COORDINATION_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+        # cards changed on the board since the last check of the delta reader and the winner per field (see BoardDelta)
+        self.drift_policy = load_drift_policy()
+        self.drifted_cards = set()
+        self.pending_overrides = {}  # (card ID, field) -> OJS value of a kept board change, None to drop it
+        self.write_stats = Counter()
+        # snapshots, registries and counters are shared by the workers of the sync engine
+        self.lock = threading.RLock()
 
     def get_login_data(self):
         headers = {
@@ -40,13 +91,18 @@ class WekanAPI:
         }
         login_url = f"{self.base_url}/users/login"
         payload = {"username": self.username, "password": self.password}
-        response = requests.post(login_url, json=payload, headers=headers)
+        response = self.http.request('post', login_url, json=payload, headers=headers)
         response.raise_for_status()
         data = self.handle_response(response)
         self.token = data['token']
         self.user_id = data['id']
         return data
 
+    def ensure_login(self):
+        """Log in only if there is no token yet, long running processes keep their token between runs"""
+        if not self.token:
+            self.get_login_data()
+
     def call_api(self, method, url, params=None, data=None, json_data=None, headers=None):
         params = params or {}
         data = data or {}
@@ -66,14 +122,15 @@ class WekanAPI:
             print(f"Headers: {merged_headers}")
 
         method = method.lower()
-        if method == 'get':
-            response = requests.get(url, params=params, headers=merged_headers)
-        elif method == 'post':
-            response = requests.post(url, data=data, json=json_data, headers=merged_headers)
-        elif method == 'put':
-            response = requests.put(url, data=data, json=json_data, headers=merged_headers)
-        else:
+        if method not in ('get', 'post', 'put'):
             raise ValueError("Method must be 'get', 'put' or 'post'")
+        response = self.send_request(method, url, params, data, json_data, merged_headers)
+        if response.status_code == 401 and self.token:
+            # the token expired, log in again and repeat the request once
+            print("\033[91mWekan token rejected, logging in again.\033[0m")
+            self.get_login_data()
+            merged_headers['Authorization'] = f'Bearer {self.token}'
+            response = self.send_request(method, url, params, data, json_data, merged_headers)
         try:
             response.raise_for_status()
         except requests.HTTPError as e:
@@ -82,174 +139,414 @@ class WekanAPI:
             raise
         return self.handle_response(response)
 
+    def send_request(self, method, url, params, data, json_data, headers):
+        endpoint = endpoint_template(urlparse(url).path[len(urlparse(self.base_url).path.rstrip('/')):])
+        started = time.monotonic()
+        status = 'error'
+        try:
+            if method == 'get':
+                response = self.http.request('get', url, params=params, headers=headers)
+            else:
+                response = self.http.request(method, url, data=data, json=json_data, headers=headers)
+            status = response.status_code
+            return response
+        finally:
+            self.metrics.observe_request('wekan', method, endpoint, status, time.monotonic() - started)
+
     def handle_response(self, response):
         content_type = response.headers.get('Content-Type', '')
         if 'application/json' in content_type:
             return response.json()
         elif 'text/html' in content_type:
             print(f"\033[91mWarning: Received HTML response instead of JSON when fetching URL {response.url}.\033[0m")
-            exit(1)
+            raise ValueError(f"Received HTML response instead of JSON from {response.url}")
         else:
             return {"content": response.text}
         
-    def synchronize(self, ojs_api):
-        self.get_login_data()
-
-        # fetch issues and sections from OJS
-        ojs_api.getIssuesAndSections()
-        print(f"\033[92mCollected {len(ojs_api.sections)} unique sections from issues.\033[0m")
-
-        # create a default card for the journal itself in the inbox
+    def get_snapshot(self, board_title):
+        """Return the board snapshot of the current run, the board is loaded on first access"""
+        with self.lock:
+            if board_title not in self.snapshots:
+                self.snapshots[board_title] = BoardSnapshot(self, board_title).load()
+            return self.snapshots[board_title]
+
+    def get_custom_fields(self, board_id):
+        """Return the custom field registry of a board"""
+        with self.lock:
+            if board_id not in self.custom_fields:
+                self.custom_fields[board_id] = CustomFieldRegistry(self, board_id)
+            return self.custom_fields[board_id]
+
+    def get_sync_state(self):
+        """Return the local sync state store, if a state file is configured"""
+        with self.lock:
+            if self.sync_state is None and self.sync_state_file:
+                self.sync_state = SyncState(self.sync_state_file)
+            return self.sync_state
+
+    def begin_run(self):
+        """Log in if necessary and start with a fresh board snapshot and custom field definitions"""
+        self.ensure_login()
+        self.snapshots = {}
+        self.custom_fields = {}
+        self.drifted_cards = set()
+        self.pending_overrides = {}
+        # write requests sent for cards in this run
+        self.write_stats = Counter()
+
+    def synchronize(self, ojs_api, dry_run=False, observer=None, coordinator=None):
+        """Synchronize journal, future issues and active submissions, see SyncPlanner and SyncEngine"""
+        # the engine and the planner build on this class and are imported on use
+        from middleware.SyncEngine import SyncEngine
+        if coordinator is None and self.coordinated:
+            # a single run (e.g. of run_loop.sh) leases its shards for the duration of the run
+            coordinator = self.get_coordinator().start()
+            try:
+                return self.synchronize(ojs_api, dry_run=dry_run, observer=observer, coordinator=coordinator)
+            finally:
+                coordinator.stop()
+        if coordinator is not None and not coordinator.held:
+            print(f"\033[92mAll shards of board '{self.board_name}' are leased by other workers, nothing to synchronize.\033[0m")
+            return {"changed": 0, "unchanged": 0}
+        with self.dry_run_mode(dry_run):
+            return SyncEngine(self, ojs_api, observer=observer, coordinator=coordinator).run(dry_run=dry_run)
+
+    @contextmanager
+    def dry_run_mode(self, dry_run):
+        """Leave the sync state untouched while the block runs, if dry_run is set"""
+        previous, self.dry_run = self.dry_run, self.dry_run or dry_run
+        try:
+            yield
+        finally:
+            self.dry_run = previous
+
+    def get_coordinator(self):
+        """Coordinator of the workers sharing the swimlane of this board"""
+        from middleware.Coordination import Coordinator
+        return Coordinator(f"{self.base_url}|{self.board_name}|{self.swimlane_name}")
+
+    def count_writes(self, key, count=1):
+        with self.lock:
+            self.write_stats[key] += count
+
+    def report_write_stats(self):
+        cards = self.write_stats["created"] + self.write_stats["updated"] + self.write_stats["unchanged"]
+        print(f"\033[92mCard writes: {self.write_stats['requests']} requests for {cards} cards "
+              f"({self.write_stats['created']} created, {self.write_stats['updated']} updated, {self.write_stats['unchanged']} up to date).\033[0m")
+
+    def synchronizeSubmission(self, ojs_api, submission_id):
+        """Synchronize and link the card of a single submission, e.g. after a webhook notification"""
+        self.begin_run()
+        stats = {"changed": 0, "unchanged": 0}
+        submission = ojs_api.getSubmission(submission_id)
+        if submission.status != ojs_api.STATUS_QUEUED:
+            print(f"Submission ID {submission_id} is not active (status {submission.status}), skipping.")
+            return stats
+        if not ojs_api.sections:
+            ojs_api.getIssuesAndSections()
         journal_name = self.get_journal_name()
+        default_journal_card = self.sync_journal(journal_name, stats)
+        changed = self.sync_submission(ojs_api, journal_name, submission, stats)
+        if changed:
+            self.link_submission(*changed, default_journal_card)
+        return stats
+
+    def synchronizeIssue(self, ojs_api, issue_id):
+        """Synchronize the card of a single issue and relink the active submissions assigned to it"""
+        self.begin_run()
+        stats = {"changed": 0, "unchanged": 0}
+        issue = ojs_api.getIssue(issue_id)
+        journal_name = self.get_journal_name()
+        if not issue.is_published:
+            self.sync_issue(journal_name, issue, stats)
+        if not ojs_api.issues:
+            ojs_api.getIssuesAndSections()
+        default_journal_card = self.sync_journal(journal_name, stats)
+        # only the submissions the cached publications assign to the issue are fetched again, submissions moved
+        # to the issue since are relinked by their own notification or the next full synchronization
+        submission_ids = ojs_api.getCachedSubmissionIds(issue_id)
+        if submission_ids is None:
+            # nothing cached yet, e.g. before the first full run of the process
+            submissions = ojs_api.iterSubmissions()
+        else:
+            submissions = (ojs_api.getSubmission(submission_id) for submission_id in sorted(submission_ids))
+        for submission in submissions:
+            if submission.status != ojs_api.STATUS_QUEUED:
+                continue
+            if ojs_api.getCurrentPublication(submission).issue_id == issue_id:
+                submission_card = self.render_submission(ojs_api, journal_name, submission)
+                card = self.find_mapped_card('submission', submission.id, submission_card['card_title'])
+                if card:
+                    self.link_submission(submission, submission_card, card, default_journal_card)
+        return stats
+
+    def sync_journal(self, journal_name, stats):
+        """Create or update the default card of the journal and return it"""
+        journal_card = self.render_journal(journal_name)
+        if self.is_unchanged('journal', journal_name, None, journal_card):
+            stats["unchanged"] += 1
+            return self.find_mapped_card('journal', journal_name, journal_card['card_title'])
+
         default_journal_card = self.synchronizeCard(
+            card_id=self.get_mapped_card_id('journal', journal_name, journal_card['card_title']),
             board_title=self.board_name,
-            swimlane_title=PRODUCT_GROUP_JOURNALS,
-            list_title=PROCESS_GROUP_INBOX,
-            card_title=journal_name,
-            card_description=f"Zeitschrift {journal_name}",
+            swimlane_title=self.swimlane_name,
+            list_title=journal_card['list_title'],
+            card_title=journal_card['card_title'],
+            card_description=journal_card['card_description'],
             color="blue",
-            title=journal_name,
+            title=journal_card['title'],
             checklist=json.loads(os.getenv('CHECKLIST_TEMPLATE_JOURNAL', {}))
         )
+        self.record_mapping('journal', journal_name, default_journal_card)
+        self.record_sync_state('journal', journal_name, None, journal_card, default_journal_card)
+        stats["changed"] += 1
+        return default_journal_card
+
+    def sync_issue(self, journal_name, issue, stats):
+        """Create or update the card of a future issue"""
+        issue_card = self.render_issue(journal_name, issue)
+        issue_stamp = issue.last_modified
+        if self.is_unchanged('issue', issue.id, issue_stamp, issue_card):
+            print(f"Issue ID {issue.id} is unchanged, skipping.")
+            stats["unchanged"] += 1
+            return None
+        print(f"\033[92mSynchronizing issue ID {issue.id} with number '{issue.volume}' and year '{issue.year}'\033[0m")
+
+        card = self.synchronizeCard(
+            card_id=self.get_mapped_card_id('issue', issue.id, issue_card['card_title']),
+            board_title=self.board_name,
+            swimlane_title=self.swimlane_name,
+            list_title=issue_card['list_title'],
+            card_title=issue_card['card_title'],
+            card_description=issue_card['card_description'],
+            color="green", title=issue_card['title'],
+            checklist=json.loads(os.getenv('CHECKLIST_TEMPLATE_ISSUE', {}))
+        )
+        self.record_mapping('issue', issue.id, card)
+        self.record_sync_state('issue', issue.id, issue_stamp, issue_card, card)
+        stats["changed"] += 1
+        return card
 
-        # loop through all issues and create cards if they don't exist
-        for issue in ojs_api.future_issues.get('items', []):
-            print(f"Found future issue: {issue['identification']}")
-            locale = issue.get('locale', 'de_DE')
-            issue_number = issue.get('volume', 'No volume number')
-            issue_year = issue.get('year', 'No Year')
-            print(f"\033[92mSynchronizing issue ID {issue['id']} with number '{issue_number}' and year '{issue_year}'\033[0m")
-
-            card_title = f"{journal_name} {os.getenv('DEFAULT_ISSUE_NAME', 'Heft')} {issue_number} ({issue_year})"
-            self.synchronizeCard(
-                board_title=self.board_name,
-                swimlane_title=PRODUCT_GROUP_JOURNALS,
-                list_title=PROCESS_GROUP_INBOX,
-                card_title=card_title,
-                card_description=f"{os.getenv('DEFAULT_ISSUE_NAME', 'Heft')} {issue_number} ({issue_year})",
-                color="green", title=issue.get('title', 'No Title').get(locale, 'No Title'),
-                checklist=json.loads(os.getenv('CHECKLIST_TEMPLATE_ISSUE', {}))
-            )
+    def sync_submission(self, ojs_api, journal_name, submission, stats):
+        """Create or update the card of a submission, returns (submission, rendered card, card) if it was written"""
+        if self.DEBUG:
+            print("Active submission:", json.dumps(submission.to_dict(), indent=2))
+        submission_card = self.render_submission(ojs_api, journal_name, submission)
+        if self.is_unchanged('submission', submission.id, self.get_submission_stamp(submission), submission_card):
+            stats["unchanged"] += 1
+            return None
+        print(f"\033[92mSynchronizing submission ID {submission.id} with title '{submission_card['title']}'\033[0m")
+
+        # the parent card is known at this point, so the link is written together with the card
+        parent_card = self.find_parent_card(submission_card)
+        card = self.synchronizeCard(
+            card_id=self.get_mapped_card_id('submission', submission.id, submission_card['card_title']),
+            parent_id=parent_card['_id'] if parent_card else None,
+            board_title=self.board_name,
+            swimlane_title=self.swimlane_name,
+            list_title=submission_card['list_title'],
+            card_title=submission_card['card_title'],
+            card_description=submission_card['card_description'],
+            title=submission_card['title'],
+            checklist=json.loads(os.getenv('CHECKLIST_TEMPLATE_SUBMISSION', {}))
+        )
+        self.record_mapping('submission', submission.id, card)
+        stats["changed"] += 1
+        return (submission, submission_card, card)
+
+    def link_submission(self, submission, submission_card, card, default_journal_card):
+        """Set the parentId of a submission card to its issue card or to the default journal card"""
+        # the board snapshot already knows all cards including the ones written in this run
+        snapshot = self.get_snapshot(self.board_name)
+        board = snapshot.board
+        if not board or not card:
+            return
+        issue_id = submission_card['issue_id']
+        card_title = submission_card['card_title']
+        print(f"\033[92mProcessing card linking information for submission ID {submission.id} with current publication issueId = {issue_id}\033[0m")
+        if issue_id:
+            issue_card_title = submission_card['parent_title']
+            if issue_card_title:
+                print(f"\033[92mLinking submission ID {submission.id} to issue ID {issue_id}\033[0m")
+
+                # find issue card by its mapped card ID
+                issue_card = self.find_mapped_card('issue', issue_id, issue_card_title)
+
+                # remove existing links to default journal card from submission card
+                ## ToDO @ronste: implement removal of existing links if any. First check the problem that OJS returns issueIds even if submissions are not assigned to an issue yet.
+
+                # add parentId to submission card if not already set
+                if issue_card and card.get('parentId') != issue_card.get('_id'):
+                    print(f"Updating parentId of submission card '{card_title}' to issue card '{issue_card_title}'")
+                    updated_card = self.call_api(
+                        'put',
+                        f"{self.base_url}/api/boards/{board['_id']}/lists/{card['listId']}/cards/{card['_id']}",
+                        json_data={"parentId": issue_card.get('_id')}
+                    )
+                    self.count_writes("requests")
+                    self.record_written_fields(snapshot.apply_card(card['_id'], {"parentId": issue_card.get('_id')}))
+                    if self.DEBUG:
+                        print("Updated card:", json.dumps(updated_card, indent=2))
+        elif default_journal_card:
+            print(f"Submission ID {submission.id} has no issue assigned, linking to default journal card '{default_journal_card['title']}'.")
+            # link to default journal card via id provided by default_journal_card
+            if card.get('parentId') != default_journal_card['_id']:
+                self.call_api(
+                    'put',
+                    f"{self.base_url}/api/boards/{board['_id']}/lists/{card['listId']}/cards/{card['_id']}",
+                    json_data={"parentId": default_journal_card['_id']}
+                )
+                self.count_writes("requests")
+                self.record_written_fields(snapshot.apply_card(card['_id'], {"parentId": default_journal_card['_id']}))
+        self.record_sync_state('submission', submission.id, self.get_submission_stamp(submission), submission_card, card)
+
+    def render_journal(self, journal_name):
+        """Desired state of the default journal card"""
+        return {
+            "card_title": journal_name,
+            "card_description": f"Zeitschrift {journal_name}",
+            "list_title": self.stage_lists["inbox"],
+            "title": journal_name,
+            "parent": None,
+            "parent_title": None
+        }
 
-        # fetch OJS submissions and iterate over them
-        ojs_api.getActiveSubmissions()
-        for submission in ojs_api.iterSubmissions():
-            locale = submission.get('locale')
-            current_publication = ojs_api.getCurrentPublication(submission)
-            if self.DEBUG:
-                print("Active submission:", json.dumps(submission, indent=2))
-
-            title = current_publication.get('fullTitle', 'No Title')[locale]
-            url = current_publication.get('_href', 'No URL')
-            url = re.sub(r'/api/v1/.*$', f'/workflow/index/{submission["id"]}/{submission["stageId"]}', url)
-            authors = current_publication.get('authorsStringShort', "No Authors")
-            description = f"URL: {url} Title: {title}\n\n\nAuthors: {authors}\n\n"
-            print(f"\033[92mSynchronizing submission ID {submission['id']} with title '{title}'\033[0m")
-
-            # get submission workflow stage and map to list
-            workflow_stage = submission.get('stageId', ojs_api.WORKFLOW_STAGE_SUBMISSION)
-            if workflow_stage == ojs_api.WORKFLOW_STAGE_SUBMISSION:
-                list_name = PROCESS_GROUP_INBOX
-            elif workflow_stage == ojs_api.WORKFLOW_STAGE_INTERNAL_REVIEW or workflow_stage == ojs_api.WORKFLOW_STAGE_EXTERNAL_REVIEW:
-                list_name = PROCESS_GROUP_PROOF
-            elif workflow_stage == ojs_api.WORKFLOW_STAGE_EDITING:
-                list_name = PROCESS_GROUP_COPYEDITING
-            elif workflow_stage == ojs_api.WORKFLOW_STAGE_PRODUCTION:
-                list_name = PROCESS_GROUP_PRODUCTION
-            else:
-                list_name = PROCESS_GROUP_INBOX  # default to inbox if unknown
-
-            # get section name from OJS sections indexing by current_publication sectionId
-            section_name = self.get_section_name(ojs_api, current_publication, locale)
-            card_title = self.get_card_title(journal_name, section_name, submission['id'], authors)
-
-            self.synchronizeCard(
-                board_title=self.board_name,
-                swimlane_title=PRODUCT_GROUP_JOURNALS,
-                list_title=list_name,
-                card_title=card_title,
-                card_description=description,
-                title=title,
-                checklist=json.loads(os.getenv('CHECKLIST_TEMPLATE_SUBMISSION', {}))
-            )
+    def render_issue(self, journal_name, issue):
+        """Desired state of an issue card"""
+        return {
+            "card_title": self.get_issue_card_title(journal_name, issue),
+            "card_description": f"{os.getenv('DEFAULT_ISSUE_NAME', 'Heft')} {issue.volume} ({issue.year})",
+            "list_title": self.stage_lists["inbox"],
+            "title": issue.title,
+            "parent": None,
+            "parent_title": None
+        }
 
-        # if the publications issueId is set, find the corresponding issue and set the cards parentId to the issue card
-        # this requires that the issue cards have been created first
-        
-        # find the board and swimlane once for all linking operations
-        boards = self.call_api('get', f"{self.base_url}/api/users/{self.user_id}/boards")
-        board = next((b for b in boards if b['title'] == self.board_name), None)
-        if not board:
-            print(f"\033[91mBoard '{self.board_name}' not found.\033[0m")
-            return
+    def render_submission(self, ojs_api, journal_name, submission):
+        """Desired state of a submission card, including the title of the card it is linked to"""
+        current_publication = ojs_api.getCurrentPublication(submission)
+
+        title = current_publication.title
+        url = re.sub(r'/api/v1/.*$', f'/workflow/index/{submission.id}/{submission.stage_id}', current_publication.url)
+        authors = current_publication.authors
+        description = f"URL: {url} Title: {title}\n\n\nAuthors: {authors}\n\n"
+
+        # get submission workflow stage and map to list
+        workflow_stage = submission.stage_id if submission.stage_id is not None else ojs_api.WORKFLOW_STAGE_SUBMISSION
+        if workflow_stage == ojs_api.WORKFLOW_STAGE_SUBMISSION:
+            list_name = self.stage_lists["inbox"]
+        elif workflow_stage == ojs_api.WORKFLOW_STAGE_INTERNAL_REVIEW or workflow_stage == ojs_api.WORKFLOW_STAGE_EXTERNAL_REVIEW:
+            list_name = self.stage_lists["proof"]
+        elif workflow_stage == ojs_api.WORKFLOW_STAGE_EDITING:
+            list_name = self.stage_lists["copyediting"]
+        elif workflow_stage == ojs_api.WORKFLOW_STAGE_PRODUCTION:
+            list_name = self.stage_lists["production"]
+        else:
+            list_name = self.stage_lists["inbox"]  # default to inbox if unknown
 
-        swimlanes = self.call_api('get', f"{self.base_url}/api/boards/{board['_id']}/swimlanes")
-        swimlane = next((sl for sl in swimlanes if sl['title'] == PRODUCT_GROUP_JOURNALS), None)
-        if not swimlane:
-            print(f"\033[91mSwimlane '{PRODUCT_GROUP_JOURNALS}' not found.\033[0m")
-            return
+        # get section name from OJS sections indexing by current_publication sectionId
+        section_name = self.get_section_name(ojs_api, current_publication, submission.locale)
 
-        # get all cards in the swimlane once
-        cards = self.call_api('get', f"{self.base_url}/api/boards/{board['_id']}/swimlanes/{swimlane['_id']}/cards")
-
-        for submission in ojs_api.iterSubmissions():
-            current_publication = ojs_api.getCurrentPublication(submission)
-            # print(current_publication) # for debugging
-            issue_id = current_publication.get('issueId')
-            print(f"\033[92mProcessing card linking information for submission ID {submission['id']} with current publication issueId = {issue_id}\033[0m")
-            if issue_id:
-                issue = next((iss for iss in ojs_api.issues.get('items', []) if iss['id'] == issue_id), None)
-                if issue:
-                    locale = issue.get('locale', 'de_DE')
-                    issue_number = issue.get('volume', 'No volume number')
-                    issue_year = issue.get('year', 'No Year')
-                    issue_card_title = f"{journal_name} {os.getenv('DEFAULT_ISSUE_NAME', 'Heft')} {issue_number} ({issue_year})"
-                    submission_locale = submission.get('locale')
-                    current_publication = ojs_api.getCurrentPublication(submission)
-                    title = current_publication.get('fullTitle', 'No Title')[submission_locale]
-                    authors = current_publication.get('authorsStringShort', "No Authors")
-
-                    # get section name from OJS sections indexing by current_publication sectionId
-                    section_name = self.get_section_name(ojs_api, current_publication, locale)
-                    card_title = self.get_card_title(journal_name, section_name, submission['id'], authors)
-
-                    print(f"\033[92mLinking submission ID {submission['id']} to issue ID {issue_id}\033[0m")
-
-                    # find issue card and submission card by title
-                    issue_card = next((card for card in cards if card['title'] == issue_card_title), None)
-                    submission_card = next((card for card in cards if card['title'] == card_title), None)
-
-                    # remove existing links to default journal card from submission card
-                    ## ToDO @ronste: implement removal of existing links if any. First check the problem that OJS returns issueIds even if submissions are not assigned to an issue yet.
-
-                    # add parentId to submission card if not already set
-                    if issue_card and submission_card:
-                        if submission_card.get('parentId') != issue_card.get('_id'):
-                            print(f"Updating parentId of submission card '{card_title}' to issue card '{issue_card_title}'")
-                            updated_card = self.call_api(
-                                'put',
-                                f"{self.base_url}/api/boards/{board['_id']}/lists/{submission_card['listId']}/cards/{submission_card['_id']}",
-                                json_data={"parentId": issue_card.get('_id')}
-                            )
-                            if self.DEBUG:
-                                print("Updated card:", json.dumps(updated_card, indent=2))
-            else:
-                print(f"Submission ID {submission['id']} has no issue assigned, linking to default journal card '{default_journal_card['title']}'.")
-                # link to default journal card via id provided by default_journal_card
-                if default_journal_card:
-                    card_title = self.get_card_title(
-                        journal_name,
-                        self.get_section_name(ojs_api, ojs_api.getCurrentPublication(submission), submission.get('locale')),
-                        submission['id'],
-                        ojs_api.getCurrentPublication(submission).get('authorsStringShort', "No Authors")
-                    )
-                    submission_card = next((card for card in cards if card['title'] == card_title), None)
-                    if submission_card:
-                        self.call_api(
-                            'put',
-                            f"{self.base_url}/api/boards/{board['_id']}/lists/{submission_card['listId']}/cards/{submission_card['_id']}",
-                            json_data={"parentId": default_journal_card['_id']}
-                        )
+        # submissions are linked to their issue card or, without issue, to the default journal card
+        issue_id = current_publication.issue_id
+        if issue_id:
+            issue = ojs_api.getIssueSummary(issue_id)
+            parent = ('issue', issue_id) if issue else None
+            parent_title = self.get_issue_card_title(journal_name, issue) if issue else None
+        else:
+            parent = ('journal', journal_name)
+            parent_title = journal_name
+
+        return {
+            "card_title": self.get_card_title(journal_name, section_name, submission.id, authors),
+            "card_description": description,
+            "list_title": list_name,
+            "title": title,
+            "parent": parent,
+            "parent_title": parent_title,
+            "issue_id": issue_id
+        }
+
+    def get_submission_stamp(self, submission):
+        """Last change of a submission as reported by OJS"""
+        return f"{submission.date_last_activity}|{submission.last_modified}"
+
+    def is_unchanged(self, kind, source_id, source_stamp, rendered_card):
+        """Check in incremental mode if neither the OJS source nor the card on the board changed since the last run"""
+        sync_state = self.get_sync_state()
+        if not self.incremental or not sync_state:
+            return False
+        entry = sync_state.get(kind, source_id)
+        if not entry or entry['source_stamp'] != source_stamp or entry['payload_hash'] != SyncState.hash_payload(self.state_payload(rendered_card)):
+            return False
+        # the card drifted if it was edited, moved or removed on the board
+        card = self.find_mapped_card(kind, source_id, rendered_card['card_title'])
+        snapshot = self.get_snapshot(self.board_name)
+        target_list = snapshot.find_list(rendered_card['list_title'])
+        return bool(
+            card and target_list
+            and card['_id'] == entry['card_id']
+            and card['_id'] not in self.drifted_cards
+            and card.get('title') == rendered_card['card_title']
+            and card.get('description') == rendered_card['card_description']
+            and card.get('listId') == target_list['_id']
+        )
+
+    def find_mapped_card(self, kind, source_id, card_title, swimlane_title=None):
+        """Find the card of an OJS object by its mapped card ID, title matching is only used once to backfill the mapping"""
+        snapshot = self.get_snapshot(self.board_name)
+        if not snapshot.board:
+            return None
+        sync_state = self.get_sync_state()
+        mapping = sync_state.get_mapping(kind, source_id) if sync_state else None
+        if mapping and mapping['board_id'] == snapshot.board['_id']:
+            card = snapshot.get_card(mapping['card_id'], mapping['swimlane_id']) or self.fetch_card(snapshot, mapping)
+            if card:
+                return card
+            print(f"\033[91mMapped card {mapping['card_id']} of {kind} {source_id} not found, matching by title.\033[0m")
+
+        swimlane = snapshot.find_swimlane(swimlane_title or self.swimlane_name)
+        if not swimlane or not card_title:
+            return None
+        card = snapshot.find_card(swimlane['_id'], card_title)
+        if card and not self.dry_run:
+            self.record_mapping(kind, source_id, card)
+        return card
+
+    def get_mapped_card_id(self, kind, source_id, card_title):
+        card = self.find_mapped_card(kind, source_id, card_title)
+        return card['_id'] if card else None
+
+    def fetch_card(self, snapshot, mapping):
+        """Read a mapped card that is not part of the snapshot, e.g. because it was moved to another swimlane"""
+        try:
+            card = self.call_api('get', f"{self.base_url}/api/boards/{mapping['board_id']}/lists/{mapping['list_id']}/cards/{mapping['card_id']}")
+        except requests.HTTPError:
+            return None
+        if not isinstance(card, dict) or card.get('_id') != mapping['card_id']:
+            return None
+        return snapshot.apply_card(card['_id'], card)
+
+    def record_mapping(self, kind, source_id, card):
+        sync_state = self.get_sync_state()
+        snapshot = self.get_snapshot(self.board_name)
+        if sync_state and card and snapshot.board:
+            sync_state.set_mapping(kind, source_id, snapshot.board['_id'], card.get('swimlaneId'), card.get('listId'), card['_id'])
+
+    def find_parent_card(self, rendered_card):
+        parent_kind, parent_id = rendered_card.get('parent') or (None, None)
+        return self.find_mapped_card(parent_kind, parent_id, rendered_card['parent_title']) if parent_kind else None
+
+    def state_payload(self, rendered_card):
+        """Payload recorded in the sync state, a recreated parent card changes the payload of its children"""
+        parent_card = self.find_parent_card(rendered_card)
+        return dict(rendered_card, parent_id=parent_card['_id'] if parent_card else None)
+
+    def record_sync_state(self, kind, source_id, source_stamp, rendered_card, card):
+        sync_state = self.get_sync_state()
+        if sync_state and card:
+            sync_state.record(kind, source_id, source_stamp, self.state_payload(rendered_card), card.get('_id'))
 
     # simple test function to demonstrate usage
     def test_api(self, data=''):
@@ -291,42 +588,59 @@ class WekanAPI:
         custom_field = self.call_api('get', f"{self.base_url}/api/boards/{board['_id']}/custom-fields/{card_custom_fields[0].get('_id')}")
         print("Custom field definition:", json.dumps(custom_field, indent=2))
 
-    def synchronizeCard(self, board_title, swimlane_title, list_title, card_title, title, card_description, card_id=None, color=None, checklist=None):        
-        board = self.find_board(board_title)
+    def synchronizeCard(self, board_title, swimlane_title, list_title, card_title, title, card_description, card_id=None, color=None, checklist=None, parent_id=None):        
+        """Create or update a card with the minimum number of write requests and return its locally known state"""
+        # board structure and cards are looked up in the snapshot of the current run
+        snapshot = self.get_snapshot(board_title)
+        board = snapshot.board
         if not board:
             print(f"\033[91mBoard '{board_title}' not found.\033[0m")
             return
 
-        swimlane = self.find_swimlane(board['_id'], swimlane_title)
+        swimlane = snapshot.find_swimlane(swimlane_title)
         if not swimlane:
             print(f"\033[91mSwimlane '{swimlane_title}' not found in board '{board_title}'.\033[0m")
             return
 
-        target_list = self.find_list(board['_id'], list_title)
+        target_list = snapshot.find_list(list_title)
         if not target_list:
             print(f"\033[91mList '{list_title}' not found in board '{board_title}'.\033[0m")
             return
 
-        # Get all cards in the swimlane
-        existing_card = self.find_card_by_title(board['_id'], swimlane['_id'], card_title)
+        # cards are identified by their mapped ID, the title is only used if no ID is known
+        existing_card = snapshot.get_card(card_id) if card_id else None
+        if not existing_card:
+            existing_card = snapshot.find_card(swimlane['_id'], card_title)
 
+        # resolve the custom field Title once per board, its value is written together with the card
+        with self.metrics.span('custom_fields'):
+            title_field_id = self.get_custom_fields(board['_id']).resolve('Title', TITLE_FIELD_DEFINITION)
+        custom_fields = [{"_id": title_field_id, "value": title}] if title_field_id else None
+
+        # fields the card listing doesn't return are taken from the sync state if they were written before
+        unlisted_fields = {"customFields": custom_fields, "parentId": parent_id}
+        if existing_card and 'customFields' not in existing_card:
+            existing_card = self.apply_written_fields(snapshot, existing_card, unlisted_fields)
+
+        writes = 0
         # Update existing card or create a new one
         if existing_card:
-            print(f"Card '{card_title}' already exists. Updating...")
+            changes = self.get_card_changes(existing_card, board, swimlane, target_list, card_title, card_description, custom_fields, parent_id)
+            if not changes:
+                print(f"Card '{card_title}' is up to date.")
+                self.count_writes("unchanged")
+                return existing_card
+            print(f"Card '{card_title}' already exists. Updating {', '.join(sorted(changes))}...")
             card = self.call_api(
                 'put',
                 f"{self.base_url}/api/boards/{board['_id']}/lists/{existing_card['listId']}/cards/{existing_card['_id']}",
-                json_data={
-                    "newBoardId": board['_id'],
-                    "newSwimlaneId": swimlane['_id'],
-                    "listId": target_list['_id'],
-                    "archive": "false",
-                    "title": card_title,
-                    "description": card_description
-                }
+                json_data=changes
             )
+            writes += 1
+            self.count_writes("updated")
             if self.DEBUG:
                 print("Updated card:", json.dumps(card, indent=2))
+            card = snapshot.apply_card(existing_card['_id'], self.get_applied_fields(changes, swimlane, target_list))
         else:
             print(f"Creating new card '{card_title}'...")
             new_card = {
@@ -340,104 +654,133 @@ class WekanAPI:
                 f"{self.base_url}/api/boards/{board['_id']}/lists/{target_list['_id']}/cards",
                 json_data=new_card
             )
+            writes += 1
+            card = snapshot.apply_card(card['_id'], dict(new_card, listId=target_list['_id'], archived=False))
+            # the create endpoint ignores color, custom fields and parent, so they are set with one edit of the new card
+            changes = {}
             if color:
-                # we need to edit the card again to set the color
-                card = self.call_api(
+                changes["color"] = color
+            if custom_fields:
+                changes["customFields"] = custom_fields
+            if parent_id:
+                changes["parentId"] = parent_id
+            if changes:
+                self.call_api(
                     'put',
                     f"{self.base_url}/api/boards/{board['_id']}/lists/{target_list['_id']}/cards/{card['_id']}",
-                    json_data={"color": color}
+                    json_data=changes
                 )
+                writes += 1
+                card = snapshot.apply_card(card['_id'], changes)
             # add checklist to the card
-            checklist = self.call_api(
-                'post',
-                f"{self.base_url}/api/boards/{board['_id']}/cards/{card['_id']}/checklists",
-                json_data=checklist
-            )
-            if self.DEBUG:
-                print("Created card:", json.dumps(card, indent=2))
-        
-        # get card details, find custom field with name Title and update it
-        card_details = self.call_api('get', f"{self.base_url}/api/boards/{board['_id']}/lists/{target_list['_id']}/cards/{card['_id']}")
-        custom_fields = card_details.get('customFields', {})
-        # get details for custom field named Title
-        title_field = None
-        for field in custom_fields:
-            custom_field_details = self.call_api('get', f"{self.base_url}/api/boards/{board['_id']}/custom-fields/{field.get('_id')}")
-            if self.DEBUG:
-                print("Custom field details:", json.dumps(custom_field_details, indent=2))
-            if custom_field_details.get('name') == 'Title':
-                title_field = custom_field_details
-                break
-        if not title_field:
-            # get all custom fields of the board
-            board_custom_fields = self.call_api('get', f"{self.base_url}/api/boards/{board['_id']}/custom-fields")
-            title_field = next((cf for cf in board_custom_fields if cf.get('name') == 'Title'), None)
-            # create new custom field Title if it doesn't exist
-            if not title_field:
-                print(f"\033[91mCustom field 'Title' not found. Creating it...\033[0m")
-                title_field = self.call_api(
+            if checklist:
+                self.call_api(
                     'post',
-                    f"{self.base_url}/api/boards/{board['_id']}/custom-fields",
-                    json_data={
-                        "name": "Title",
-                        "type": "text",
-                        "settings": {},
-                        "showOnCard": False,
-                        "automaticallyOnCard": True,
-                        "alwaysOnCard": True,
-                        "showLabelOnMiniCard": True,
-                        "showSumAtTopOfList": False
-                    }
+                    f"{self.base_url}/api/boards/{board['_id']}/cards/{card['_id']}/checklists",
+                    json_data=checklist
                 )
-                if self.DEBUG:
-                    print("Created custom field 'Title':", json.dumps(title_field, indent=2))
-        
-        # update custom field Title with the provided title
-        if title_field:
-            # Handle both dict and string responses from API
-            field_id = title_field.get('_id') if isinstance(title_field, dict) else title_field
-            self.call_api(
-                'put',
-                f"{self.base_url}/api/boards/{board['_id']}/lists/{target_list['_id']}/cards/{card['_id']}",
-                json_data={"customFields": [
-                    { "_id": field_id, "value": title }
-                ]}
-            )
+                writes += 1
+            self.count_writes("created")
+            if self.DEBUG:
+                print("Created card:", json.dumps(card, indent=2))
 
-        # return card updated card details
-        return self.call_api('get', f"{self.base_url}/api/boards/{board['_id']}/lists/{target_list['_id']}/cards/{card['_id']}")
+        self.record_written_fields(card)
+        self.count_writes("requests", writes)
+        if self.DEBUG:
+            print(f"Card '{card_title}': {writes} write requests")
+        # the snapshot holds everything written above, there is no need to read the card again
+        return card
+
+    def get_card_changes(self, card, board, swimlane, target_list, card_title, card_description, custom_fields, parent_id):
+        """Fields of a known card that differ from the desired state, fields the snapshot doesn't know are always written"""
+        changes = {}
+        if card.get('swimlaneId') != swimlane['_id']:
+            changes["newBoardId"] = board['_id']
+            changes["newSwimlaneId"] = swimlane['_id']
+            changes["listId"] = target_list['_id']
+        if card.get('listId') != target_list['_id']:
+            changes["listId"] = target_list['_id']
+        if card.get('archived'):
+            changes["archive"] = "false"
+        if card.get('title') != card_title:
+            changes["title"] = card_title
+        if card.get('description') != card_description:
+            changes["description"] = card_description
+        if custom_fields:
+            known_fields = {field.get('_id'): field.get('value') for field in card.get('customFields') or []}
+            if 'customFields' not in card or any(known_fields.get(field['_id']) != field['value'] for field in custom_fields):
+                changes["customFields"] = custom_fields
+        if parent_id and card.get('parentId') != parent_id:
+            changes["parentId"] = parent_id
+        return self.apply_drift_policy(card, changes, target_list, custom_fields)
+
+    def apply_drift_policy(self, card, changes, target_list, custom_fields):
+        """Drop the changes of the fields the board wins for (DRIFT_POLICY), see BoardDelta"""
+        sync_state = self.get_sync_state()
+        if not sync_state or 'board' not in self.drift_policy.values():
+            return changes
+        # a card moved to another swimlane needs a list of the synchronized swimlane
+        fields = {"title": ("customFields", custom_fields[0]['value'] if custom_fields else None)}
+        if "newSwimlaneId" not in changes:
+            fields["list"] = ("listId", target_list['title'])
+        for field, (key, ojs_value) in fields.items():
+            if self.drift_policy[field] != 'board' or key not in changes or ojs_value is None:
+                continue
+            with self.lock:
+                pending = self.pending_overrides.get((card['_id'], field), False)
+            override = pending if pending is not False else sync_state.get_override(card['_id'], field)
+            if card['_id'] in self.drifted_cards or override == str(ojs_value):
+                # changed on the board: the board value is kept until OJS changes the field itself
+                with self.lock:
+                    self.pending_overrides[(card['_id'], field)] = str(ojs_value)
+                del changes[key]
+            elif override is not None:
+                with self.lock:
+                    self.pending_overrides[(card['_id'], field)] = None
+        return changes
+
+    def apply_written_fields(self, snapshot, card, fields):
+        """Apply unlisted fields to the snapshot card if the sync state shows they were last written with these values"""
+        sync_state = self.get_sync_state()
+        if sync_state and sync_state.get_card_fields_hash(card['_id']) == SyncState.hash_payload(fields):
+            return snapshot.apply_card(card['_id'], fields)
+        return card
+
+    def record_written_fields(self, card):
+        sync_state = self.get_sync_state()
+        if sync_state and 'customFields' in card:
+            sync_state.set_card_fields(card['_id'], {"customFields": card.get('customFields'), "parentId": card.get('parentId')})
+
+    def get_applied_fields(self, changes, swimlane, target_list):
+        """Card fields to apply to the snapshot after a successful edit"""
+        fields = {key: value for key, value in changes.items() if key not in ('newBoardId', 'newSwimlaneId', 'archive')}
+        if "newSwimlaneId" in changes:
+            fields["swimlaneId"] = swimlane['_id']
+        if "archive" in changes:
+            fields["archived"] = False
+        return fields
 
     def get_journal_name(self):
-        """Extract journal name from OJS URL"""
+        """Extract journal name from OJS URL, unless JOURNAL_NAME is set"""
+        if self.journal_name:
+            return self.journal_name
         return os.path.basename(urlparse(os.getenv('OJS_URL')).path).upper()
 
     def get_card_title(self, journal_name, section_name, submission_id, authors):
         """Generate card title for submissions"""
         return f"{journal_name}: {section_name} #{submission_id} {authors}"
 
+    def get_issue_card_title(self, journal_name, issue):
+        """Generate card title for issues"""
+        return f"{journal_name} {os.getenv('DEFAULT_ISSUE_NAME', 'Heft')} {issue.volume} ({issue.year})"
+
     def get_section_name(self, ojs_api, current_publication, locale):
         """Get section name from OJS sections indexing by current_publication sectionId"""
-        section = next((sec for sec in ojs_api.sections if sec['id'] == current_publication.get('sectionId')), {})
+        section = ojs_api.getSection(current_publication.section_id)
         if section:
             return section.get('title', '')[locale]
         else:
             if os.getenv('DEFAULT_SECTION_NAME') == '':
-                return f"Section #{current_publication.get('sectionId', '')}"
+                return f"Section #{current_publication.section_id}"
             else:
                 return f"{os.getenv('DEFAULT_SECTION_NAME', 'Section')}"
-
-    def find_board(self, board_title):
-        boards = self.call_api('get', f"{self.base_url}/api/users/{self.user_id}/boards")
-        return next((b for b in boards if b['title'] == board_title), None)
-
-    def find_swimlane(self, board_id, swimlane_title):
-        swimlanes = self.call_api('get', f"{self.base_url}/api/boards/{board_id}/swimlanes")
-        return next((s for s in swimlanes if s['title'] == swimlane_title), None)
-
-    def find_list(self, board_id, list_title):
-        lists = self.call_api('get', f"{self.base_url}/api/boards/{board_id}/lists")
-        return next((lst for lst in lists if lst['title'] == list_title), None)
-
-    def find_card_by_title(self, board_id, swimlane_id, card_title):
-        cards = self.call_api('get', f"{self.base_url}/api/boards/{board_id}/swimlanes/{swimlane_id}/cards")
-        return next((card for card in cards if card_title == card['title']), None)
\ No newline at end of file
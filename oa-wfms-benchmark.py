@@ -0,0 +1,173 @@
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+from dotenv import load_dotenv
+
+# Offline benchmark of the OJS -> Wekan synchronization
+#
+#   python3 oa-wfms-benchmark.py
+#   python3 oa-wfms-benchmark.py --submissions 1000 --issues 10 --sections 8 --existing-cards 200 --latency 0.05
+#   python3 oa-wfms-benchmark.py --scenarios warm churn --json benchmark.json
+#   python3 oa-wfms-benchmark.py --scenarios drift --drift 0.1
+#
+# Every scenario starts local stand-in servers for OJS and Wekan (benchmark/) in a separate process,
+# runs `synchronize` end to end against them and reports the wall time, the requests per endpoint, the
+# transferred bytes and the peak memory of the synchronization. Scenarios:
+#   cold    empty board, all cards are created
+#   warm    second run against an unchanged journal
+#   churn   second run after --churn (default 5%) of the submissions changed their stage or title
+#   drift   second run with DRIFT_ENABLED after --drift (default 5%) of the cards were moved or edited by hand on
+#           the board, the board is checked right away with DRIFT_INTERVAL=0 (see BoardDelta)
+# The sync state, publication cache and section catalogue are kept in a temporary directory per scenario.
+# Peak memory is measured with tracemalloc in a second pass of the scenario, so it does not slow down the
+# timed pass (--no-memory skips it).
+
+SCENARIOS = ('cold', 'warm', 'churn', 'drift')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='oa-wfms-benchmark', description='Benchmark the synchronization against local stand-in servers.')
+    parser.add_argument('--submissions', type=int, default=200, help='number of active submissions (default: 200)')
+    parser.add_argument('--issues', type=int, default=5, help='number of issues, the last one is unpublished (default: 5)')
+    parser.add_argument('--sections', type=int, default=5, help='number of journal sections (default: 5)')
+    parser.add_argument('--existing-cards', type=int, default=0, help='cards on the board that are not managed by the middleware (default: 0)')
+    parser.add_argument('--latency', type=float, default=0.01, help='response time of the stand-in servers in seconds (default: 0.01)')
+    parser.add_argument('--churn', type=float, default=0.05, help='fraction of submissions changed in the churn scenario (default: 0.05)')
+    parser.add_argument('--drift', type=float, default=0.05, help='fraction of cards changed on the board in the drift scenario (default: 0.05)')
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS), help='scenarios to run (default: all)')
+    parser.add_argument('--incremental', action='store_true', help='run with SYNC_INCREMENTAL="true" (default: value from .env)')
+    parser.add_argument('--no-memory', action='store_true', help='skip the pass that measures the peak memory')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the synchronization')
+    args = parser.parse_args()
+
+    load_dotenv()
+    if args.incremental:
+        os.environ['SYNC_INCREMENTAL'] = 'true'
+
+    results = []
+    for scenario in args.scenarios:
+        print(f"\033[92mRunning scenario '{scenario}' with {args.submissions} submissions, {args.issues} issues, "
+              f"{args.sections} sections and {args.existing_cards} existing cards ...\033[0m")
+        result = run_scenario(scenario, args)
+        if not args.no_memory:
+            result['peakMemory'] = run_scenario(scenario, args, trace_memory=True)['peakMemory']
+        results.append(result)
+        print_result(result)
+
+    print_summary(results)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({"options": vars(args), "results": results}, f, indent=2)
+        print(f"Results written to {args.json}")
+
+
+def run_scenario(scenario, args, trace_memory=False):
+    """Run one scenario against fresh stand-in servers, returns the measurements of the last synchronization"""
+    from middleware.WekanAPI import (PRODUCT_GROUP_JOURNALS, PRODUCT_GROUP_BOOKSERIES, PROCESS_GROUP_INBOX, PROCESS_GROUP_PROOF,
+                                     PROCESS_GROUP_COPYEDITING, PROCESS_GROUP_PRODUCTION, PROCESS_GROUP_POST_PRODUCTION, PROCESS_GROUP_CONTROL)
+    options = {
+        "submissions": args.submissions, "issues": args.issues, "sections": args.sections, "existing_cards": args.existing_cards,
+        "latency": args.latency, "board_title": os.getenv('DEMO_BOARD_NAME', 'Testboard'),
+        "swimlanes": [PRODUCT_GROUP_JOURNALS, PRODUCT_GROUP_BOOKSERIES],
+        "lists": [PROCESS_GROUP_INBOX, PROCESS_GROUP_PROOF, PROCESS_GROUP_COPYEDITING, PROCESS_GROUP_PRODUCTION,
+                  PROCESS_GROUP_POST_PRODUCTION, PROCESS_GROUP_CONTROL]
+    }
+    # the stand-in servers run in their own process, so they don't count towards the measured time and memory
+    context = multiprocessing.get_context('spawn')
+    connection, child_connection = context.Pipe()
+    from benchmark.FakeServer import serve
+    process = context.Process(target=serve, args=(options, child_connection), daemon=True)
+    process.start()
+    state_dir = tempfile.mkdtemp(prefix='oa-wfms-benchmark-')
+    # the drift scenario checks the board in every run, the other scenarios use the DRIFT_* settings of the .env file
+    drift_settings = {name: os.environ.get(name) for name in ('DRIFT_ENABLED', 'DRIFT_INTERVAL')}
+    if scenario == 'drift':
+        os.environ.update({"DRIFT_ENABLED": 'true', "DRIFT_INTERVAL": '0'})
+    try:
+        urls = connection.recv()
+        os.environ.update({
+            "WEKAN_URL": urls['wekan'], "WEKAN_USERNAME": "benchmark", "WEKAN_PASSWORD": "benchmark",
+            "OJS_URL": f"{urls['ojs']}/index.php/journal", "OJS_USERNAME": "benchmark", "OJS_PASSWORD": "benchmark",
+            "SYNC_STATE_FILE": os.path.join(state_dir, 'sync_state.sqlite'),
+            "OJS_PUBLICATION_CACHE": os.path.join(state_dir, 'publications.cache.json'),
+            "OJS_SECTION_CACHE": os.path.join(state_dir, 'sections.cache.json')
+        })
+
+        result = {"scenario": scenario}
+        if scenario in ('warm', 'churn', 'drift'):
+            synchronize(args.verbose)
+        if scenario == 'churn':
+            connection.send(('churn', args.churn))
+            result['changedSubmissions'] = len(connection.recv())
+        if scenario == 'drift':
+            connection.send(('drift', args.drift))
+            result['changedCards'] = len(connection.recv())
+
+        connection.send(('stats', True))
+        connection.recv()
+        if trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        stats = synchronize(args.verbose)
+        result['wallTime'] = round(time.perf_counter() - started, 3)
+        if trace_memory:
+            result['peakMemory'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        connection.send(('stats', False))
+        result['servers'] = connection.recv()
+        result['sync'] = stats
+        return result
+    finally:
+        connection.send(('stop', None))
+        process.join(timeout=10)
+        shutil.rmtree(state_dir, ignore_errors=True)
+        for name, value in drift_settings.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+def synchronize(verbose):
+    """One synchronization with new API objects, as run by `oa-wfms.py sync`"""
+    from middleware.OJSAPI import OJSAPI
+    from middleware.WekanAPI import WekanAPI
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        return WekanAPI().synchronize(OJSAPI())
+
+
+def print_result(result):
+    for server in ('ojs', 'wekan'):
+        stats = result['servers'][server]
+        for endpoint, count in sorted(stats['requests'].items()):
+            print(f"  {server.upper():5} {count:6}  {endpoint}")
+
+
+def print_summary(results):
+    print(f"\n{'scenario':10} {'wall time':>10} {'OJS req':>8} {'Wekan req':>10} {'sent':>10} {'received':>10} {'peak memory':>12}")
+    for result in results:
+        servers = result['servers'].values()
+        requests = {server: sum(stats['requests'].values()) for server, stats in result['servers'].items()}
+        # bytes as seen by the middleware: sent = requests to the servers, received = (compressed) responses
+        sent = sum(stats['bytesReceived'] for stats in servers)
+        received = sum(stats['bytesSent'] for stats in servers)
+        peak = f"{result['peakMemory'] / 1e6:.1f} MB" if 'peakMemory' in result else '-'
+        print(f"{result['scenario']:10} {result['wallTime']:>9.2f}s {requests['ojs']:>8} {requests['wekan']:>10} "
+              f"{format_bytes(sent):>10} {format_bytes(received):>10} {peak:>12}")
+
+
+def format_bytes(count):
+    return f"{count / 1024:.1f} kB" if count < 1024 * 1024 else f"{count / 1024 / 1024:.1f} MB"
+
+
+if __name__ == "__main__":
+    main()
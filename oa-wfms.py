@@ -0,0 +1,185 @@
+import argparse
+import os
+from dotenv import load_dotenv
+from middleware.OJSAPI import OJSAPI
+from middleware.WekanAPI import WekanAPI
+from middleware.SyncDaemon import SyncDaemon
+from middleware.WebhookReceiver import WorkQueue, WebhookReceiver, send_notification
+from middleware.Metrics import MetricsExporter, get_metrics
+from middleware.Profiler import start_profiler
+from middleware.Tenants import ShardedRunner, load_tenants
+from middleware.Backfill import Backfill
+from middleware.RefreshScheduler import RefreshScheduler
+from middleware.BoardDelta import BoardDelta
+
+# Command line entry point of the OJS -> Wekan middleware
+#
+#   python3 oa-wfms.py sync                 run a single synchronization
+#   python3 oa-wfms.py sync --dry-run       only print the plan of the synchronization
+#   python3 oa-wfms.py sync --metrics-summary run.json   write timings and request counts of the run as JSON
+#   python3 oa-wfms.py sync --record run.jsonl           record all requests and responses to a cassette
+#   python3 oa-wfms.py sync --replay run.jsonl --profile sample   replay a cassette without network and profile it
+#   python3 oa-wfms.py daemon [--interval]  keep synchronizing in a long-lived process
+#   python3 oa-wfms.py daemon --webhooks    additionally receive Wekan / OJS notifications
+#   python3 oa-wfms.py daemon --metrics-port 9108   serve Prometheus metrics on /metrics
+#   python3 oa-wfms.py daemon --tiered      refresh hot submissions often and dormant ones rarely between full runs
+#   python3 oa-wfms.py daemon --coordinate  share the board with daemons on other nodes via leased shards
+#   python3 oa-wfms.py repair [--dry-run]  re-check and repair only the cards changed by hand on the board
+#   python3 oa-wfms.py notify ...           send a stand-in notification to a running receiver
+#   python3 oa-wfms.py tenants [--workers]  synchronize all tenants of TENANTS_FILE in parallel worker processes
+#   python3 oa-wfms.py backfill --status published scheduled   create the cards of all submissions with these statuses,
+#                                           in batches and resumable from BACKFILL_CHECKPOINT
+
+STATUSES = {'queued': OJSAPI.STATUS_QUEUED, 'published': OJSAPI.STATUS_PUBLISHED,
+            'declined': OJSAPI.STATUS_DECLINED, 'scheduled': OJSAPI.STATUS_SCHEDULED}
+
+def main():
+    parser = argparse.ArgumentParser(prog='oa-wfms', description='Synchronize OJS submissions and issues with a Wekan board.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sync_parser = subparsers.add_parser('sync', help='run a single synchronization')
+    sync_parser.add_argument('--dry-run', action='store_true', help='print the planned card operations and the expected number of requests without writing')
+    sync_parser.add_argument('--metrics-summary', help='write the phase timings and request metrics of the run as JSON to this file (default: METRICS_SUMMARY_FILE)')
+    cassette_group = sync_parser.add_mutually_exclusive_group()
+    cassette_group.add_argument('--record', metavar='CASSETTE', help='record all HTTP requests and responses to a JSONL cassette')
+    cassette_group.add_argument('--replay', metavar='CASSETTE', help='answer all HTTP requests from a recorded cassette, without network')
+    sync_parser.add_argument('--profile', choices=['cprofile', 'sample'], help='profile the run with cProfile or the sampling profiler')
+    sync_parser.add_argument('--profile-output', help='profile file (default: oa-wfms.pstats or oa-wfms.folded)')
+    sync_parser.add_argument('--coordinate', action='store_true', default=None,
+                             help='only synchronize the shards leased from COORDINATION_STORE (default: COORDINATION_ENABLED)')
+
+    daemon_parser = subparsers.add_parser('daemon', help='run the synchronization continuously in a long-lived process')
+    daemon_parser.add_argument('--interval', type=float, help='base interval between synchronizations in seconds (default: DAEMON_INTERVAL)')
+    daemon_parser.add_argument('--webhooks', action='store_true', help='start the webhook receiver (WEBHOOK_HOST, WEBHOOK_PORT)')
+    daemon_parser.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on this port (default: METRICS_PORT, empty = disabled)')
+    daemon_parser.add_argument('--tiered', action='store_true', default=None,
+                               help='refresh due submissions by refresh tier between full runs (default: REFRESH_TIERED)')
+    daemon_parser.add_argument('--coordinate', action='store_true', default=None,
+                               help='share the board with other workers by leasing shards from COORDINATION_STORE (default: COORDINATION_ENABLED)')
+
+    repair_parser = subparsers.add_parser('repair', help='re-check and repair only the cards changed on the board since the last check')
+    repair_parser.add_argument('--dry-run', action='store_true', help='print the card operations without writing or advancing the high-water mark')
+
+    notify_parser = subparsers.add_parser('notify', help='send a stand-in notification to a running webhook receiver')
+    notify_parser.add_argument('kind', choices=['submission', 'issue', 'card'], help='OJS object type or Wekan card')
+    notify_parser.add_argument('id', help='OJS submission / issue ID or Wekan card ID')
+    notify_parser.add_argument('--url', default=None, help='receiver base URL (default: http://WEBHOOK_HOST:WEBHOOK_PORT)')
+
+    tenants_parser = subparsers.add_parser('tenants', help='synchronize all journals of the tenants file, boards in parallel')
+    tenants_parser.add_argument('--file', help='tenants file (default: TENANTS_FILE)')
+    tenants_parser.add_argument('--only', nargs='+', metavar='TENANT', help='only synchronize these tenants')
+    tenants_parser.add_argument('--workers', type=int, help='number of worker processes (default: TENANT_WORKERS)')
+    tenants_parser.add_argument('--dry-run', action='store_true', help='only print the plans of the synchronizations')
+
+    backfill_parser = subparsers.add_parser('backfill', help='create the cards of all submissions with the given statuses, resumable')
+    backfill_parser.add_argument('--status', nargs='+', choices=list(STATUSES), default=['queued', 'published', 'scheduled'],
+                                 help='submission statuses to backfill (default: queued published scheduled)')
+    backfill_parser.add_argument('--batch-size', type=int, help='submissions per batch and checkpoint (default: BACKFILL_BATCH_SIZE)')
+    backfill_parser.add_argument('--checkpoint', help='checkpoint file (default: BACKFILL_CHECKPOINT)')
+    backfill_parser.add_argument('--restart', action='store_true', help='ignore the checkpoint and start from the first submission')
+    backfill_parser.add_argument('--no-checklists', action='store_true', help='create the cards without checklists, saves a request per card')
+    backfill_parser.add_argument('--dry-run', action='store_true', help='print the planned card operations without writing or checkpointing')
+
+    args = parser.parse_args()
+
+    if args.command == 'notify':
+        notify(args)
+        return
+    if args.command == 'tenants':
+        sync_tenants(args)
+        return
+
+    if args.command == 'sync' and (args.record or args.replay):
+        # the transport is created with the API objects and picks up the cassette settings
+        os.environ['HTTP_CASSETTE'] = args.record or args.replay
+        os.environ['HTTP_CASSETTE_MODE'] = 'record' if args.record else 'replay'
+
+    wekan_api = WekanAPI()
+    ojs_api = OJSAPI()
+    if getattr(args, 'coordinate', None):
+        wekan_api.coordinated = True
+    if args.command == 'sync':
+        summary_file = args.metrics_summary or os.getenv('METRICS_SUMMARY_FILE', '')
+        profiler = start_profiler(args.profile, args.profile_output) if args.profile else None
+        try:
+            wekan_api.synchronize(ojs_api, dry_run=args.dry_run)
+        finally:
+            if profiler:
+                profiler.stop()
+            if wekan_api.http.cassette:
+                wekan_api.http.cassette.report()
+            if summary_file:
+                get_metrics().write_summary(summary_file)
+                print(f"Run summary written to {summary_file}")
+    elif args.command == 'daemon':
+        queue = None
+        receiver = None
+        exporter = None
+        if args.webhooks:
+            queue = WorkQueue()
+            receiver = WebhookReceiver(queue, sync_state=wekan_api.get_sync_state(), ignore_user=wekan_api.username).start()
+        metrics_port = args.metrics_port if args.metrics_port is not None else os.getenv('METRICS_PORT', '')
+        if metrics_port not in ('', None):
+            exporter = MetricsExporter(get_metrics(), port=metrics_port).start()
+        tiered = args.tiered if args.tiered is not None else os.getenv('REFRESH_TIERED', 'false').lower() in ('1', 'true', 'yes')
+        scheduler = RefreshScheduler(wekan_api, ojs_api) if tiered else None
+        coordinator = wekan_api.get_coordinator() if wekan_api.coordinated else None
+        drift = os.getenv('DRIFT_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+        # the full runs read the board changes themselves, the refresh cycles in between repair them
+        delta = BoardDelta(wekan_api) if scheduler and drift and wekan_api.get_sync_state() else None
+        try:
+            SyncDaemon(wekan_api, ojs_api, interval=args.interval, queue=queue, scheduler=scheduler, coordinator=coordinator,
+                       delta=delta).run_forever()
+        finally:
+            if receiver:
+                receiver.stop()
+            if exporter:
+                exporter.stop()
+    elif args.command == 'repair':
+        if not wekan_api.get_sync_state():
+            raise SystemExit("The delta reader keeps its high-water mark in the sync state, set SYNC_STATE_FILE.")
+        stats = BoardDelta(wekan_api).run(ojs_api, dry_run=args.dry_run)
+        if stats.get('failed'):
+            raise SystemExit(1)
+    elif args.command == 'backfill':
+        backfill = Backfill(wekan_api, ojs_api, [STATUSES[status] for status in args.status], batch_size=args.batch_size,
+                            checkpoint_file=args.checkpoint, checklists=not args.no_checklists)
+        stats = backfill.run(restart=args.restart, dry_run=args.dry_run)
+        if stats.get('failed'):
+            raise SystemExit(1)
+
+
+def sync_tenants(args):
+    load_dotenv()
+    load_dotenv(dotenv_path=".secrets.env")
+    tenants = load_tenants(args.file)
+    if args.only:
+        unknown = set(args.only) - {tenant.name for tenant in tenants}
+        if unknown:
+            raise SystemExit(f"Unknown tenants: {', '.join(sorted(unknown))}")
+        tenants = [tenant for tenant in tenants if tenant.name in args.only]
+    results = ShardedRunner(tenants, workers=args.workers).run(dry_run=args.dry_run)
+    ShardedRunner.report(results)
+    summary_file = os.getenv('METRICS_SUMMARY_FILE', '')
+    if summary_file:
+        ShardedRunner.write_summary(results, summary_file)
+        print(f"Run summary written to {summary_file}")
+    if any(result['result'] != 'ok' for result in results):
+        raise SystemExit(1)
+
+
+def notify(args):
+    load_dotenv()
+    load_dotenv(dotenv_path=".secrets.env")
+    base_url = args.url or f"http://{os.getenv('WEBHOOK_HOST', '127.0.0.1')}:{os.getenv('WEBHOOK_PORT', '8085')}"
+    if args.kind == 'card':
+        # mimics a Wekan outgoing webhook of a card activity
+        result = send_notification(f"{base_url}/webhooks/wekan", {"description": "act-moveCard", "cardId": args.id}, os.getenv('WEBHOOK_SECRET', ''))
+    else:
+        # mimics an OJS plugin callback
+        result = send_notification(f"{base_url}/webhooks/ojs", {"type": args.kind, "id": int(args.id)}, os.getenv('WEBHOOK_SECRET', ''))
+    print("Receiver response:", result)
+
+
+if __name__ == "__main__":
+    main()